@@ -0,0 +1,64 @@
+import sys
+import timeit
+import codec
+from message import Message
+from tabulate import tabulate
+from utils import *
+
+# Micro-benchmark of the wire formats
+# python bench_codec.py [iterations]
+
+""" Compares the binary codec with the json format for the most frequent message shapes:
+encoding time, decoding time (per message) and bytes on the wire. """
+
+
+def sample_messages():
+    leader = ("192.168.0.54", 3001)
+    follower = ("192.168.0.54", 3002)
+    client = ("192.168.0.54", 4001)
+
+    heartbeat = Message('AppendEntries', from_address=leader, to_address=follower, leader_address=leader,
+                        from_id=1, term=12, prev_index=48210, prev_term=12, entries=[], commit_index=48210)
+
+    request_vote = Message('RequestVote', from_address=leader, to_address=follower, from_id=1, term=13,
+                           last_log_index=48210, last_log_term=12)
+
+    entries = []
+    for i in range(20):
+        serial = "{0}-2022-02-16 21:32:{1:02d}.343491".format(client, i)
+        entries.append(Log(Command(client, serial, "SET", str(i % 5 + 1), "value-{0}".format(i)), 12))
+
+    append_entries = Message('AppendEntries', from_address=leader, to_address=follower, leader_address=leader,
+                             from_id=1, term=12, prev_index=48210, prev_term=12, entries=entries,
+                             commit_index=48210)
+
+    append_reply = Message('AppendEntries', from_address=leader, to_address=follower, from_id=2, term=12,
+                           success=True, match_index=48230)
+
+    return [("Heartbeat", heartbeat, "request"),
+            ("RequestVote", request_vote, "request"),
+            ("AppendEntries (20 entries)", append_entries, "request"),
+            ("AppendEntries-Reply", append_reply, "reply")]
+
+
+def json_encode(message):
+    return json.dumps(message, default=to_dict, indent=4).encode()
+
+
+if __name__ == '__main__':
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    rows = []
+    for name, message, direction in sample_messages():
+        message.direction = direction
+
+        for wire_format, encode in (("json", json_encode), ("binary", codec.encode)):
+            data = encode(message)
+            encode_time = timeit.timeit(lambda: encode(message), number=iterations) / iterations
+            decode_time = timeit.timeit(lambda: Message.deserialize(data), number=iterations) / iterations
+
+            rows.append([name, wire_format, len(data),
+                         "{0:.2f}".format(encode_time * 1e6), "{0:.2f}".format(decode_time * 1e6)])
+
+    print(tabulate(rows, headers=["Message", "Format", "Bytes", "Encode (us)", "Decode (us)"], tablefmt='fancy_grid'))
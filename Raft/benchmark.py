@@ -0,0 +1,274 @@
+import os
+import sys
+import shutil
+import argparse
+import asyncio
+import subprocess
+from datetime import datetime
+from tabulate import tabulate
+from raft_client import AsyncRaftClient
+from server import get_server_info
+from stats import request_stats
+from utils import *
+
+# Load generator and benchmark of a local cluster
+# python benchmark.py --servers 3 --clients 16 --duration 10 --reads 0.5 --value-size 16
+
+""" Starts a cluster of N servers on this host and drives it with M simulated clients. The servers run in
+CLUSTER_DIRECTORY, with their own configurations (created by raft_setup.py) and write-ahead logs, so a run leaves
+the configurations and the data of the local cluster alone. Each client sends one command at a time and sends
+the next one as soon as it gets the response (closed loop), choosing GET or SET according to the given mix.
+It reports the throughput, the round-trip time of the commands seen by the clients (p50, p99, p999), the commit
+latency measured by the leader (from the append of a command to its commit, over the whole run, warmup
+included) and the CPU used by the leader, and writes them along with the parameters of the run (and the git
+commit) to a json results file, so that runs can be compared across commits.
+With --groups, the servers run several Raft groups (multiraft.py), and the CPU is measured on the leader
+of the lowest group used. """
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of a local Raft cluster")
+    parser.add_argument("--servers", type=int, default=3, help="number of servers of the cluster")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measurement")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of load before measuring")
+    parser.add_argument("--reads", type=float, default=0.5, help="fraction of GET commands (0..1)")
+    parser.add_argument("--value-size", type=int, default=16, help="size in bytes of the values set")
+    parser.add_argument("--keys", type=int, default=5, help="number of distinct positions used")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the commands chosen")
+    parser.add_argument("--follower-reads", action="store_true", help="send the GETs to any server")
+    parser.add_argument("--groups", type=int, default=None, help="number of Raft groups of each server")
+    parser.add_argument("--output", default=None, help="results file (results/benchmark-<date>.json)")
+    return parser.parse_args()
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Cluster ------------------------------------------------------------------------------------------------------- """
+
+# Working directory of the servers (under results/, which git ignores), rewritten by each run
+CLUSTER_DIRECTORY = os.path.join("results", "cluster")
+
+
+def start_cluster(servers, groups=None):
+    """ Creates the configurations of the servers and starts them, returns their processes {port: process}. """
+
+    # The servers read their parameters and configurations, and write their data, relative to their directory
+    shutil.copytree(os.path.join("configs", "parameters"), os.path.join(CLUSTER_DIRECTORY, "configs", "parameters"),
+                    dirs_exist_ok=True)
+    subprocess.run([sys.executable, os.path.abspath("raft_setup.py"), str(servers), "1"], check=True,
+                   stdout=subprocess.DEVNULL, cwd=CLUSTER_DIRECTORY)
+
+    processes = {}
+    for i in range(1, servers + 1):
+        config_file = "configs/server-{0}.json".format(i)
+        node_id, port, node_list = get_server_info(os.path.join(CLUSTER_DIRECTORY, config_file))
+        command = [sys.executable, os.path.abspath("server.py"), config_file]
+        if groups:
+            command = [sys.executable, os.path.abspath("multiraft.py"), config_file, str(groups)]
+        processes[port] = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                           cwd=CLUSTER_DIRECTORY)
+    return processes
+
+
+def stop_cluster(processes):
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.wait()
+
+
+def cpu_time(pid):
+    """ Returns the CPU time (user + system, in seconds) used so far by a process (Linux only). """
+    try:
+        with open("/proc/{0}/stat".format(pid), "r") as file:
+            # The process name may contain spaces, the fields are counted after it
+            fields = file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Load ---------------------------------------------------------------------------------------------------------- """
+
+
+class Recorder(object):
+    """ Keeps the latency of the commands completed while measuring. """
+
+    def __init__(self):
+        self.measuring = False
+        self.latencies = {'GET': [], 'SET': []}  # Seconds
+        self.errors = 0
+
+    def record(self, action, latency):
+        if self.measuring:
+            self.latencies[action].append(latency)
+
+    def error(self):
+        if self.measuring:
+            self.errors += 1
+
+
+async def run_client(client, number, args, recorder, stop):
+    rand = random.Random(None if args.seed is None else args.seed + number)
+    value = "x" * args.value_size
+
+    while not stop.is_set():
+        action = 'GET' if rand.random() < args.reads else 'SET'
+        position = str(rand.randint(1, args.keys))
+
+        start = time.perf_counter()
+        try:
+            await client.request(action, position, value if action == 'SET' else None)
+            recorder.record(action, time.perf_counter() - start)
+        except TimeoutError:
+            recorder.error()
+
+
+async def run_load(args, server_list, processes):
+    clients = []
+    for _ in range(args.clients):
+        client = AsyncRaftClient(server_list, follower_reads=args.follower_reads, groups=args.groups)
+        await client.start()
+        clients.append(client)
+
+    # Every key read by the GETs has a value, and the leaders must be known before measuring
+    for position in range(1, args.keys + 1):
+        await clients[0].set(str(position), "x" * args.value_size)
+
+    for client in clients[1:]:
+        client.leaders = dict(clients[0].leaders)
+
+    leader_address = min(clients[0].leaders.items(), key=lambda item: item[0] or 0, default=(None, None))[1]
+    leader_port = leader_address[1] if leader_address else None
+    leader_pid = processes[leader_port].pid if leader_port in processes else None
+
+    recorder = Recorder()
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(run_client(client, number, args, recorder, stop))
+             for number, client in enumerate(clients)]
+
+    await asyncio.sleep(args.warmup)
+
+    recorder.measuring = True
+    start_cpu = cpu_time(leader_pid) if leader_pid else None
+    start = time.perf_counter()
+
+    await asyncio.sleep(args.duration)
+
+    recorder.measuring = False
+    elapsed = time.perf_counter() - start
+    end_cpu = cpu_time(leader_pid) if leader_pid else None
+
+    stop.set()
+    await asyncio.gather(*tasks)
+    for client in clients:
+        client.close()
+
+    leader_cpu = None
+    if start_cpu is not None and end_cpu is not None:
+        leader_cpu = 100 * (end_cpu - start_cpu) / elapsed
+
+    return recorder, elapsed, leader_cpu, commit_latency(leader_address)
+
+
+def commit_latency(leader_address):
+    """ Returns the commit latency recorded by the leader (see Node.advance_commit_index), in milliseconds. """
+    try:
+        histogram = request_stats(leader_address)['histograms'].get('commit.latency')
+    except (OSError, TypeError, ValueError, KeyError):
+        return None
+
+    if not histogram:
+        return None
+
+    result = {'count': histogram['count']}
+    for name in ('p50', 'p99', 'p999'):
+        result[name + '_ms'] = histogram[name] * 1000 if histogram[name] is not None else None
+    return result
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Results ------------------------------------------------------------------------------------------------------- """
+
+
+def percentile(values, fraction):
+    """ Returns the value below which the given fraction of the (sorted) values fall. """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summary(latencies, elapsed):
+    latencies = sorted(latencies)
+    result = {'count': len(latencies), 'throughput': len(latencies) / elapsed}
+    for name, fraction in (('p50', 0.50), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(latencies, fraction)
+        result[name + '_ms'] = value * 1000 if value is not None else None
+    return result
+
+
+def report(args, recorder, elapsed, leader_cpu, leader_commit_latency):
+    results = {
+        'date': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'args': vars(args),
+        'config': {name: config[name] for name in sorted(config)},
+        'elapsed': elapsed,
+        'errors': recorder.errors,
+        'leader_cpu_percent': leader_cpu,
+        'leader_commit_latency': leader_commit_latency,
+        'all': summary(recorder.latencies['GET'] + recorder.latencies['SET'], elapsed),
+        'GET': summary(recorder.latencies['GET'], elapsed),
+        'SET': summary(recorder.latencies['SET'], elapsed),
+    }
+
+    rows = []
+    for name in ('all', 'GET', 'SET'):
+        row = results[name]
+        rows.append([name, row['count'], "{0:.1f}".format(row['throughput'])] +
+                    ["{0:.2f}".format(row[p]) if row[p] is not None else "-" for p in ('p50_ms', 'p99_ms', 'p999_ms')])
+
+    # The latency seen by the clients is a full round trip (commit, apply and both messages)
+    if leader_commit_latency:
+        rows.append(["commit (leader)", leader_commit_latency['count'], "-"] +
+                    ["{0:.2f}".format(leader_commit_latency[p]) if leader_commit_latency[p] is not None else "-"
+                     for p in ('p50_ms', 'p99_ms', 'p999_ms')])
+
+    print(tabulate(rows, headers=["Commands", "Count", "Ops/s", "p50 (ms)", "p99 (ms)", "p999 (ms)"],
+                   tablefmt='fancy_grid'))
+    print("Round trip of the commands for the clients, commit latency for the leader (whole run)")
+    print("Errors:", recorder.errors)
+    print("Leader CPU:", "{0:.1f}%".format(leader_cpu) if leader_cpu is not None else "-")
+
+    output = args.output or "results/benchmark-{0}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        file.write(json.dumps(results, indent=2))
+    print("Results:", output)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    processes = start_cluster(args.servers, args.groups)
+    try:
+        with open(os.path.join(CLUSTER_DIRECTORY, "configs", "client-1.json"), "r") as file:
+            server_list = [Host(**node) for node in json.loads(file.read())["server_list"]]
+
+        # Time for the first election
+        time.sleep(ELECTION_INTERVAL[1])
+
+        recorder, elapsed, leader_cpu, leader_commit_latency = asyncio.run(run_load(args, server_list, processes))
+    finally:
+        stop_cluster(processes)
+
+    report(args, recorder, elapsed, leader_cpu, leader_commit_latency)
@@ -1,10 +1,9 @@
 import socket
 import sys
-import message as msg
+from raft_client import RaftClient
+from state_machine import prefix_end
 from utils import *
 from tkinter import *
-from random import choice
-from datetime import datetime
 
 # python client.py configs\client-1.json
 
@@ -18,13 +17,8 @@ out; clients then try again with randomly-chosen servers.
 
 
 client_address = None
-server_address = None
 server_list = []
-
-
-def generate_serial(address):
-    """ Generates a unique serial number to assign to a command. """
-    return str(address) + "-" + str(datetime.now())
+raft_client = None  # RaftClient used to send the requests
 
 
 def get_client_data(file_name):
@@ -54,12 +48,12 @@ def check_data(action, index, new_value):
     """ Checks if the given data is consistent. """
     ok_data = True
 
-    if action != 'SET' and action != 'GET':
+    if action not in ('SET', 'GET', 'DELETE', 'SCAN'):
         txt.insert(END, "Wrong command!\n")
         ok_data = False
 
-    if not index or int(index) not in [1, 2, 3, 4, 5]:
-        txt.insert(END, "Position out of range!\n")
+    if not index and action != 'SCAN':
+        txt.insert(END, "You must enter a key!\n")
         ok_data = False
 
     if action == 'SET' and new_value == "":
@@ -70,10 +64,6 @@ def check_data(action, index, new_value):
 
 
 def send_request():
-    global client_address
-    global server_address
-    global server_list
-
     op = operation.get().upper()
     pos = position.get()
     val = value.get()
@@ -83,73 +73,27 @@ def send_request():
     if not check_data(op, pos, val):
         return
 
-    # Create a UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(client_address)
-
-    # Create Command
-    serial = generate_serial(client_address)
-    new_value = (None if op == 'GET' else val)
-    command = Command(client_address, serial, op, pos, new_value)
-
-    response_ok = False
-    timeout = time.time() + TIME_TO_RETRY
-
-    while True:
-
-        if not server_address:
-            server_address = choice(server_list).address
+    # The request runs in the client's background thread, the window is not blocked while waiting
+    # (a SCAN lists the keys that start with the one entered)
+    new_value = {'SET': val, 'SCAN': [prefix_end(pos), None]}.get(op)
+    button.config(state=DISABLED)
+    show_response(raft_client.submit(op, pos, new_value))
 
-        message = msg.Message('ClientRequest', from_address=client_address, to_address=server_address, command=command)
 
-        try:
-            # Send request
-            print('Sending message:')
-            print(' -> ', server_address)
-            message.send(sock)
+def show_response(future):
+    """ Shows the response of the request once it arrives. """
 
-            # Receive response
-            sock.settimeout(SERVER_TIMEOUT)
-            data, server = sock.recvfrom(4096)
-
-            message = msg.Message.deserialize(data.decode())
-            print(message)
-
-            if message.msg_type == "ClientRequest":
-                if message.direction == "reply":
-                    # Receives the response to the request
-                    if message.response:
-                        txt.delete("1.0", END)
-                        txt.insert(END, message.response + "\n")
-                        response_ok = True
-                        break
-                    else:
-                        # Current server is not the leader, It rejected the client’s
-                        # request and supply information about the most recent leader
-                        if message.leader_address:
-                            server_address = tuple(message.leader_address)
-                        else:
-                            # Current server has no leader's info
-                            # Try again with another server
-                            server_address = None
-
-        except socket.timeout as e:
-            print(e)
-            server_address = None
-
-        except socket.error as e:
-            print(e)
-            server_address = None
-
-        if time.time() >= timeout:
-            break
+    if not future.done():
+        root.after(50, show_response, future)
+        return
 
-    if not response_ok:
-        txt.delete("1.0", END)
-        txt.insert(END, "Impossible to connect, try again")
+    button.config(state=NORMAL)
+    txt.delete("1.0", END)
 
-    print('Closing socket')
-    sock.close()
+    try:
+        txt.insert(END, str(future.result()) + "\n")
+    except TimeoutError as e:
+        txt.insert(END, str(e))
 
 
 if __name__ == '__main__':
@@ -157,6 +101,7 @@ if __name__ == '__main__':
     # Client Data
     json_file = sys.argv[1]
     client_address, server_list = get_client_data(json_file)
+    raft_client = RaftClient(server_list, client_address)
 
     # Windows
     root = Tk()
@@ -186,17 +131,17 @@ if __name__ == '__main__':
     entry_op = Entry(root, textvariable=operation, width=25, bd=3)
     entry_op.place(x=90, y=30)
 
-    label_op2 = Label(root, text="(GET/SET)", bd=4)
+    label_op2 = Label(root, text="(GET/SET/...)", bd=4)
     label_op2.place(x=260, y=30)
 
     # Position
-    label_port = Label(root, text="Position ", bd=4)
+    label_port = Label(root, text="Key ", bd=4)
     label_port.place(x=10, y=60)
 
     entry_port = Entry(root, textvariable=position, width=25, bd=3)
     entry_port.place(x=90, y=60)
 
-    label_op2 = Label(root, text="[1..5]", bd=4)
+    label_op2 = Label(root, text="(or prefix)", bd=4)
     label_op2.place(x=260, y=60)
 
     # Value
@@ -219,3 +164,4 @@ if __name__ == '__main__':
     txt.place(x=11, y=200)
 
     root.mainloop()
+    raft_client.close()
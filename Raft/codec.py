@@ -0,0 +1,409 @@
+from utils import *
+import struct
+
+""" Compact binary encoding of the messages exchanged by servers and clients.
+
+Every message starts with a fixed header:
+    • version (1 byte): version of the encoding, messages with another version are rejected.
+    • kind (1 byte): message type and direction (type code * 2 + 1 if it is a reply).
+    • length (varint): size of the body that follows, so truncated datagrams are detected.
+The body starts with a bitmap (varint) of the fields present, followed by the values of those fields
+in the order given by the schema of the message type. Terms, indexes and ids are varints, and the log
+entries of an AppendEntries message are packed back to back.
+Decoding reads the fields straight from the received buffer, without converting it first: the messages of a batch
+are views of the datagram (memoryview), which are never copied.
+The generic values (keys, values, responses) carry a tag with their type; lists, as the ones of the multi-key
+commands and transactions, are written item by item, and only other objects fall back to json.
+
+Several messages for the same address may travel in a single datagram (see multiraft.py): a batch starts with
+the BATCH byte, followed by the number of messages and each message preceded by its size (varints). """
+
+VERSION = 1
+
+# Message types and their codes
+MSG_TYPES = ['RequestVote', 'AppendEntries', 'InstallSnapshot', 'ClientRequest', 'Stats', 'TimeoutNow']
+MSG_CODES = {msg_type: code for code, msg_type in enumerate(MSG_TYPES)}
+
+# Fields sent by each (message type, direction), in order, with the kind of value they hold
+SCHEMAS = {
+    ('RequestVote', 'request'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint'),
+                                 ('last_log_index', 'uint'), ('last_log_term', 'uint'), ('pre_vote', 'bool'),
+                                 ('transfer', 'bool')],
+    ('RequestVote', 'reply'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint'),
+                               ('granted', 'bool'), ('pre_vote', 'bool')],
+    ('AppendEntries', 'request'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint'),
+                                   ('prev_index', 'uint'), ('prev_term', 'uint'), ('commit_index', 'uint'),
+                                   ('round', 'uint'), ('entries', 'entries')],
+    ('AppendEntries', 'reply'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint'),
+                                 ('prev_index', 'uint'), ('success', 'bool'), ('match_index', 'uint'),
+                                 ('conflict_term', 'uint'), ('conflict_index', 'uint'), ('round', 'uint')],
+    ('InstallSnapshot', 'request'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint'),
+                                     ('last_included_index', 'uint'), ('last_included_term', 'uint'),
+                                     ('offset', 'uint'), ('done', 'bool'), ('data', 'str')],
+    ('InstallSnapshot', 'reply'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint'),
+                                   ('last_included_index', 'uint'), ('offset', 'uint'), ('match_index', 'uint')],
+    ('ClientRequest', 'request'): [('from_address', 'addr'), ('command', 'command'), ('commit_index', 'uint')],
+    ('ClientRequest', 'reply'): [('from_address', 'addr'), ('from_id', 'uint'), ('command', 'command'),
+                                 ('response', 'value'), ('leader_address', 'addr'), ('commit_index', 'uint')],
+    ('Stats', 'request'): [('from_address', 'addr')],
+    ('Stats', 'reply'): [('from_address', 'addr'), ('from_id', 'uint'), ('data', 'str')],
+    ('TimeoutNow', 'request'): [('from_address', 'addr'), ('from_id', 'uint'), ('term', 'uint')],
+}
+
+# Every message may belong to one of the Raft groups of a host (see multiraft.py). The group is the last field,
+# so the messages of a single group (without group_id) do not grow.
+for schema in SCHEMAS.values():
+    schema.append(('group_id', 'uint'))
+
+# Tags of the generic values (positions, values, responses)
+TAG_NONE, TAG_STR, TAG_INT, TAG_TRUE, TAG_FALSE, TAG_FLOAT, TAG_JSON, TAG_LIST = range(8)
+
+DOUBLE = struct.Struct("!d")
+
+# First byte of a batch of messages (messages start with VERSION, or with '{' in json)
+BATCH = 0xFF
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Encoding ------------------------------------------------------------------------------------------------------ """
+
+
+def write_uint(buffer, number):
+    """ Appends an unsigned integer as a varint (7 bits per byte, least significant group first). """
+    while number > 0x7F:
+        buffer.append((number & 0x7F) | 0x80)
+        number >>= 7
+    buffer.append(number)
+
+
+def write_str(buffer, string):
+    data = string.encode()
+    write_uint(buffer, len(data))
+    buffer += data
+
+
+def write_addr(buffer, address):
+    write_str(buffer, address[0])
+    write_uint(buffer, address[1])
+
+
+def write_value(buffer, value):
+    """ Appends a generic value preceded by a tag with its type. """
+    if value is None:
+        buffer.append(TAG_NONE)
+    elif isinstance(value, str):
+        buffer.append(TAG_STR)
+        write_str(buffer, value)
+    elif value is True:
+        buffer.append(TAG_TRUE)
+    elif value is False:
+        buffer.append(TAG_FALSE)
+    elif isinstance(value, int):
+        buffer.append(TAG_INT)
+        write_uint(buffer, (value << 1) if value >= 0 else ((-value << 1) - 1))  # ZigZag
+    elif isinstance(value, float):
+        buffer.append(TAG_FLOAT)
+        buffer += DOUBLE.pack(value)
+    elif isinstance(value, (list, tuple)):
+        buffer.append(TAG_LIST)
+        write_uint(buffer, len(value))
+        for item in value:
+            write_value(buffer, item)
+    else:
+        buffer.append(TAG_JSON)
+        write_str(buffer, json.dumps(value, default=to_dict))
+
+
+def write_command(buffer, command):
+    write_addr(buffer, command.client_address)
+    write_command_fields(buffer, command)
+
+
+def write_command_fields(buffer, command):
+    write_value(buffer, command.serial)
+    write_str(buffer, command.action)
+    write_value(buffer, command.position)
+    write_value(buffer, command.new_value)
+
+
+def write_entries(buffer, entries):
+    """ Appends a list of log entries. The client addresses are written once in a table
+    at the beginning, and each entry refers to its address by the position in that table
+    (starting at 1, 0 is used for entries without a client). """
+
+    addresses = {None: 0}
+    for log in entries:
+        address = log.command.client_address
+        addresses.setdefault(tuple(address) if address else None, len(addresses))
+
+    write_uint(buffer, len(addresses) - 1)
+    for address in addresses:
+        if address:
+            write_addr(buffer, address)
+
+    write_uint(buffer, len(entries))
+    for log in entries:
+        address = log.command.client_address
+        write_uint(buffer, log.term)
+        write_uint(buffer, addresses[tuple(address) if address else None])
+        write_command_fields(buffer, log.command)
+
+
+def write_entry(buffer, log):
+    """ Appends a single log entry along with its own client address (as stored in the log segment files). """
+    write_uint(buffer, log.term)
+    if log.command.client_address:
+        buffer.append(1)
+        write_addr(buffer, log.command.client_address)
+    else:
+        buffer.append(0)
+    write_command_fields(buffer, log.command)
+
+
+def entry_size(log):
+    """ Returns the number of bytes that a log entry takes in an AppendEntries message. """
+    buffer = bytearray()
+    write_uint(buffer, log.term)
+    if log.command.client_address:
+        write_addr(buffer, log.command.client_address)
+    write_command_fields(buffer, log.command)
+    return len(buffer)
+
+
+WRITERS = {
+    'uint': write_uint,
+    'bool': lambda buffer, value: buffer.append(1 if value else 0),
+    'str': write_str,
+    'addr': write_addr,
+    'value': write_value,
+    'command': write_command,
+    'entries': write_entries,
+}
+
+
+def encode(message):
+    """ Returns the binary representation of a message. """
+
+    schema = SCHEMAS[(message.msg_type, message.direction)]
+
+    present = 0
+    body = bytearray()
+    for position, (name, kind) in enumerate(schema):
+        value = getattr(message, name)
+        if value is not None:
+            present |= 1 << position
+            WRITERS[kind](body, value)
+
+    bitmap = bytearray()
+    write_uint(bitmap, present)
+
+    buffer = bytearray((VERSION, MSG_CODES[message.msg_type] * 2 + (message.direction == 'reply')))
+    write_uint(buffer, len(bitmap) + len(body))
+    buffer += bitmap
+    buffer += body
+    return bytes(buffer)
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Decoding ------------------------------------------------------------------------------------------------------ """
+
+# Each reader receives the received buffer (bytes or memoryview) and the current position,
+# and returns the decoded value along with the position that follows it.
+# Single byte varints, the most common ones, are read inline.
+
+
+def read_uint(view, pos):
+    number = view[pos]
+    if number < 0x80:
+        return number, pos + 1
+
+    number = 0
+    shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+def read_str(view, pos):
+    size = view[pos]
+    if size < 0x80:
+        pos += 1
+    else:
+        size, pos = read_uint(view, pos)
+    end = pos + size
+    return str(view[pos:end], "utf-8"), end
+
+
+def read_addr(view, pos):
+    host, pos = read_str(view, pos)
+    port, pos = read_uint(view, pos)
+    return (host, port), pos
+
+
+def read_value(view, pos):
+    tag = view[pos]
+    pos += 1
+    if tag == TAG_STR:
+        return read_str(view, pos)
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_INT:
+        number, pos = read_uint(view, pos)
+        return (number >> 1) if not number & 1 else -((number + 1) >> 1), pos
+    if tag == TAG_FLOAT:
+        return DOUBLE.unpack_from(view, pos)[0], pos + DOUBLE.size
+    if tag == TAG_LIST:
+        count, pos = read_uint(view, pos)
+        items = []
+        for _ in range(count):
+            item, pos = read_value(view, pos)
+            items.append(item)
+        return items, pos
+    if tag == TAG_JSON:
+        string, pos = read_str(view, pos)
+        return json.loads(string), pos
+    raise ValueError("Unknown value tag: " + str(tag))
+
+
+def read_command(view, pos):
+    client_address, pos = read_addr(view, pos)
+    return read_command_fields(view, pos, client_address)
+
+
+def read_command_fields(view, pos, client_address):
+    serial, pos = read_value(view, pos)
+    action, pos = read_str(view, pos)
+    position, pos = read_value(view, pos)
+    new_value, pos = read_value(view, pos)
+    return Command(client_address, serial, action, position, new_value), pos
+
+
+def read_entries(view, pos):
+    count, pos = read_uint(view, pos)
+    addresses = [None]
+    for _ in range(count):
+        address, pos = read_addr(view, pos)
+        addresses.append(address)
+
+    count, pos = read_uint(view, pos)
+    entries = []
+    append = entries.append
+    for _ in range(count):
+        term = view[pos]
+        if term < 0x80:
+            pos += 1
+        else:
+            term, pos = read_uint(view, pos)
+        address, pos = read_uint(view, pos)
+        command, pos = read_command_fields(view, pos, addresses[address])
+        append(Log(command, term))
+    return entries, pos
+
+
+def read_entry(view, pos):
+    term, pos = read_uint(view, pos)
+    client_address = None
+    if view[pos]:
+        client_address, pos = read_addr(view, pos + 1)
+    else:
+        pos += 1
+    command, pos = read_command_fields(view, pos, client_address)
+    return Log(command, term), pos
+
+
+READERS = {
+    'uint': read_uint,
+    'bool': lambda view, pos: (view[pos] == 1, pos + 1),
+    'str': read_str,
+    'addr': read_addr,
+    'value': read_value,
+    'command': read_command,
+    'entries': read_entries,
+}
+
+
+def decode(view, message_class):
+    """ Builds a message (instance of the given class) from its binary representation
+    (bytes, or a memoryview of the datagram it arrived in). """
+
+    if view[0] != VERSION:
+        raise ValueError("Unsupported message version: " + str(view[0]))
+
+    msg_type = MSG_TYPES[view[1] >> 1]
+    direction = 'reply' if view[1] & 1 else 'request'
+
+    length, pos = read_uint(view, 2)
+    if len(view) - pos < length:
+        raise ValueError("Truncated message: expected {0} bytes, got {1}".format(length, len(view) - pos))
+
+    message = message_class(msg_type, from_address=None, to_address=None, direction=direction)
+
+    present, pos = read_uint(view, pos)
+    for position, (name, kind) in enumerate(SCHEMAS[(msg_type, direction)]):
+        if present & (1 << position):
+            value, pos = READERS[kind](view, pos)
+            setattr(message, name, value)
+
+    return message
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Batches ------------------------------------------------------------------------------------------------------- """
+
+
+def pack(messages, limit=MAX_DATAGRAM_SIZE):
+    """ Packs serialized messages into as few batches as possible, each one no larger than the limit.
+    Returns the datagrams to send (a message that travels alone is not wrapped in a batch). """
+
+    header = 4  # BATCH byte and number of messages
+    datagrams = []
+    group = []
+    size = header
+    for data in messages:
+        extra = len(data) + 3  # Size of the message and its varint length (up to 3 bytes for a datagram)
+        if group and size + extra > limit:
+            datagrams.append(pack_batch(group))
+            group, size = [], header
+        group.append(data)
+        size += extra
+
+    if group:
+        datagrams.append(pack_batch(group))
+    return datagrams
+
+
+def pack_batch(messages):
+    if len(messages) == 1:
+        return messages[0]
+
+    buffer = bytearray((BATCH,))
+    write_uint(buffer, len(messages))
+    for data in messages:
+        write_uint(buffer, len(data))
+        buffer += data
+    return bytes(buffer)
+
+
+def unpack(data):
+    """ Returns the messages contained in a received datagram (a batch, or a single message).
+    The messages of a batch are views of the datagram. """
+
+    if data[0] != BATCH:
+        return [data]
+
+    view = memoryview(data)
+    count, pos = read_uint(view, 1)
+    messages = []
+    for _ in range(count):
+        size, pos = read_uint(view, pos)
+        messages.append(view[pos:pos + size])
+        pos += size
+    return messages
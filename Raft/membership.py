@@ -0,0 +1,105 @@
+from utils import *
+
+""" Membership of the cluster.
+
+The members of the cluster are not fixed: they are changed through the log, one server at a time, with
+CONFIG entries that contain the whole new configuration. A server uses the latest configuration of its log
+as soon as the entry is appended (even before it is committed), and the leader starts a new change only
+once the previous one is committed, so the majorities of two consecutive configurations always overlap.
+
+A server is added in two steps: first as a learner, which receives the log but neither votes nor counts
+for the majorities, and once it has caught up with the leader, as a voter.
+A server may also remain a learner: it serves follower reads without slowing down the elections and commits.
+    python membership.py add <node_id> <ip> <port>
+    python membership.py learner <node_id> <ip> <port>
+    python membership.py remove <node_id>
+The leadership can also be handed over to another voter (see Leadership Transfer in node.py), e.g. before
+restarting the leader (with several Raft groups, of the given group):
+    python membership.py transfer <node_id> [group] """
+
+
+class Configuration(object):
+    """ The Configuration class represents the members of the cluster: the voters, whose majority
+    is needed to elect a leader and to commit entries, and the learners, which only receive the log. """
+
+    def __init__(self, voters, learners=()):
+        self.voters = {host.node_id: host for host in voters}  # {node_id: Host}
+        self.learners = {host.node_id: host for host in learners}  # {node_id: Host}
+
+    def __str__(self):
+        return "voters: {0}, learners: {1}".format(sorted(self.voters), sorted(self.learners))
+
+    def is_voter(self, node_id):
+        return node_id in self.voters
+
+    def is_member(self, node_id):
+        return node_id in self.voters or node_id in self.learners
+
+    def members(self):
+        """ Returns every member of the cluster (voters and learners). """
+        return list(self.voters.values()) + list(self.learners.values())
+
+    def quorum_size(self):
+        """ Number of voters required to reach consensus. """
+        return len(self.voters) // 2 + 1
+
+    def with_learner(self, host):
+        return Configuration(self.voters.values(), list(self.learners.values()) + [host])
+
+    def with_voter(self, node_id):
+        """ Returns the configuration in which the given learner becomes a voter. """
+        learners = [host for host in self.learners.values() if host.node_id != node_id]
+        return Configuration(list(self.voters.values()) + [self.learners[node_id]], learners)
+
+    def without(self, node_id):
+        return Configuration([host for host in self.voters.values() if host.node_id != node_id],
+                             [host for host in self.learners.values() if host.node_id != node_id])
+
+    def to_value(self):
+        """ Returns the configuration in a json serializable form (the value of CONFIG entries and snapshots). """
+        return {'voters': [[host.node_id, list(host.address)] for host in self.voters.values()],
+                'learners': [[host.node_id, list(host.address)] for host in self.learners.values()]}
+
+    @staticmethod
+    def from_value(value):
+        return Configuration([Host(node_id, address) for node_id, address in value['voters']],
+                             [Host(node_id, address) for node_id, address in value['learners']])
+
+
+class CatchUp(object):
+    """ A server being added to the cluster, which the leader replicates to as a learner until it catches up.
+    The replication goes in rounds: each round ends when the learner has every entry that the leader had
+    when the round began. When a round takes less than the minimum election timeout, the learner is close
+    enough to the leader to become a voter without making the cluster unavailable. """
+
+    def __init__(self, request, host, round_end, round_start):
+        self.request = request  # ClientRequest message that asked for the change
+        self.host = host  # Server being added (Host)
+        self.round_end = round_end  # Last log index of the leader when the current round began
+        self.round_start = round_start  # Time at which the current round began
+        self.rounds = 1  # Number of rounds so far
+        self.progress = None  # Last (match index, snapshot offset) of the learner seen by the leader
+        self.progress_time = round_start  # Time at which the learner last made progress
+
+
+if __name__ == '__main__':
+
+    import sys
+    from raft_client import RaftClient
+
+    with open("configs/client-1.json", "r") as file:
+        servers = [Host(**server) for server in json.loads(file.read())['server_list']]
+
+    client = RaftClient(servers)
+    try:
+        if sys.argv[1] == "add":
+            print(client.add_server(int(sys.argv[2]), (sys.argv[3], int(sys.argv[4])), timeout=30))
+        elif sys.argv[1] == "learner":
+            print(client.add_learner(int(sys.argv[2]), (sys.argv[3], int(sys.argv[4])), timeout=30))
+        elif sys.argv[1] == "transfer":
+            group_id = int(sys.argv[3]) if len(sys.argv) > 3 else None
+            print(client.transfer_leader(int(sys.argv[2]), group_id, timeout=30))
+        else:
+            print(client.remove_server(int(sys.argv[2]), timeout=30))
+    finally:
+        client.close()
@@ -1,28 +1,42 @@
 from utils import *
 from tabulate import tabulate
+import codec
 
 
 class Message(object):
     """ The Message class represents a message which will be used
     for communication between the different servers of the cluster and the clients.
     These messages contain all the necessary components to be able to carry out a
-    correct communication in the implementation of the raft consensus algorithm. """
+    correct communication in the implementation of the raft consensus algorithm.
+    Most of the fields are only used by some types of message, so they are kept in slots instead of a dictionary. """
+
+    __slots__ = ('msg_type', 'from_address', 'to_address', 'direction', 'from_id', 'term', 'last_log_index',
+                 'last_log_term', 'granted', 'prev_index', 'prev_term', 'entries', 'commit_index', 'round', 'success',
+                 'match_index', 'conflict_term', 'conflict_index', 'last_included_index', 'last_included_term',
+                 'offset', 'data', 'done', 'command', 'response', 'leader_address', 'group_id', 'pre_vote',
+                 'transfer')
 
     def __init__(self, msg_type, from_address, to_address, direction=None, from_id=None, term=None, command=None,
                  response=None, leader_address=None, last_log_index=None, last_log_term=None, granted=None,
-                 prev_index=None, prev_term=None, entries=None, commit_index=None, success=None, match_index=None):
+                 prev_index=None, prev_term=None, entries=None, commit_index=None, success=None, match_index=None,
+                 last_included_index=None, last_included_term=None, offset=None, data=None, done=None,
+                 conflict_term=None, conflict_index=None, round=None, group_id=None, pre_vote=None,
+                 transfer=None):
 
         # Common fields
-        self.msg_type = msg_type  # Type of message to send (RequestVote, AppendEntries, ClientRequest)
+        self.msg_type = msg_type  # Type (RequestVote, AppendEntries, InstallSnapshot, ClientRequest, Stats, TimeoutNow)
         self.from_address = from_address  # Sender's address
         self.to_address = to_address  # Recipient's address
         self.direction = direction  # Way of the message (Request / Reply)
         self.from_id = from_id  # Id of the server that sends the message
         self.term = term  # Term number owned by the server that sends the message
+        self.group_id = group_id  # Raft group of the message, when a host runs several of them (see multiraft.py)
 
         # RequestVote
         self.last_log_index = last_log_index  # Index of the last candidate record entry
         self.last_log_term = last_log_term  # Term of last candidate record entry
+        self.pre_vote = pre_vote  # True for a PreVote, which asks for the vote of the next term (see node.py)
+        self.transfer = transfer  # True for the election that the leader asked for to transfer its leadership
 
         # RequestVote-Reply
         self.granted = granted  # True means the candidate received the vote
@@ -31,33 +45,61 @@ class Message(object):
         self.prev_index = prev_index  # Log entry index immediately prior to the new ones
         self.prev_term = prev_term  # Term of the prev_index entry
         self.entries = entries  # Log entries to store (empty for heartbeats)
-        self.commit_index = commit_index  # Leader's commit index.
+        self.commit_index = commit_index  # Leader's commit index (ClientRequest: see below)
+        self.round = round  # Leader's heartbeat round, echoed in the reply to confirm the leadership
 
         # AppendEntries-Reply
         self.success = success  # True if the follower contains an entry that matches prev_index and prev_term
         self.match_index = match_index  # Log entry index in which the follower matched the leader
+        self.conflict_term = conflict_term  # Term of the conflicting entry in the follower's log
+        self.conflict_index = conflict_index  # First index of conflict_term in the follower's log
+
+        # InstallSnapshot
+        self.last_included_index = last_included_index  # The snapshot replaces all entries up through this index
+        self.last_included_term = last_included_term  # Term of last_included_index
+        self.offset = offset  # Position of the chunk in the snapshot (next expected position in the reply)
+        self.data = data  # Chunk of the snapshot, starting at offset
+        self.done = done  # True if this is the last chunk
 
         # ClientRequest
         self.command = command  # Operation requested by the client to be executed in the distributed system
+        # commit_index: minimum log index that a follower must have applied to serve a read
+        # (in the reply, log index at which the response was given)
 
         # ClientRequest-Reply
         self.response = response  # Response message to the operation requested by the client previously
         self.leader_address = leader_address  # Address of the last leader known to the server
 
-    def send(self, socket):
+    def send(self, transport):
+        """ Sends the message as a request, returns its size in bytes. """
         self.direction = "request"
-        socket.sendto(self.serialize().encode(), self.to_address)
+        data = self.serialize()
+        transport.sendto(data, tuple(self.to_address))
+        return len(data)
 
-    def reply(self, socket):
+    def reply(self, transport):
+        """ Sends the message back to its sender as a reply, returns its size in bytes. """
         self.direction = "reply"
-        socket.sendto(self.serialize().encode(), tuple(self.from_address))
+        data = self.serialize()
+        transport.sendto(data, tuple(self.from_address))
+        return len(data)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
 
     def serialize(self):
-        return json.dumps(self, default=lambda o: o.__dict__, indent=4)
+        """ Returns the message in the wire format (binary, or indented json for debugging). """
+        if WIRE_FORMAT == "json":
+            return json.dumps(self, default=to_dict, indent=4).encode()
+        return codec.encode(self)
 
     @staticmethod
-    def deserialize(json_data):
-        msg = Message(**json.loads(json_data))
+    def deserialize(data):
+        """ Builds a message from the received bytes, whichever wire format they are in. """
+        if data[:1] != b"{":
+            return codec.decode(data, Message)
+
+        msg = Message(**json.loads(bytes(data)))
 
         if msg.command:
             msg.command = Command(**msg.command)
@@ -71,7 +113,8 @@ class Message(object):
 
         if self.msg_type == "RequestVote":
             if self.direction == "request":
-                return tabulate({'Type': [self.msg_type],
+                return tabulate({'Type': [self.msg_type + (" (pre-vote)" if self.pre_vote else
+                                                            " (transfer)" if self.transfer else "")],
                                  'Node': [str(self.from_id)],
                                  'Term': [str(self.term)],
                                  'Last_log_index': [str(self.last_log_index)],
@@ -79,7 +122,7 @@ class Message(object):
                                 headers="keys", tablefmt='fancy_grid',
                                 colalign=("center", "center", "center", "center", "center"))
             else:
-                return tabulate({'Type': [self.msg_type + "-Reply"],
+                return tabulate({'Type': [self.msg_type + "-Reply" + (" (pre-vote)" if self.pre_vote else "")],
                                  'Node': [str(self.from_id)],
                                  'Term': [str(self.term)],
                                  'Granted': [self.granted]},
@@ -102,6 +145,28 @@ class Message(object):
                                  'Node': [str(self.from_id)],
                                  'Term': [str(self.term)],
                                  'Success': [str(self.success)],
+                                 'Match_index': [str(self.match_index)],
+                                 'Conflict_term': [str(self.conflict_term)],
+                                 'Conflict_index': [str(self.conflict_index)]},
+                                headers="keys", tablefmt='fancy_grid',
+                                colalign=("center", "center", "center", "center", "center", "center", "center"))
+
+        if self.msg_type == "InstallSnapshot":
+            if self.direction == "request":
+                return tabulate({'Type': [self.msg_type],
+                                 'Node': [str(self.from_id)],
+                                 'Term': [str(self.term)],
+                                 'Last_included_index': [str(self.last_included_index)],
+                                 'Last_included_term': [str(self.last_included_term)],
+                                 'Offset': [str(self.offset)],
+                                 'Done': [str(self.done)]},
+                                headers="keys", tablefmt='fancy_grid',
+                                colalign=("center", "center", "center", "center", "center", "center", "center"))
+            else:
+                return tabulate({'Type': [self.msg_type + "-Reply"],
+                                 'Node': [str(self.from_id)],
+                                 'Term': [str(self.term)],
+                                 'Offset': [str(self.offset)],
                                  'Match_index': [str(self.match_index)]},
                                 headers="keys", tablefmt='fancy_grid',
                                 colalign=("center", "center", "center", "center", "center"))
@@ -119,3 +184,16 @@ class Message(object):
                                  'Leader': [str(self.leader_address)]},
                                 headers="keys", tablefmt='fancy_grid',
                                 colalign=("center", "center", "center", "center"))
+
+        if self.msg_type == "Stats":
+            return tabulate({'Type': [self.msg_type + ("-Reply" if self.direction == "reply" else "")],
+                             'Node': [str(self.from_id)]},
+                            headers="keys", tablefmt='fancy_grid',
+                            colalign=("center", "center"))
+
+        if self.msg_type == "TimeoutNow":
+            return tabulate({'Type': [self.msg_type],
+                             'Node': [str(self.from_id)],
+                             'Term': [str(self.term)]},
+                            headers="keys", tablefmt='fancy_grid',
+                            colalign=("center", "center", "center"))
@@ -0,0 +1,120 @@
+from utils import *
+import threading
+from math import frexp
+from collections import defaultdict
+from contextlib import contextmanager
+
+""" Counters and latency histograms of a node.
+
+Recording a value only updates a counter or a bucket, so it can be done on the hot paths.
+The histograms have 8 buckets per power of two (the percentiles are exact within ~6%),
+and only the buckets that have been used are kept. """
+
+# Buckets per power of two
+SUB_BUCKETS = 8
+
+
+class Histogram(object):
+    """ Distribution of the values recorded (durations in seconds, sizes in entries or bytes). """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = defaultdict(int)  # Number of values recorded in each bucket {bucket: count}
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+        if value > 0:
+            mantissa, exponent = frexp(value)
+            self.buckets[exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)] += 1
+        else:
+            self.buckets[None] += 1
+
+    @staticmethod
+    def upper_bound(bucket):
+        """ Returns the highest value that falls in the given bucket. """
+        if bucket is None:
+            return 0
+        exponent, sub_bucket = divmod(bucket, SUB_BUCKETS)
+        return (0.5 + (sub_bucket + 1) / (2 * SUB_BUCKETS)) * 2 ** exponent
+
+    def percentile(self, fraction):
+        """ Returns the value below which the given fraction of the values fall. """
+
+        if not self.count:
+            return None
+
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: -1e9 if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(0.50),
+                'p99': self.percentile(0.99),
+                'p999': self.percentile(0.999),
+                'max': self.max}
+
+
+class Metrics(object):
+    """ The Metrics class keeps the counters and histograms of a node, by name. """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def increment(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record(self, name, value):
+        self.histograms[name].record(value)
+
+    @contextmanager
+    def timer(self, name):
+        """ Records the time (in seconds) spent inside the with block. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[name].record(time.perf_counter() - start)
+
+    def to_dict(self):
+        return {'uptime': time.time() - self.start_time,
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())}}
+
+
+class TimedLock(object):
+    """ Reentrant lock that records, in a histogram of the metrics, how long it is held
+    (from the outermost acquire to the matching release). """
+
+    def __init__(self, metrics, name):
+        self.lock = threading.RLock()
+        self.metrics = metrics
+        self.name = name
+        self.depth = 0  # Nested acquisitions by the owner
+        self.acquired = None  # Time of the outermost acquisition
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            self.acquired = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            self.metrics.record(self.name, time.perf_counter() - self.acquired)
+        self.lock.release()
@@ -0,0 +1,187 @@
+import sys
+import signal
+import socket
+import asyncio
+import codec
+from node import Node
+from message import Message
+from storage import WriteAheadLog
+from transport import CoalescingTransport, open_transport
+from server import ServerProtocol, get_server_info
+from tracing import Tracer, ERROR, SERVER_ERROR
+from utils import *
+
+""" Several Raft groups on each server (multi-raft).
+
+A single group commits every command through one leader, which limits the throughput to what that server can
+handle. Here the data is split among several independent groups (the group of a key is given by group_of), and
+every server process (host) runs a node of each group. Each group elects its own leader, and the hosts prefer
+different leaders for different groups at start up, so every server leads some of the groups. The leaders can be
+spread again later (after a restart, for instance) with leadership transfers: python membership.py transfer <node> <g>
+
+The nodes of a host share its socket and its timers. The messages that they send while the host handles a
+datagram or a timeout are held by a CoalescingTransport and sent together, several messages per datagram,
+and the heartbeats of the groups led by a host are aligned, so a single datagram carries them to each follower.
+The messages carry their group_id, which the host uses to hand them to the right node.
+The nodes do not force their logs to disk on every event either: the host does it once for all the datagrams
+received in a pass of the event loop, right before sending the messages held (so nothing is answered before
+it is durable). With several groups each batch of commands is smaller, and this keeps the number of syncs down.
+
+    python multiraft.py configs/server-1.json <groups> """
+
+
+class RaftHost(object):
+    """ The RaftHost class represents a server that runs a node of each Raft group.
+    It has the interface that the server protocol expects from a node (see server.py). """
+
+    def __init__(self, node_id, address, node_list, groups, tracer=None):
+        self.node_id = node_id  # Host unique identifier (the id of its nodes in every group)
+        self.address = address  # Address of the host (udp_ip, udp_port)
+        self.groups = groups  # Number of Raft groups
+        self.tracer = tracer or Tracer()  # Records the events of every node of the host
+        self.coalescer = CoalescingTransport()  # Holds the messages of the nodes until the host flushes them
+        self.nodes = {group_id: Node(node_id, address, 'FOLLOWER', list(node_list), self.coalescer,
+                                     WriteAheadLog("data/server-{0}/group-{1}".format(node_id, group_id)),
+                                     tracer=self.tracer, group_id=group_id)
+                      for group_id in range(groups)}  # {group_id: Node}
+
+        for node in self.nodes.values():
+            node.deferred_sync = True
+
+    def __str__(self):
+        return "\n".join(str(node) for node in self.nodes.values())
+
+    @property
+    def transport(self):
+        return self.coalescer.transport
+
+    @transport.setter
+    def transport(self, transport):
+        self.coalescer.transport = transport
+
+    def update_state(self, data=None):
+        """ Updates the state of every node from the configuration file of the server and from its write-ahead log.
+        Each node only gets the keys of its group. The node of group g on the g-th voter (modulo the number
+        of voters) times out first, and it is likely to become the leader of that group. """
+
+        if data is None:
+            with open("configs/server-{0}.json".format(self.node_id), "r") as file:
+                data = json.loads(file.read())
+
+        for group_id, node in self.nodes.items():
+            dict_data = {key: value for key, value in dict(data['dict_data']).items()
+                         if group_of(key, self.groups) == group_id}
+            node.update_state({'dict_data': dict_data, 'join': data.get('join')})
+
+            voters = sorted(node.configuration.voters)
+            if voters[group_id % len(voters)] == self.node_id:
+                node.election_timeout = node.clock.time() + ELECTION_INTERVAL[0]
+            else:
+                node.election_timeout = random_timeout(node.clock) + ELECTION_INTERVAL[1]
+
+    def start_stats(self):
+        for group_id, node in self.nodes.items():
+            node.start_stats("data/server-{0}/group-{1}/stats.json".format(self.node_id, group_id))
+
+    def receive_message(self, message):
+        """ Hands a message to the node of its group (the messages without group_id belong to the first one,
+        as the membership changes and the statistics requests). """
+
+        node = self.nodes.get(message.group_id or 0)
+        if node:
+            node.receive_message(message)
+
+    def tick(self):
+        """ Handles the timeouts of every node. The heartbeats due within half a heartbeat interval are sent now,
+        so the heartbeats of the groups led by the host go out together. """
+        for node in self.nodes.values():
+            node.tick(HEARTBEAT_TIMEOUT / 2)
+
+    def next_deadline(self):
+        deadlines = [t for t in (node.next_deadline() for node in self.nodes.values()) if t]
+        return min(deadlines) if deadlines else None
+
+    def flush(self):
+        """ Sends the messages held since the last flush, and writes the logs of the nodes to stable storage.
+        The followers write theirs first, as their replies acknowledge the entries. The leaders do not need their
+        own entries on disk to send them (they count themselves for a majority only up to durable_index), so their
+        batches leave before their write, and the replies of the commands that it commits go out after it. """
+        leaders = [node for node in self.nodes.values() if node.state == "LEADER"]
+        for node in self.nodes.values():
+            if node not in leaders:
+                node.sync_log()
+        self.coalescer.flush()
+
+        for node in leaders:
+            node.sync_log()
+            node.log_synced()
+        self.coalescer.flush()
+
+
+class HostProtocol(ServerProtocol):
+    """ Runs a RaftHost inside the asyncio event loop. The datagrams received may contain several messages.
+    The host is flushed once the loop has handled every datagram and timeout ready in the current pass. """
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.flush_scheduled = False
+
+    def datagram_received(self, data, address):
+        for message in codec.unpack(data):
+            try:
+                self.server.receive_message(Message.deserialize(message))
+
+            except Exception as e:
+                self.server.tracer.record(ERROR, SERVER_ERROR, detail=repr(e))
+
+        self.schedule()
+        self.schedule_flush()
+
+    def timeout(self):
+        super().timeout()
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        try:
+            self.server.flush()
+        except Exception as e:
+            self.server.tracer.record(ERROR, SERVER_ERROR, detail=repr(e))
+
+
+async def run_host(host, host_address):
+    loop = asyncio.get_running_loop()
+    endpoint, protocol = await loop.create_datagram_endpoint(lambda: HostProtocol(host), local_addr=host_address)
+
+    # The large messages go over TCP, received on the same port (see transport.py)
+    host.transport, _ = await open_transport(endpoint, protocol.datagram_received, host_address)
+
+    # kill -USR1 <pid> writes the last events of the nodes to data/server-N/trace.bin
+    if hasattr(signal, "SIGUSR1"):
+        trace_file = "data/server-{0}/trace.bin".format(host.node_id)
+        loop.add_signal_handler(signal.SIGUSR1, host.tracer.dump, trace_file)
+
+    # Runs until the process is stopped
+    await loop.create_future()
+
+
+if __name__ == '__main__':
+
+    # Get data from the json file
+    node_id, port, node_list = get_server_info(sys.argv[1])
+    groups = int(sys.argv[2])
+
+    # Host Address
+    host_address = (socket.gethostbyname(socket.gethostname()), port)
+
+    host = RaftHost(node_id, host_address, node_list, groups)
+    host.update_state()
+    host.start_stats()
+    print(host)
+
+    asyncio.run(run_host(host, host_address))
@@ -1,35 +1,71 @@
 from message import *
-from math import floor
 from tabulate import tabulate
+from replicator import Replicator
+from membership import Configuration, CatchUp
+from session import SessionTable
+from state_machine import KeyValueStore
+from storage import WriteAheadLog
+from metrics import Metrics, TimedLock
+from tracing import *
 from utils import *
 import threading
+import codec
 
 
 class Node(object):
     """ The Node class represents a server with all the necessary
     components for the implementation of the raft consensus algorithm. """
 
-    def __init__(self, node_id, address, state, node_list, socket):
+    def __init__(self, node_id, address, state, node_list, transport, storage=None, clock=time, tracer=None,
+                 group_id=None, state_machine=None):
 
         self.node_id = node_id  # Node unique identifier
         self.address = address  # Address of the node (udp_ip, udp_port)
         self.state = state      # Current node status (LEADER / FOLLOWER / CANDIDATE).
-        self.node_list = node_list  # List of all servers in the system, not including himself [(node_id, address)]
+        self.node_list = node_list  # Other members of the cluster, voters and learners (see apply_configuration) [Host]
         self.leader_address = None  # Address of the current leader
-        self.dictionary_data = None  # Shared resource on the system
-        self.socket = socket
+        self.state_machine = state_machine or KeyValueStore()  # Shared resource on the system (see state_machine.py)
+        self.sessions = SessionTable()  # Responses of the commands already applied, for each client
+        self.pending_requests = set()  # Commands in the log not applied yet {(client_address, serial)}
+        self.transport = transport  # Sends the messages to other servers and clients (sendto)
+        self.storage = storage or WriteAheadLog("data/server-{0}".format(node_id))  # Stable storage of the node
+        self.deferred_sync = False  # True if the owner of the node forces the log to disk (see RaftHost.flush)
+        self.clock = clock  # Source of the current time (time)
+        self.tracer = tracer or Tracer(clock=clock)  # Records the events of the node
+        self.group_id = group_id  # Raft group of the node, when its host runs several of them (see multiraft.py)
+        self.metrics = Metrics()  # Counters and histograms of the node
         self.lock_request = threading.Lock()
-        self.lock_log = threading.RLock()
+        self.lock_log = TimedLock(self.metrics, "lock_log.held")
 
-        # Number of nodes required to reach consensus.
-        self.quorum_size = floor((len(node_list) + 1) / 2) + 1
+        # Configurations of the cluster: the one before the first entry of the log (initial, or included in the
+        # snapshot), followed by the ones of the CONFIG entries of the log. The last one is in effect.
+        self.configurations = [(0, Configuration(node_list + [Host(node_id, address)]))]  # [(index, Configuration)]
+        self.configuration = None  # Configuration in effect
+        self.quorum_size = None  # Number of voters required to reach consensus
+        self.catch_up = None  # Server being added to the cluster, while it catches up as a learner (leader only)
+        self.transfer = None  # Leadership transfer in progress (leader only, see LeadershipTransfer)
 
         # Timeout to wait for a 'AppendEntries' message
-        self.election_timeout = random_timeout()
+        self.election_timeout = random_timeout(self.clock)
 
         # Timeout to sent a 'AppendEntries' message
         self.heartbeat_timeout = None
 
+        # Timeout to append the client commands collected so far to the log (group commit)
+        self.batch_timeout = None
+        self.pending_batch = []  # Client commands waiting to be appended to the log [Command]
+
+        # Timeout to force the log to disk (FSYNC_POLICY "interval"), and time at which it was last done
+        self.sync_timeout = None
+        self.fsync_time = 0
+
+        # Timeout to write the next part of the snapshot being taken
+        self.snapshot_timeout = None
+
+        # Timeout to write the statistics of the node to its stats file (only if it has one)
+        self.stats_file = None
+        self.stats_timeout = None
+
         # -------------------------------------------------------------------------------------
         # Persistent state on all servers:
         # (Updated on stable storage before responding to RPCs)
@@ -37,22 +73,41 @@ class Node(object):
         self.current_term = 0  # Latest term server has seen
         self.voted_for = None  # Candidate Id that received vote in current term
         self.votes = set()  # Amount of votes received in current term
-        self.logs = list()  # Log entries; each entry contains command for state machine, and term
+        self.pre_votes = None  # Servers that granted the PreVote in progress, None if there is none {node_id}
+        # Log entries (each entry contains command for state machine, and term) are kept by the storage,
+        # which only holds the most recent ones in memory
+
+        # Snapshot of the state machine, replaces every log entry up to its last index
+        self.snapshot_index = 0  # Index of the last entry included in the snapshot
+        self.snapshot_term = 0  # Term of the last entry included in the snapshot
+        self.snapshot_writing = None  # Snapshot being taken, a few chunks at a time (see SnapshotWriting)
+        self.incoming_snapshot = None  # Snapshot being received from the leader [last_included_index, SnapshotWriter]
+        self.applied_size = 0  # Bytes of the log entries applied since the last snapshot
 
         # -------------------------------------------------------------------------------------
         # Volatile state on all servers:
 
         self.commit_index = 0  # Index of highest log entry known to be committed
         self.last_applied = 0  # Index of highest log entry applied to state machine
+        self.durable_index = 0  # Index of highest log entry written to stable storage (see sync_log)
+        self.leader_contact = None  # Time of the last message received from the leader of the current term
+        self.follower_reads = []  # Reads waiting for their minimum index to be applied [(time, ClientRequest)]
 
         # -------------------------------------------------------------------------------------
         # Volatile state on leaders:
 
-        # For each server, index of the next log entry to send to that server
-        self.next_index = {node.node_id: 1 for node in node_list}
+        # For each server, the replication state: index of the next log entry to send to that server,
+        # index of highest log entry known to be replicated on server, and batches in flight
+        self.replicators = {node.node_id: Replicator(node, 1, self.clock) for node in node_list}
 
-        # For each server, index of highest log entry known to be replicated on server
-        self.match_index = {node.node_id: 0 for node in node_list}
+        # Heartbeat rounds, used to confirm the leadership before serving reads
+        self.heartbeat_round = 0  # Number of the last round of AppendEntries sent to the followers
+        self.round_times = {}  # Time at which each round not yet confirmed was sent {round: time}
+        self.lease_expiration = 0  # Time until which reads may be served without confirming the leadership
+        self.pending_reads = []  # Reads waiting for a confirmation round or for the state machine [ReadRequest]
+        self.append_times = {}  # Time at which the leader appended each client command not applied yet {index: time}
+
+        self.apply_configuration()
 
     def __str__(self):
         return tabulate({'Node ID': [str(self.node_id)],
@@ -60,25 +115,171 @@ class Node(object):
                          'State': [str(self.state)]},
                         headers="keys", tablefmt='fancy_grid', colalign=("center", "center", "center"))
 
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Events ---------------------------------------------------------------------------------------------------- """
+
+    def receive_message(self, message):
+        """ Handles a message received from another server or from a client. """
+
+        self.metrics.increment("received." + message.msg_type + "." + message.direction)
+        self.tracer.record(TRACE, MESSAGE_RECEIVED,
+                           codec.MSG_CODES[message.msg_type] * 2 + (message.direction == "reply"),
+                           message.from_id or 0, message.term or 0, detail=message)
+
+        if message.msg_type == "AppendEntries":
+            if message.direction == "request":
+                self.receive_append_entries(message)
+            else:
+                self.receive_append_entries_reply(message)
+
+        elif message.msg_type == "RequestVote":
+            if message.direction == "request":
+                self.receive_request_vote(message)
+            else:
+                self.receive_request_vote_reply(message)
+
+        elif message.msg_type == "InstallSnapshot":
+            if message.direction == "request":
+                self.receive_install_snapshot(message)
+            else:
+                self.receive_install_snapshot_reply(message)
+
+        elif message.msg_type == "ClientRequest":
+            if message.direction == "request":
+                self.receive_client_request(message)
+
+        elif message.msg_type == "Stats":
+            if message.direction == "request":
+                self.receive_stats_request(message)
+
+        elif message.msg_type == "TimeoutNow":
+            if message.direction == "request":
+                self.receive_timeout_now(message)
+
+    def send(self, message):
+        """ Sends a request to another server, returns its size in bytes. """
+        message.group_id = self.group_id
+        size = message.send(self.transport)
+        self.metrics.increment("sent." + message.msg_type + ".request")
+        self.metrics.increment("sent_bytes." + message.msg_type + ".request", size)
+        return size
+
+    def reply(self, message):
+        """ Replies to the sender of a message, returns the size of the reply in bytes. """
+        message.group_id = self.group_id
+        size = message.reply(self.transport)
+        self.tracer.record(TRACE, REPLY_SENT, codec.MSG_CODES[message.msg_type] * 2 + 1, message.from_address[1])
+        self.metrics.increment("sent." + message.msg_type + ".reply")
+        self.metrics.increment("sent_bytes." + message.msg_type + ".reply", size)
+        return size
+
+    def tick(self, slack=0):
+        """ Handles the timeouts that are due. The heartbeats due within 'slack' seconds are sent now,
+        which lets the Raft groups of a host send theirs together (see multiraft.py). """
+
+        # It's time to send a heartbeat message
+        self.heartbeat_timeout_due(slack)
+
+        # Timed out to wait for a heartbeat message
+        self.election_timeout_due()
+
+        # It's time to append the collected client commands
+        self.batch_timeout_due()
+
+        # It's time to force the log to disk
+        self.sync_timeout_due()
+
+        # It's time to write the next part of the snapshot
+        self.snapshot_timeout_due()
+
+        # It's time to write the statistics
+        self.stats_timeout_due()
+
+    def next_deadline(self):
+        """ Returns the time of the next timeout (None if there is none), at which tick must be called. """
+        deadlines = [t for t in (self.heartbeat_timeout, self.election_timeout, self.batch_timeout,
+                                 self.sync_timeout, self.snapshot_timeout, self.stats_timeout) if t]
+        return min(deadlines) if deadlines else None
+
     """ ----------------------------------------------------------------------------------------------------------- """
     """ Utils ----------------------------------------------------------------------------------------------------- """
 
+    def last_log_index(self):
+        """ Returns the index of the last entry in the log (including the ones replaced by the snapshot). """
+        return self.storage.last_index
+
+    def log_entry(self, index):
+        """ Returns the log corresponding to the assigned position (index),
+        which must be after the snapshot. """
+        return self.storage.entry(index)
+
     def log_term(self, index):
         """ Returns the term of the log corresponding to the assigned position (index). """
-        if index < 1 or len(self.logs) < index:
+        if index == self.snapshot_index:
+            return self.snapshot_term
+        if index < self.snapshot_index or self.last_log_index() < index:
             return 0
-        return self.logs[index - 1].term
+        return self.storage.term(index)
+
+    def first_index_of_term(self, index):
+        """ Returns the first index of the log that has the same term as the entry at the given index.
+        The terms of the log never decrease, so it is found with a binary search. """
+
+        term = self.log_term(index)
+        low, high = self.snapshot_index + 1, index
+        while low < high:
+            middle = (low + high) // 2
+            if self.log_term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def last_index_of_term(self, term):
+        """ Returns the last index of the log whose entry has the given term, or None if there is none. """
+
+        low, high = self.snapshot_index, self.last_log_index()
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.log_term(middle) <= term:
+                low = middle
+            else:
+                high = middle - 1
+        return low if low > self.snapshot_index and self.log_term(low) == term else None
 
     def step_down(self, term):
         """ If one server’s current term is smaller than the other’s,
         then it updates its current term to the larger value. If a candidate or leader discovers
         that its term is out of date, it immediately reverts to follower state. """
 
+        if self.state != 'FOLLOWER':
+            self.tracer.record(INFO, STEPPED_DOWN, ['FOLLOWER', 'CANDIDATE', 'LEADER'].index(self.state),
+                               self.current_term, term)
+
+        # A former leader no longer sends the clients to itself
+        if self.state == 'LEADER':
+            self.leader_address = None
+
+        # A transfer ends with the leader stepping down, and the commands it held may follow the new leader
+        next_leader = self.end_transfer(term)
+
+        # The vote is kept when the term does not change (a leader removed from the cluster)
+        if term > self.current_term:
+            self.voted_for = None
+
         self.state = 'FOLLOWER'
         self.current_term = term
-        self.voted_for = None
         self.votes = set()
+        self.pre_votes = None
         self.heartbeat_timeout = None
+        self.append_times = {}
+        self.reject_reads()
+        self.discard_batch(next_leader)
+        self.cancel_catch_up()
+
+        # A former leader had no election timeout, it waits for the next leader like any other follower
+        if self.election_timeout is None:
+            self.election_timeout = random_timeout(self.clock)
 
     def advance_commit_index(self):
         """ The leader commits (advance the commitIndex) all log entries
@@ -86,86 +287,410 @@ class Node(object):
 
         # If there exists an N such that N > commitIndex,
         # a majority of matchIndex[i] ≥ N, and log[N].term == currentTerm: set commitIndex = N
-        match_list = [self.match_index[i] for i in self.match_index]
-        match_list.append(len(self.logs))
+        # (only the voters count, the leader itself included unless it is being removed,
+        # with the entries it has already written to its own stable storage)
+        match_list = [replicator.match_index for node_id, replicator in self.replicators.items()
+                      if self.configuration.is_voter(node_id)]
+        if self.configuration.is_voter(self.node_id):
+            match_list.append(min(self.durable_index, self.last_log_index()))
         match_list.sort(reverse=True)
         n = match_list[self.quorum_size - 1]
 
-        if self.state == "LEADER" and self.log_term(n) == self.current_term:
-            self.commit_index = max(self.commit_index, n)
+        if self.state == "LEADER" and self.log_term(n) == self.current_term and n > self.commit_index:
+            now = self.clock.time()
+            for index in range(self.commit_index + 1, n + 1):
+                if index in self.append_times:
+                    self.metrics.record("commit.latency", now - self.append_times[index])
+
+            self.commit_index = n
 
     def apply_log_commands(self):
         """ Applies the log commands that are safe to be executed to the state machine.
         Responds to the client request if the server is the leader. """
 
+        replies = []
+        configuration_applied = False
+
         # If commitIndex > lastApplied:
         # increment lastApplied, apply log[lastApplied] to state machine
         while self.commit_index > self.last_applied:
             self.last_applied += 1
-            cmd = self.logs[self.last_applied-1].command
-            self.execute_command(cmd)
+            log = self.log_entry(self.last_applied)
+            cmd = log.command
+            if log.size is None:
+                log.size = codec.entry_size(log)
+            self.applied_size += log.size
+            response = self.execute_command(cmd)
+            configuration_applied |= cmd.action == "CONFIG"
+
+            # Entries without a client (NOOP) do not have a response
+            if cmd.client_address is None:
+                continue
+
+            append_time = self.append_times.pop(self.last_applied, None)
+            if append_time is not None:
+                self.metrics.record("apply.latency", self.clock.time() - append_time)
+
+            # The response is kept in the client's session, in case the command is sent again
+            self.pending_requests.discard(self.request_key(cmd))
+            self.sessions.record(cmd, response, self.last_applied)
 
             if self.state == "LEADER":
                 # Responds to the client
                 message = Message("ClientRequest", from_address=tuple(cmd.client_address), to_address=self.address)
                 message.from_id = self.node_id
-                message.response = "Command executed successfully!"
-                message.reply(self.socket)
+                message.response = response
+                # The serial number lets the client match the reply with its request (the value is not sent back)
+                message.command = Command(cmd.client_address, cmd.serial, cmd.action, cmd.position)
+                message.commit_index = self.last_applied
+                replies.append(message)
+
+        # The replies are sent together, once all the ready commands have been applied
+        for message in replies:
+            self.reply(message)
+
+        if configuration_applied:
+            self.configuration_committed()
+
+        # The log has grown enough since the last snapshot
+        if self.snapshot_writing is None and \
+                self.applied_size >= max(SNAPSHOT_MIN_SIZE, SNAPSHOT_RATIO * self.storage.snapshot_size):
+            self.take_snapshot()
+
+        # Reads waiting for these entries
+        if self.pending_reads:
+            self.serve_reads()
+        if self.follower_reads:
+            self.serve_follower_reads()
 
     def execute_command(self, command):
-        """ Applies the current command in the state machine, if it has not already been applied. """
-        if not command.executed:
-            command.old_value = self.dictionary_data[command.position]
-            self.dictionary_data[command.position] = command.new_value
-            command.executed = True
-
-    def revert_command(self, command):
-        """ Reverts the current command in the state machine, if it has already been applied. """
-        if command.executed:
-            self.dictionary_data[command.position] = command.old_value
+        """ Applies the current command in the state machine, if it has not already been applied.
+        Returns the response for the client. """
+        if command.action == "NOOP":
+            return None
+        if command.action == "CONFIG":
+            return "Configuration changed: " + str(Configuration.from_value(command.new_value))
+        return self.state_machine.apply(command)
+
+    @staticmethod
+    def request_key(command):
+        """ Identifies a client's command (client address and serial number). """
+        if command.client_address is None:
+            return None
+        return tuple(command.client_address), command.serial
 
     def save_state(self):
-        """ Saves the current node status to a json configuration file. """
+        """ Saves the current node status to stable storage.
+        The term/vote record is only rewritten when it has changed (and always forced to disk), and the log
+        entries written since the last call are synced (see sync_log), or later with deferred_sync, by the owner
+        of the node, which does it before sending the messages that acknowledge them (see RaftHost.flush). """
+
+        with self.metrics.timer("save_state.duration"):
+            if self.storage.meta != (self.current_term, self.voted_for):
+                self.storage.save_meta(self.current_term, self.voted_for)
+
+            if not self.deferred_sync:
+                self.sync_log()
+
+    def sync_log(self):
+        """ Writes the log entries to stable storage, as FSYNC_POLICY says:
+            • "always": they are forced to disk (fsync) every time.
+            • "interval": they are written to the operating system every time, and forced to disk
+            at most every FSYNC_INTERVAL seconds (sync_timeout).
+            • "none": they are written to the operating system, which decides when they reach the disk.
+        Once this returns, the entries count as stored: the follower acknowledges them, and the leader counts
+        itself for their majority. """
+
+        now = self.clock.time()
+        fsync = FSYNC_POLICY == "always" or (FSYNC_POLICY == "interval" and now >= self.fsync_time + FSYNC_INTERVAL)
+
+        self.storage.sync(fsync)
+        self.durable_index = self.last_log_index()
+
+        if fsync:
+            self.fsync_time = now
+            self.sync_timeout = None
+        elif FSYNC_POLICY == "interval" and not self.sync_timeout:
+            self.sync_timeout = self.fsync_time + FSYNC_INTERVAL
+
+    def sync_timeout_due(self):
+        """ It's time to force the log to disk. """
+        if self.sync_timeout and (self.clock.time() >= self.sync_timeout):
+            self.sync_timeout = None
+            self.storage.sync()
+            self.fsync_time = self.clock.time()
+
+    def log_synced(self):
+        """ The leader's own entries just written to stable storage may complete a majority. """
+        if self.state == "LEADER" and self.commit_index < self.durable_index:
+            self.advance_commit_index()
+            self.apply_log_commands()
+
+    def update_state(self, data=None):
+        """ updates the current node status with information obtained from the json configuration file
+        (initial state of the shared resource) and from the write-ahead log (term, vote, snapshot and log entries).
+        The configuration may also be given directly (data), as the simulated network does.
+        A server that joins a running cluster ('join') does not start as a voter, it waits for the leader
+        to add it to the cluster (see Membership Changes).
+        A configuration file written by an older version, which still contains the logs, is imported
+        into the write-ahead log the first time. """
+
+        if data is None:
+            file_name = "configs/server-{0}.json".format(self.node_id)
+
+            with open(file_name, "r") as file:
+                data = json.loads(file.read())
+
+                file.close()
+
+        self.state_machine.restore([data.get('dict_data', {}).items()])
+
+        if data.get('join'):
+            self.configurations = [(0, self.configuration.without(self.node_id))]
+            self.apply_configuration()
+
+        meta = self.storage.load_meta()
+
+        snapshot = self.storage.load_snapshot()
+        if snapshot:
+            self.restore_snapshot(snapshot)
+
+        self.storage.load(self.snapshot_index)
+
+        if meta:
+            self.current_term, self.voted_for = meta
+
+        elif data.get('term'):
+            self.current_term = int(data['term'])
+            self.voted_for = data['voted_for']
 
-        file_name = "configs/server-{0}.json".format(self.node_id)
+            if data.get('logs'):
+                logs = []
+                for log in data['logs']:
+                    cmd = Command(log['command']['client_address'], log['command']['serial'],
+                                  log['command']['action'], log['command']['position'],
+                                  log['command']['new_value'])
+                    logs.append(Log(cmd, log['term']))
+                self.storage.append(logs)
 
-        data = dict()
-        data['node_id'] = self.node_id
-        data['port'] = self.address[1]
-        data['node_list'] = self.node_list
-        data['term'] = self.current_term
-        data['voted_for'] = self.voted_for
-        data['logs'] = self.logs
-        data['dict_data'] = self.dictionary_data
+        self.pending_requests = set()
+        for index, log in enumerate(self.storage.scan(self.snapshot_index + 1), self.snapshot_index + 1):
+            self.pending_requests.add(self.request_key(log.command))
+            if log.command.action == "CONFIG":
+                self.configurations.append((index, Configuration.from_value(log.command.new_value)))
+        self.apply_configuration()
 
-        # 1.Make a Json string
-        # 2.Make a Json object
-        json_data = json.dumps(data, default=lambda o: o.__dict__, indent=2)
-        json_data = json.loads(json_data)
+        self.save_state()
 
-        with open(file_name, 'w', encoding='utf-8') as file:
-            json.dump(json_data, file, ensure_ascii=False, indent=2)
-            file.close()
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Log Compaction -------------------------------------------------------------------------------------------- """
+
+    def take_snapshot(self):
+        """ Starts saving the state machine as it is after applying the last applied entry. The snapshot is
+        written SNAPSHOT_STEP_SIZE bytes at a time (see write_snapshot), so the node goes on handling messages
+        and applying entries meanwhile, and once it is complete every log entry up to that point is discarded.
+        The snapshot is a json line with the last included entry, the sessions and the configuration, followed
+        by a json line for each chunk of the state machine (see StateMachine.snapshot). """
+
+        last_term = self.log_term(self.last_applied)
+        configuration = self.configuration_at(self.last_applied)
+        header = {'last_index': self.last_applied,
+                  'last_term': last_term,
+                  'sessions': self.sessions.to_list(),
+                  'configuration': configuration.to_value()}
+
+        writer = self.storage.begin_snapshot()
+        writer.write(json.dumps(header).encode("ascii") + b"\n")
+        self.snapshot_writing = SnapshotWriting(writer, self.state_machine.snapshot(), self.last_applied, last_term,
+                                                configuration)
+        self.applied_size = 0
+        self.snapshot_timeout = self.clock.time()
+
+    def snapshot_timeout_due(self):
+        """ It's time to write the next part of the snapshot. """
+        if self.snapshot_timeout and (self.clock.time() >= self.snapshot_timeout):
+            self.snapshot_timeout = None
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """ Writes the next chunks of the snapshot being taken, and completes it after the last one. """
+
+        snapshot = self.snapshot_writing
+        writer = snapshot.writer
+        step_end = writer.size + SNAPSHOT_STEP_SIZE
+
+        # The json is ascii (non ascii characters are escaped), so the chunks sent can be cut at any byte
+        with self.metrics.timer("snapshot.step_duration"):
+            for chunk in snapshot.chunks:
+                writer.write(json.dumps(chunk).encode("ascii") + b"\n")
+                if writer.size >= step_end:
+                    self.snapshot_timeout = self.clock.time()
+                    return
+
+        self.snapshot_writing = None
+        self.storage.save_snapshot(writer, snapshot.last_index)
+
+        self.snapshot_index = snapshot.last_index
+        self.snapshot_term = snapshot.last_term
+        self.compact_configurations(self.snapshot_index, snapshot.configuration)
+
+        self.tracer.record(INFO, SNAPSHOT_TAKEN, self.snapshot_index, self.snapshot_term)
+
+    def cancel_snapshot(self):
+        """ Abandons the snapshot being taken (a newer one was received from the leader). """
+        if self.snapshot_writing:
+            self.snapshot_writing.writer.discard()
+            self.snapshot_writing = None
+            self.snapshot_timeout = None
+
+    def restore_snapshot(self, lines):
+        """ Replaces the state machine with the content of a stored snapshot (the lines of its file). """
+
+        header = json.loads(next(lines))
+        self.snapshot_index = header['last_index']
+        self.snapshot_term = header['last_term']
+        self.state_machine.restore(json.loads(line) for line in lines)
+        self.sessions = SessionTable.from_list(header['sessions'])
+        configuration = Configuration.from_value(header['configuration'])
+        self.compact_configurations(self.snapshot_index, configuration)
+
+        self.commit_index = max(self.commit_index, self.snapshot_index)
+        self.last_applied = self.snapshot_index
+
+    def send_install_snapshot(self, replicator):
+        """ Sends the next chunk of the snapshot to a follower whose next log entry has already been discarded
+        by the leader. The chunk is read from the stored snapshot, and is large enough to go over TCP. """
+
+        # Without TCP, a chunk must fit in a datagram (the json wire format escapes the quotes of the snapshot)
+        chunk_size = SNAPSHOT_CHUNK_SIZE if STREAM_THRESHOLD else min(SNAPSHOT_CHUNK_SIZE, MAX_DATAGRAM_SIZE // 4)
+        offset = replicator.snapshot_offset
+        data = self.storage.read_snapshot(offset, chunk_size)
+
+        message = Message('InstallSnapshot',
+                          from_address=self.address,
+                          to_address=replicator.node.address,
+                          leader_address=self.address,
+                          from_id=self.node_id,
+                          term=self.current_term,
+                          last_included_index=self.snapshot_index,
+                          last_included_term=self.snapshot_term,
+                          offset=offset,
+                          data=data.decode("ascii"),
+                          done=(offset + len(data) >= self.storage.snapshot_size))
+        # Send message...
+        self.send(message)
 
-    def update_state(self):
-        """ updates the current node status
-        with information obtained from a json configuration file. """
+    def receive_install_snapshot(self, req):
+        """ Receives a chunk of the snapshot from the leader.
+        Chunks are written in order, once the last one arrives the snapshot replaces the state machine.
+        If the follower already has the last entry included in the snapshot, the entries that follow it are kept,
+        otherwise the whole log is discarded. """
 
-        file_name = "configs/server-{0}.json".format(self.node_id)
+        # Request: [term, last_included_index, last_included_term, offset, data, done]
 
-        with open(file_name, "r") as file:
-            data = json.loads(file.read())
+        match_index = 0
 
-            self.current_term = int(data['term'])
-            self.voted_for = data['voted_for']
-            self.dictionary_data = data['dict_data']
+        # Server's current term is out of date
+        if self.current_term < req.term:
+            self.step_down(req.term)
 
-            if data['logs']:
-                for log in data['logs']:
-                    cmd = Command(**log['command'])
-                    self.logs.append(Log(cmd, log['term']))
+        if self.current_term == req.term:
+            self.state = 'FOLLOWER'
+            self.leader_address = tuple(req.from_address)
+            self.leader_contact = self.clock.time()
+            self.pre_votes = None
+
+            # Election timeout is updated
+            self.election_timeout = random_timeout(self.clock)
+
+            with self.lock_log:
+
+                # Create a new snapshot file if first chunk
+                if req.offset == 0:
+                    if self.incoming_snapshot:
+                        self.incoming_snapshot[1].discard()
+                    self.incoming_snapshot = [req.last_included_index, self.storage.begin_snapshot(incoming=True)]
+
+                snapshot = self.incoming_snapshot
+                if snapshot and snapshot[0] == req.last_included_index and snapshot[1].size == req.offset:
+                    snapshot[1].write(req.data.encode("ascii"))
+
+                    if req.done:
+                        self.incoming_snapshot = None
+                        match_index = req.last_included_index
+
+                        if req.last_included_index > self.last_applied:
+                            self.install_snapshot(snapshot[1], req.last_included_index, req.last_included_term)
+                        else:
+                            snapshot[1].discard()
+
+        # ----------------------------------------
+        # Send a reply for 'InstallSnapshot' request
+        # Arguments:
+        req.from_id = self.node_id
+        req.term = self.current_term
+        # The leader starts again from the beginning if this is not the snapshot being received
+        snapshot = self.incoming_snapshot
+        req.offset = snapshot[1].size if snapshot and snapshot[0] == req.last_included_index else 0
+        req.data = None
+        req.match_index = match_index
+
+        # Send message...
+        self.reply(req)
+
+    def install_snapshot(self, writer, last_index, last_term):
+        """ Replaces the follower's state with a snapshot received from the leader (written by the writer). """
+
+        # The snapshot being taken is older
+        self.cancel_snapshot()
+
+        # Retain the log entries following the snapshot, if the logs agree on the last included entry
+        if self.log_term(last_index) != last_term:
+            self.storage.truncate(min(self.storage.last_index, last_index))
+            self.durable_index = min(self.durable_index, self.storage.last_index)
+            self.discard_configurations(self.storage.last_index)
+
+        self.storage.save_snapshot(writer, last_index)
+        self.restore_snapshot(self.storage.load_snapshot())
+        self.applied_size = 0
+        self.pending_requests = {self.request_key(log.command) for log in self.storage.scan(last_index + 1)}
+
+    def receive_install_snapshot_reply(self, req):
+        """ The leader receives a response to the InstallSnapshot RPC previously sent,
+        and continues with the next chunk or, once the follower has installed it, with the log entries. """
+
+        # Request: [term, last_included_index, offset, match_index]
+
+        # Server's current term is out of date
+        if self.current_term < req.term:
+            self.step_down(req.term)
+
+        # Replies from servers removed from the cluster are ignored
+        if self.state == "LEADER" and self.current_term == req.term and req.from_id in self.replicators:
+
+            with self.lock_log:
+
+                replicator = self.replicators[req.from_id]
+                replicator.last_contact = self.clock.time()
 
-            file.close()
+                if req.last_included_index != self.snapshot_index:
+                    # A newer snapshot was taken meanwhile, starts sending it from the beginning
+                    replicator.snapshot_offset = 0
+
+                elif req.match_index:
+                    # The follower installed the snapshot
+                    replicator.snapshot_offset = 0
+                    replicator.acknowledged(req.match_index)
+                    self.advance_commit_index()
+                    self.apply_log_commands()
+                    self.check_catch_up()
+                    self.check_transfer()
+
+                else:
+                    replicator.snapshot_offset = req.offset
+
+                # Continues right away instead of waiting for the next heartbeat
+                self.replicate(replicator, heartbeat=True)
 
     """ ----------------------------------------------------------------------------------------------------------- """
     """ Leader Election ------------------------------------------------------------------------------------------- """
@@ -173,72 +698,116 @@ class Node(object):
     def election_timeout_due(self):
         """ If a follower receives no communication over a period of time called the election timeout,
         then it assumes there is no viable leader and begins an election to choose a new leader. """
-        if self.election_timeout and (time.time() >= self.election_timeout):
-            print("\n>>> Election Timeout <<<")
+        if self.election_timeout and (self.clock.time() >= self.election_timeout):
+
+            # Learners, and servers that are no longer in the cluster, never start an election
+            if not self.configuration.is_voter(self.node_id):
+                self.election_timeout = None
+                return
+
+            self.tracer.record(INFO, ELECTION_TIMEOUT, self.current_term)
+            if PRE_VOTE:
+                self.start_pre_vote()
+            else:
+                self.start_election()
+
+    # With PRE_VOTE, an election begins with a PreVote: the server asks the voters whether they would vote for it
+    # in the next term, without changing its own term (nor theirs). Only if a majority would, it starts the election.
+    # A server that cannot reach a majority (cut off from the others, or with an outdated log) keeps its term, so when
+    # it comes back its messages do not force the leader to step down. The voters also refuse the PreVotes while they
+    # hear from a leader (within the minimum election timeout since its last message).
+
+    # With CHECK_QUORUM, a leader that has not heard from a majority of the voters for the maximum election timeout
+    # steps down: the others may have elected another leader by then, and its clients had better look for it.
+
+    def start_pre_vote(self):
+        """ Asks the other voters whether they would vote for this server in the next term. """
+
+        self.metrics.increment("elections.pre_votes")
+        self.pre_votes = {self.node_id}
+        self.send_request_vote(pre_vote=True)
+
+        # The PreVote is started again after another timeout if it does not succeed
+        self.election_timeout = random_timeout(self.clock)
+
+        if len(self.pre_votes) >= self.quorum_size:
             self.start_election()
 
-    def start_election(self):
+    def start_election(self, transfer=False):
         """ Invoked by candidates to gather votes.
         To begin an election, a follower increments its current term and transitions to candidate state.
         It then votes for itself and issues RequestVote RPCs in parallel
-        to each of the other servers in the cluster. """
+        to each of the other servers in the cluster (transfer is True if the leader asked for it, see TimeoutNow). """
 
         # The node increments its current term
         # and transitions to candidate state
         self.state = "CANDIDATE"
         self.current_term += 1
+        self.leader_address = None
+        self.metrics.increment("elections.started")
 
         # Votes for itself
         self.votes = set()
         self.votes.add(self.node_id)
         self.voted_for = self.node_id
+        self.pre_votes = None
+        self.save_state()
 
         # Send RequestVote
-        self.send_request_vote()
+        self.send_request_vote(transfer=transfer)
 
         # Election timeout is updated
-        self.election_timeout = random_timeout()
+        self.election_timeout = random_timeout(self.clock)
 
-    def send_request_vote(self):
-        """ Issues RequestVote RPCs to each of the other servers in the cluster. """
+    def send_request_vote(self, pre_vote=False, transfer=False):
+        """ Issues RequestVote RPCs to each of the other voters of the cluster
+        (PreVotes for the next term, if pre_vote is True). """
 
-        last_log_index = len(self.logs)  # Index of candidate’s last log entry
+        last_log_index = self.last_log_index()  # Index of candidate’s last log entry
         last_log_term = self.log_term(last_log_index)  # Term of candidate’s last log entry
+        term = self.current_term + 1 if pre_vote else self.current_term
 
-        print("\nSending RequestVote")
+        self.tracer.record(INFO, PRE_VOTE_STARTED if pre_vote else ELECTION_STARTED, term, last_log_index)
         for node in self.node_list:
+            if not self.configuration.is_voter(node.node_id):
+                continue
             message = Message('RequestVote', from_address=self.address, to_address=node.address, from_id=self.node_id,
-                              term=self.current_term, last_log_index=last_log_index, last_log_term=last_log_term)
+                              term=term, last_log_index=last_log_index, last_log_term=last_log_term,
+                              pre_vote=pre_vote or None, transfer=transfer or None)
             # Send message...
-            message.send(self.socket)
+            self.send(message)
 
     def receive_request_vote(self, req):
         """ Receives a RequestVote RPC from a candidate server.
         Each server will vote for at most one candidate in a given term, on a first-come-first-served basis,
-        and it will deny its vote if its own log is more up-to-date than that of the candidate. """
+        and it will deny its vote if its own log is more up-to-date than that of the candidate.
+        While it hears from the leader, the server ignores the request altogether (neither its term nor its vote
+        change), unless the leader itself asked for the election to transfer its leadership: the lease of the
+        leader relies on it (see Linearizable Reads). """
+
+        # Request: [from_id, term, last_log_index, last_log_term, pre_vote, transfer]
 
-        # Request: [from_id, term, last_log_index, last_log_term]
+        if req.pre_vote:
+            self.receive_pre_vote(req)
+            return
 
         granted = False  # True means candidate received vote
+        ignored = not req.transfer and self.leader_in_contact()
 
         # Server's current term is out of date
-        if self.current_term < req.term:
+        if self.current_term < req.term and not ignored:
             self.step_down(req.term)
 
-        if (self.voted_for in [None, req.from_id]) and (self.current_term == req.term):
-
-            # The voter denies its vote if its own log is more up-to-date than that of the candidate:
-            # If the logs have last entries with different terms, then the log with the later term is more up-to-date.
-            # If the logs end with the same term, then whichever log is longer is more up-to-date
-            last_log_index = len(self.logs)
-            last_log_term = self.log_term(last_log_index)
+        if (self.voted_for in [None, req.from_id]) and (self.current_term == req.term) and not ignored:
 
-            if (last_log_term < req.last_log_term) or (last_log_term == req.last_log_term and last_log_index <= req.last_log_index):
+            # The voter denies its vote if its own log is more up-to-date than that of the candidate
+            if self.candidate_up_to_date(req):
                 granted = True
                 self.voted_for = req.from_id
+                self.save_state()
 
                 # Election timeout is updated
-                self.election_timeout = random_timeout()
+                self.election_timeout = random_timeout(self.clock)
 
         # --------------------------------------
         # Send a reply for 'RequestVote' request
@@ -248,15 +817,53 @@ class Node(object):
         req.granted = granted
 
         # Send message...
-        print(" -> Reply To:", req.from_address, end="\n\n")
-        req.reply(self.socket)
+        self.reply(req)
+
+    def candidate_up_to_date(self, req):
+        """ Returns True if the log of the candidate is at least as up-to-date as this one:
+        If the logs have last entries with different terms, then the log with the later term is more up-to-date.
+        If the logs end with the same term, then whichever log is longer is more up-to-date. """
+
+        last_log_index = self.last_log_index()
+        last_log_term = self.log_term(last_log_index)
+
+        return (last_log_term < req.last_log_term) or (last_log_term == req.last_log_term and
+                                                       last_log_index <= req.last_log_index)
+
+    def leader_in_contact(self):
+        """ Returns True if this server is the leader, or has heard from it within the minimum election timeout:
+        it does not want a new election. """
+        return self.state == "LEADER" or (self.leader_contact is not None and
+                                          self.clock.time() < self.leader_contact + ELECTION_INTERVAL[0])
+
+    def receive_pre_vote(self, req):
+        """ Receives a PreVote, for the term that the candidate would have (req.term).
+        It is granted as a vote in that term would be, but neither the term nor the vote of this server change.
+        A granted reply carries the term of the PreVote, so that the candidate can tell it from older ones. """
+
+        # The leader, and the followers that hear from it, do not want a new election
+        granted = self.current_term < req.term and not self.leader_in_contact() and self.candidate_up_to_date(req)
+
+        # --------------------------------------
+        # Send a reply for the PreVote
+        # Arguments:
+        req.from_id = self.node_id
+        req.term = req.term if granted else self.current_term
+        req.granted = granted
+
+        # Send message...
+        self.reply(req)
 
     def receive_request_vote_reply(self, req):
         """ Receives a response to the RequestVote RPC previously sent.
         A candidate wins an election if it receives votes from a majority
         of the servers in the full cluster for the same term"""
 
-        # Request: [from_id, from_term, granted]
+        # Request: [from_id, from_term, granted, pre_vote]
+
+        if req.pre_vote:
+            self.receive_pre_vote_reply(req)
+            return
 
         # Server's current term is out of date
         if self.current_term < req.term:
@@ -264,8 +871,8 @@ class Node(object):
 
         if self.state == "CANDIDATE" and self.current_term == req.term:
 
-            # The vote is true and it has not yet voted for me
-            if req.granted and req.from_id not in self.votes:
+            # The vote is true, it has not yet voted for me, and it is a voter of the configuration
+            if req.granted and req.from_id not in self.votes and self.configuration.is_voter(req.from_id):
 
                 self.votes.add(req.from_id)
 
@@ -273,21 +880,45 @@ class Node(object):
                 if len(self.votes) >= self.quorum_size:
                     self.become_leader()
 
+    def receive_pre_vote_reply(self, req):
+        """ Receives a response to a PreVote. Once a majority would vote for it, the server starts the election. """
+
+        if req.granted:
+            if (self.pre_votes is not None and req.term == self.current_term + 1
+                    and self.configuration.is_voter(req.from_id)):
+                self.pre_votes.add(req.from_id)
+
+                if len(self.pre_votes) >= self.quorum_size:
+                    self.start_election()
+
+        # Server's current term is out of date
+        elif self.current_term < req.term:
+            self.step_down(req.term)
+
     def become_leader(self):
         """ Once a candidate wins an election, it becomes leader.
         It then sends heartbeat messages to all of the other servers
         to establish its authority and prevent new elections. """
 
-        print("\n<<< I AM THE LEADER >>>")
+        self.tracer.record(INFO, BECAME_LEADER, self.current_term, self.last_log_index())
         self.state = "LEADER"
+        self.metrics.increment("elections.won")
         self.leader_address = self.address
 
         # It initializes all next_index values to the index just after the last one in its log
-        self.next_index = {node.node_id: (len(self.logs) + 1) for node in self.node_list}
+        self.replicators = {node.node_id: Replicator(node, self.last_log_index() + 1, self.clock)
+                            for node in self.node_list}
+
+        self.catch_up = None
+        self.pre_votes = None
 
         # Stops waiting for election timeout
         self.election_timeout = None
 
+        # An empty entry of its own term lets the leader find out which entries are committed,
+        # which it needs to know before serving any read
+        self.storage.append([Log(Command(None, None, "NOOP", None), self.current_term)])
+
         # Begins to send heartbeats
         self.start_heartbeat()
 
@@ -321,63 +952,148 @@ class Node(object):
     #   • If successful: update nextIndex and matchIndex for follower
     #   • If AppendEntries fails because of log inconsistency: decrement nextIndex and retry
 
-    def heartbeat_timeout_due(self):
+    # Entries are sent in bounded batches, and several batches can be in flight for each follower
+    # (see Replicator). nextIndex points after the batches in flight, and goes back to the
+    # rejected point when a follower refuses one of them.
+
+    def heartbeat_timeout_due(self, slack=0):
         """ It's time to send a heartbeat """
         if self.state == "LEADER":
-            if self.heartbeat_timeout and (time.time() >= self.heartbeat_timeout):
-                self.start_heartbeat()
+            if self.heartbeat_timeout and (self.clock.time() + slack >= self.heartbeat_timeout):
+                if CHECK_QUORUM:
+                    self.check_quorum()
+
+                if self.state == "LEADER":
+                    self.start_heartbeat()
+
+                # A transfer that takes too long is given up on
+                self.check_transfer()
+
+    def check_quorum(self):
+        """ The leader steps down if it has not heard from a majority of the voters
+        (itself included) within the maximum election timeout. """
+
+        now = self.clock.time()
+        contacts = sum(1 for node_id, replicator in self.replicators.items()
+                       if self.configuration.is_voter(node_id) and now - replicator.last_contact < ELECTION_INTERVAL[1])
+        if self.configuration.is_voter(self.node_id):
+            contacts += 1
+
+        if contacts < self.quorum_size:
+            self.tracer.record(WARNING, QUORUM_LOST, self.current_term, contacts)
+            self.metrics.increment("elections.quorum_lost")
+            self.step_down(self.current_term)
 
     def start_heartbeat(self):
-        """ Sends AppendEntries RPCs to each of the other servers in the cluster. """
+        """ Sends AppendEntries RPCs to each of the other servers in the cluster.
+        Every follower receives at least one message, even if its window is full, to keep its election timeout. """
 
         with self.lock_log:
 
-            print("\nSending AppendEntries\n")
-            self.save_state()
+            self.tracer.record(DEBUG, HEARTBEAT, self.current_term, self.heartbeat_round + 1, self.commit_index)
 
-            for node in self.node_list:
-                self.send_append_entries(node)
+            # Every heartbeat starts a new round, whose replies confirm the leadership
+            self.heartbeat_round += 1
+            self.round_times[self.heartbeat_round] = self.clock.time()
 
-        self.heartbeat_timeout = time.time() + HEARTBEAT_TIMEOUT
+            for replicator in self.replicators.values():
+                replicator.expire()
+                self.replicate(replicator, heartbeat=True)
 
-    def send_append_entries(self, node):
-        """ AppendEntries RPCs are initiated by leaders
-        to replicate log entries and to provide a form of heartbeat. """
+            self.store_sent_entries()
 
-        # The leader maintains a nextIndex for each follower, which is the index
-        # of the next log entry the leader will send to that follower
-        prev_index = self.next_index[node.node_id] - 1  # Index of log entry immediately preceding new ones
-        prev_term = self.log_term(prev_index)  # Term of prevLogIndex entry (from the leader)
+            self.round_confirmed()
 
-        # If last log index ≥ nextIndex for a follower:
-        # send AppendEntries RPC with log entries starting at nextIndex
-        if len(self.logs) >= self.next_index[node.node_id]:
-            begin_entries = (self.next_index[node.node_id] - 1)
-            entries = []
-            for log in self.logs[begin_entries:]:
-                cmd = log.command
-                cmd_entry = Command(cmd.client_address, cmd.serial, cmd.action, cmd.position, cmd.new_value)
-                log_entry = Log(cmd_entry, log.term)
-                entries.append(log_entry)
-        else:
-            entries = []
+            # A server being added that does not make progress is given up on
+            self.check_catch_up()
+
+        self.heartbeat_timeout = self.clock.time() + HEARTBEAT_TIMEOUT
+
+    def start_replication(self):
+        """ Sends the new log entries to the followers that have room in their window, without waiting for
+        the next heartbeat, and stores them meanwhile (see store_sent_entries). """
 
-        commit_index = self.commit_index
+        with self.lock_log:
+            for replicator in self.replicators.values():
+                self.replicate(replicator)
+
+            self.store_sent_entries()
+
+    def store_sent_entries(self):
+        """ Writes the batches just sent to the wire and then the leader's entries to its disk, so the followers
+        receive them meanwhile: the leader does not need its own entries on disk to send them, only to count itself
+        for their majority. The transports would otherwise hold the frames (TCP) until the event is handled, after
+        the write. With deferred_sync, the owner of the node does both (see RaftHost.flush). """
+
+        if not self.deferred_sync:
+            self.transport.flush()
+        self.save_state()
+        self.log_synced()
+
+    def replicate(self, replicator, heartbeat=False):
+        """ Sends the follower as many batches of entries as its window allows.
+        If there is nothing to send and it is a heartbeat, an AppendEntries without entries is sent. """
+
+        # The entry to send has already been discarded, the follower is sent the snapshot instead
+        if replicator.next_index <= self.snapshot_index:
+            if heartbeat:
+                self.send_install_snapshot(replicator)
+            return
+
+        sent = False
+        while replicator.can_send() and self.last_log_index() >= replicator.next_index:
+            prev_index = replicator.next_index - 1
+            entries = self.next_batch(replicator.next_index)
+            self.send_append_entries(replicator, prev_index, entries)
+            replicator.sent(prev_index, prev_index + len(entries))
+            sent = True
+
+        if heartbeat and not sent:
+            # With batches in flight, the heartbeat refers to the last entry known to match
+            prev_index = replicator.match_index if replicator.inflight else replicator.next_index - 1
+            self.send_append_entries(replicator, prev_index, [])
+
+    def next_batch(self, begin_index):
+        """ Returns the entries to send starting at the given index, no more than
+        MAX_BATCH_ENTRIES entries and MAX_BATCH_BYTES bytes (at least one entry is always sent). """
+
+        entries = []
+        size = 0
+        for log in self.storage.entries(begin_index, begin_index + MAX_BATCH_ENTRIES):
+            if log.size is None:
+                log.size = codec.entry_size(log)
+
+            size += log.size
+            if entries and size > MAX_BATCH_BYTES:
+                break
+
+            entries.append(log)  # Only the fields sent are read from the stored entry, it is not copied
+
+        return entries
+
+    def send_append_entries(self, replicator, prev_index, entries):
+        """ AppendEntries RPCs are initiated by leaders
+        to replicate log entries and to provide a form of heartbeat. """
 
-        # ------------------------------------------------------------------------------------------------------------
+        prev_term = self.log_term(prev_index)  # Term of prevLogIndex entry (from the leader)
 
         message = Message('AppendEntries',
                           from_address=self.address,
-                          to_address=node.address,
+                          to_address=replicator.node.address,
                           leader_address=self.address,
                           from_id=self.node_id,
                           term=self.current_term,
                           prev_index=prev_index,
                           prev_term=prev_term,
                           entries=entries,
-                          commit_index=commit_index)
+                          commit_index=self.commit_index,
+                          round=self.heartbeat_round)
         # Send message...
-        message.send(self.socket)
+        size = self.send(message)
+
+        if entries:
+            self.metrics.record("append_entries.entries", len(entries))
+            self.metrics.record("append_entries.bytes", size)
 
     def receive_append_entries(self, req):
         """ Receives a AppendEntries RPC from the leader. """
@@ -393,6 +1109,8 @@ class Node(object):
 
         success = False  # True if follower contained entry matching prevLogIndex and prevLogTerm
         match_index = 0
+        conflict_term = None  # Term of the follower's entry at prevLogIndex, when it does not match
+        conflict_index = None  # First index of conflict_term (or next index of the log, if it is too short)
 
         # Server's current term is out of date
         if self.current_term < req.term:
@@ -401,14 +1119,22 @@ class Node(object):
         if self.current_term == req.term:
             self.state = 'FOLLOWER'
             self.leader_address = tuple(req.from_address)
+            self.leader_contact = self.clock.time()
+            self.pre_votes = None
 
             # Election timeout is updated
-            self.election_timeout = random_timeout()
+            self.election_timeout = random_timeout(self.clock)
+
+            # Entries already included in the snapshot are committed, so they match the leader's ones
+            if req.prev_index < self.snapshot_index:
+                req.entries = req.entries[self.snapshot_index - req.prev_index:]
+                req.prev_index = self.snapshot_index
+                req.prev_term = self.snapshot_term
 
             prev_term = self.log_term(req.prev_index)
 
             # Log contains an entry at prevLogIndex whose term matches prevLogTerm
-            if req.prev_index == 0 or (req.prev_index <= len(self.logs) and prev_term == req.prev_term):
+            if req.prev_index == 0 or (req.prev_index <= self.last_log_index() and prev_term == req.prev_term):
                 success = True
 
                 index = req.prev_index
@@ -418,12 +1144,20 @@ class Node(object):
                     if self.log_term(index + 1) != req.entries[i].term:
 
                         # Delete the existing entry and all that follow it
-                        while len(self.logs) > index:
-                            self.revert_command(self.logs[-1].command)
-                            self.logs.pop()
+                        for log in self.storage.entries(index + 1, self.last_log_index() + 1):
+                            self.pending_requests.discard(self.request_key(log.command))
+                        self.storage.truncate(index)
+                        self.durable_index = min(self.durable_index, index)
+                        self.discard_configurations(index)
 
-                        # Append any new entries not already in the log
-                        self.logs.append(req.entries[i])
+                        # Append any new entries not already in the log (every entry that follows is new)
+                        new_entries = req.entries[i:]
+                        self.storage.append(new_entries)
+                        self.pending_requests.update(self.request_key(log.command) for log in new_entries)
+                        self.track_configurations(index + 1, new_entries)
+
+                        index += len(new_entries)
+                        break
 
                     index += 1
 
@@ -431,12 +1165,20 @@ class Node(object):
 
                 # If leaderCommit > commitIndex, set commitIndex = min(leaderCommit, index of last new entry)
                 if req.commit_index > self.commit_index:
-                    self.commit_index = min(req.commit_index, len(self.logs))
+                    self.commit_index = min(req.commit_index, index)
 
                 # Execute ready commands
                 self.apply_log_commands()
 
-                self.save_state()
+            # Hints for the leader to skip the whole conflicting term at once
+            elif req.prev_index > self.last_log_index():
+                conflict_index = self.last_log_index() + 1
+            else:
+                conflict_term = prev_term
+                conflict_index = self.first_index_of_term(req.prev_index)
+
+        # New entries (and a newer term) are stored before replying
+        self.save_state()
 
         # ----------------------------------------
         # Send a reply for 'AppendEntries' request
@@ -445,30 +1187,39 @@ class Node(object):
         req.term = self.current_term
         req.success = success
         req.match_index = match_index
+        req.conflict_term = conflict_term
+        req.conflict_index = conflict_index
 
         # Send message...
-        print(" -> Reply To:", req.from_address, end="\n\n")
-        req.reply(self.socket)
+        self.reply(req)
 
     def receive_append_entries_reply(self, req):
         """ The leader receives a response to the AppendEntries RPC previously sent. """
 
-        # Request: [term, success, match_index]
+        # Request: [term, prev_index, success, match_index, conflict_term, conflict_index]
 
         # Server's current term is out of date
         if self.current_term < req.term:
             self.step_down(req.term)
 
-        if self.state == "LEADER" and self.current_term == req.term:
+        # Replies from servers removed from the cluster are ignored
+        if self.state == "LEADER" and self.current_term == req.term and req.from_id in self.replicators:
 
             with self.lock_log:
 
+                replicator = self.replicators[req.from_id]
+                replicator.last_contact = self.clock.time()
+
+                # The follower recognized this leader when the round was sent
+                if req.round and req.round > replicator.acked_round:
+                    replicator.acked_round = req.round
+                    self.round_confirmed()
+
                 # The leader and follower logs match
                 if req.success:
 
                     # Update nextIndex and matchIndex for follower
-                    self.match_index[req.from_id] = req.match_index
-                    self.next_index[req.from_id] = req.match_index + 1
+                    replicator.acknowledged(req.match_index)
 
                     # Commit all safe log entries
                     self.advance_commit_index()
@@ -477,21 +1228,27 @@ class Node(object):
                     # Responds to client requests
                     self.apply_log_commands()
 
+                    # A server being added, or the target of a transfer, may have caught up
+                    self.check_catch_up()
+                    self.check_transfer()
+
                 else:
-                    # Follower’s log is inconsistent with the leader’s,
-                    # decrements next_index and retries the AppendEntries RPC
-                    self.next_index[req.from_id] = max(1, self.next_index[req.from_id] - 1)
+                    # Follower’s log is inconsistent with the leader’s, next_index skips back a whole term:
+                    # after the leader's last entry of the conflicting term if it has one,
+                    # or else to the first index of that term in the follower's log
+                    next_index = req.conflict_index or req.prev_index
+                    if req.conflict_term:
+                        next_index = (self.last_index_of_term(req.conflict_term) or (next_index - 1)) + 1
+
+                    # The AppendEntries RPC is retried right away
+                    replicator.rejected(req.prev_index, next_index)
+
+                # Fills the window again
+                self.replicate(replicator)
 
     """ ----------------------------------------------------------------------------------------------------------- """
     """ Client Interaction ---------------------------------------------------------------------------------------- """
 
-    def get_log_by_serial(self, serial):
-        """ Returns the log that contains this serial number. """
-        for log in self.logs:
-            if log.command.serial == serial:
-                return log
-        return None
-
     def receive_client_request(self, request):
         """ Receives a request from a client.
         The leader accepts log entries from clients, replicates them on other servers,
@@ -499,7 +1256,8 @@ class Node(object):
         • If the server is not the leader, it rejects the client’s request
         and supply information about the most recent leader it has heard.
         • If it receives a command whose serial number has already been executed,
-        it responds immediately without re-executing the request.
+        it responds immediately without re-executing the request (with the response kept in the client's session).
+        If the command is in the log but not executed yet, the response is sent once it is.
         • Read-only operations can be handled without writing anything into the log. """
 
         cmd = request.command
@@ -508,33 +1266,617 @@ class Node(object):
 
             with self.lock_request:
 
-                if cmd.action == "GET":
-                    # Reply with dictionary content
-                    self.start_heartbeat()
-                    time.sleep(SERVER_TIMEOUT/3)
-    
+                if cmd.action in self.state_machine.read_actions:
+                    # Reply with the state machine content, once it is safe (see receive_read)
+                    self.receive_read(request)
+
+                elif cmd.action in ("ADD_SERVER", "ADD_LEARNER", "REMOVE_SERVER"):
+                    # Goes through the log as a change of configuration (see Membership Changes)
+                    self.receive_membership_change(request)
+
+                elif cmd.action == "TRANSFER_LEADER":
+                    # Hands the leadership over to another voter (see Leadership Transfer)
+                    self.receive_leadership_transfer(request)
+
+                elif cmd.action in ("CONFIG", "NOOP"):
+                    # Entries that only the servers append
                     request.from_id = self.node_id
-                    request.response = self.dictionary_data[cmd.position]
-                    request.reply(self.socket)
+                    request.response = "Invalid action: " + cmd.action
+                    self.reply(request)
+
                 else:
 
                     with self.lock_log:
 
                         # Check if the request has already been executed before
-                        log = self.get_log_by_serial(cmd.serial)
+                        response = self.sessions.response(cmd.client_address, cmd.serial)
+
+                        if response is not None:
+                            request.from_id = self.node_id
+                            request.response = response
+                            request.commit_index = self.sessions.last_index(cmd.client_address)
+                            self.reply(request)
+
+                        elif self.request_key(cmd) not in self.pending_requests:
+                            # The new command is appended to the log with the next batch,
+                            # and replied once it has been applied to the state machine
+                            self.pending_requests.add(self.request_key(cmd))
+                            self.pending_batch.append(cmd)
+
+                            # With nothing waiting to be committed there is no reason to wait for more commands
+                            if len(self.pending_batch) >= BATCH_SIZE or self.commit_index == self.last_log_index():
+                                self.append_batch()
+                            elif not self.batch_timeout:
+                                self.batch_timeout = self.clock.time() + BATCH_WINDOW
+        elif cmd.action in self.state_machine.read_actions and request.commit_index is not None:
+            # Reads that accept the state of a follower (see Follower Reads)
+            self.receive_follower_read(request)
 
-                        if log:
-                            if log.command.executed:
-                                request.from_id = self.node_id
-                                request.response = "Command already executed successfully!"
-                                request.reply(self.socket)
-                        else:
-                            # Append the new command to the log,
-                            # and reply once it has been applied to the state machine
-                            self.logs.append(Log(cmd, self.current_term))
-                            self.start_heartbeat()
         else:
             # Reply with the leader's address
             request.from_id = self.node_id
             request.leader_address = self.leader_address
-            request.reply(self.socket)
+            self.reply(request)
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Linearizable Reads ---------------------------------------------------------------------------------------- """
+
+    # A read must not return stale data, so the leader serves it only once (ReadIndex):
+    # 1. It records its current commit index as the read index.
+    # 2. It confirms that it is still the leader: a majority of the cluster answers a heartbeat round
+    #    that was sent after the read arrived. Reads that arrive together wait for the same round.
+    # 3. Its state machine has applied the entries up to the read index.
+    # With LEASE_READS, a confirmed round also gives the leader a lease (a bit shorter than the minimum
+    # election timeout, by the clock drift allowed), during which reads skip the second step.
+    # The lease relies on bounded clock drift between servers, and on the voters, which do not elect another leader
+    # while they hear from this one (see receive_request_vote). A leader that transfers its leadership gives
+    # its lease up, since the target does not wait for it to expire.
+
+    def receive_read(self, request):
+        """ Receives a read-only request from a client and queues it until it can be served. """
+
+        with self.lock_log:
+
+            if LEASE_READS and self.clock.time() < self.lease_expiration:
+                required_round = 0
+            else:
+                required_round = self.heartbeat_round + 1
+
+            # Until an entry of its own term is committed, the leader does not know the real commit index
+            read_index = self.commit_index if self.log_term(self.commit_index) == self.current_term else None
+
+            self.pending_reads.append(ReadRequest(request, read_index, required_round))
+
+            # Starts the confirmation round right away, unless one is already waiting for answers
+            # (the new reads will wait for the following one)
+            if required_round and self.confirmed_round() == self.heartbeat_round:
+                self.start_heartbeat()
+            else:
+                self.serve_reads()
+
+    def confirmed_round(self):
+        """ Returns the last heartbeat round answered by a majority of the cluster (including the leader). """
+        rounds = [replicator.acked_round for node_id, replicator in self.replicators.items()
+                  if self.configuration.is_voter(node_id)]
+        if self.configuration.is_voter(self.node_id):
+            rounds.append(self.heartbeat_round)
+        rounds.sort(reverse=True)
+        return rounds[self.quorum_size - 1]
+
+    def round_confirmed(self):
+        """ Updates the lease and serves the reads after a heartbeat round is acknowledged by a follower. """
+
+        confirmed = self.confirmed_round()
+
+        if confirmed in self.round_times and not self.transfer:
+            lease = self.round_times[confirmed] + ELECTION_INTERVAL[0] * (1 - CLOCK_DRIFT)
+            self.lease_expiration = max(self.lease_expiration, lease)
+
+        for heartbeat_round in [r for r in self.round_times if r <= confirmed]:
+            del self.round_times[heartbeat_round]
+
+        self.serve_reads()
+
+        # Reads that arrived during the confirmed round need another one
+        if self.state == "LEADER" and confirmed == self.heartbeat_round and \
+                any(read.round > confirmed for read in self.pending_reads):
+            self.start_heartbeat()
+
+    def serve_reads(self):
+        """ Replies to the reads that are confirmed and whose read index has been applied. """
+
+        confirmed = self.confirmed_round()
+        waiting = []
+
+        for read in self.pending_reads:
+            if read.index is None and self.log_term(self.commit_index) == self.current_term:
+                read.index = self.commit_index
+
+            if read.round <= confirmed and read.index is not None and read.index <= self.last_applied:
+                read.request.from_id = self.node_id
+                read.request.response = self.state_machine.query(read.request.command)
+                read.request.commit_index = self.last_applied
+                self.reply(read.request)
+            else:
+                waiting.append(read)
+
+        self.pending_reads = waiting
+
+    def reject_reads(self):
+        """ The server is no longer the leader, the clients are told to try again with the new one. """
+
+        for read in self.pending_reads:
+            read.request.from_id = self.node_id
+            read.request.leader_address = self.leader_address
+            self.reply(read.request)
+
+        self.pending_reads = []
+        self.round_times = {}
+        self.lease_expiration = 0
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Follower Reads -------------------------------------------------------------------------------------------- """
+
+    # Reads can also be served by followers and learners, when the client accepts a state that is not the latest:
+    # the request carries a minimum index (the highest index the client has seen in its replies, such as the one
+    # of its last write), and the server answers once it has applied that index. The client always sees its own
+    # writes and never goes back in time, but it may miss the latest writes of other clients.
+    # These reads do not go through the leader, so the read capacity grows with the number of replicas.
+
+    def receive_follower_read(self, request):
+        """ Receives a read with a minimum index and queues it until the state machine reaches that index. """
+
+        with self.lock_log:
+            self.follower_reads.append((self.clock.time(), request))
+            self.serve_follower_reads()
+
+    def serve_follower_reads(self):
+        """ Replies to the follower reads whose minimum index has been applied. The ones that have waited
+        longer than SERVER_TIMEOUT are dropped, the client has already sent them to another server. """
+
+        now = self.clock.time()
+        waiting = []
+
+        for arrival, request in self.follower_reads:
+            if request.commit_index <= self.last_applied:
+                request.from_id = self.node_id
+                request.response = self.state_machine.query(request.command)
+                request.commit_index = self.last_applied
+                self.reply(request)
+                self.metrics.increment("follower_reads")
+            elif now - arrival < SERVER_TIMEOUT:
+                waiting.append((arrival, request))
+
+        self.follower_reads = waiting
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Group Commit ---------------------------------------------------------------------------------------------- """
+
+    # Client commands are not appended to the log one by one: while earlier entries are still waiting to be
+    # committed, the leader collects them for BATCH_WINDOW seconds (or until BATCH_SIZE commands arrive),
+    # and then appends the whole batch, stores it on disk once and replicates it with a single AppendEntries
+    # per follower. A command that arrives when everything is committed is appended right away.
+
+    def batch_timeout_due(self):
+        """ It's time to append the collected commands. """
+        if self.batch_timeout and (self.clock.time() >= self.batch_timeout):
+            self.append_batch()
+
+    def append_batch(self):
+        """ Appends the collected client commands to the log and starts replicating them. """
+
+        self.batch_timeout = None
+
+        # During a leadership transfer the commands wait (see Leadership Transfer)
+        if self.state != "LEADER" or not self.pending_batch or self.transfer:
+            return
+
+        with self.lock_log:
+            now = self.clock.time()
+            for index in range(self.last_log_index() + 1, self.last_log_index() + len(self.pending_batch) + 1):
+                self.append_times[index] = now
+            self.storage.append([Log(cmd, self.current_term) for cmd in self.pending_batch])
+            self.metrics.record("group_commit.commands", len(self.pending_batch))
+            self.pending_batch = []
+
+            self.start_replication()
+
+    def discard_batch(self, leader_address=None):
+        """ The server is no longer the leader, the collected commands are dropped (the clients will retry).
+        If the next leader is known, the clients are told to send them there right away. """
+
+        for cmd in self.pending_batch:
+            self.pending_requests.discard(self.request_key(cmd))
+
+            if leader_address:
+                message = Message("ClientRequest", from_address=tuple(cmd.client_address), to_address=self.address)
+                message.from_id = self.node_id
+                message.command = Command(cmd.client_address, cmd.serial, cmd.action, cmd.position)
+                message.leader_address = leader_address
+                self.reply(message)
+
+        self.pending_batch = []
+        self.batch_timeout = None
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Membership Changes ---------------------------------------------------------------------------------------- """
+
+    # The members of the cluster change one server at a time, through CONFIG entries (see membership.py).
+    # Every server uses the latest configuration of its log, even if it is not committed yet, so a change
+    # discarded along with its entry is also undone. The leader starts a change only when the previous one is
+    # committed and an entry of its own term is committed, so two consecutive majorities always overlap.
+    # A new server is first added as a learner, and becomes a voter once it has caught up (see CatchUp).
+    # A leader that removes itself keeps leading until the change is committed (without counting itself
+    # for the majorities), and then steps down.
+
+    def apply_configuration(self):
+        """ Puts the latest configuration into effect: the servers to replicate to and the size of the majorities. """
+
+        index, configuration = self.configurations[-1]
+        if configuration is self.configuration:
+            return
+
+        self.configuration = configuration
+        self.node_list = [host for host in configuration.members() if host.node_id != self.node_id]
+        self.quorum_size = configuration.quorum_size()
+
+        # The leader replicates to the new members right away,
+        # and to the removed ones until the change is committed (see configuration_committed)
+        if self.state == "LEADER":
+            for node in self.node_list:
+                if node.node_id not in self.replicators:
+                    self.replicators[node.node_id] = Replicator(node, self.last_log_index() + 1, self.clock)
+
+        self.tracer.record(INFO, CONFIGURATION_CHANGED, index, len(configuration.voters), len(configuration.learners))
+
+    def configuration_at(self, index):
+        """ Returns the configuration in effect at the given index of the log. """
+        for config_index, configuration in reversed(self.configurations):
+            if config_index <= index:
+                return configuration
+        return self.configurations[0][1]
+
+    def track_configurations(self, first_index, entries):
+        """ Registers the configurations of the entries appended to the log from the given index. """
+
+        count = len(self.configurations)
+        for index, log in enumerate(entries, first_index):
+            if log.command.action == "CONFIG":
+                self.configurations.append((index, Configuration.from_value(log.command.new_value)))
+
+        if len(self.configurations) > count:
+            self.apply_configuration()
+
+    def discard_configurations(self, index):
+        """ The entries after the given index were removed from the log, and so are their configurations. """
+        if self.configurations[-1][0] > index:
+            self.configurations = [item for item in self.configurations if item[0] <= index]
+            self.apply_configuration()
+
+    def compact_configurations(self, index, configuration):
+        """ The entries up to the given index were replaced by a snapshot, which has the given configuration. """
+        self.configurations = [(index, configuration)] + [item for item in self.configurations if item[0] > index]
+        self.apply_configuration()
+
+    def receive_membership_change(self, request):
+        """ Receives a request to add a server (ADD_SERVER, position: node id, new value: address),
+        to add a learner that never votes (ADD_LEARNER, same arguments) or to remove a server or learner
+        (REMOVE_SERVER, position: node id). The client is answered once the new configuration is applied,
+        or right away if the change cannot be made. """
+
+        cmd = request.command
+        node_id = int(cmd.position)
+
+        with self.lock_log:
+
+            # The change is already in progress
+            if self.request_key(cmd) in self.pending_requests:
+                return
+
+            # Check if the request has already been executed before, or if it cannot be made
+            response = self.sessions.response(cmd.client_address, cmd.serial)
+            if response is None:
+                response = self.membership_error(cmd.action, node_id)
+
+            if response is not None:
+                request.from_id = self.node_id
+                request.response = response
+                request.commit_index = self.sessions.last_index(cmd.client_address)
+                self.reply(request)
+                return
+
+            self.pending_requests.add(self.request_key(cmd))
+
+            if cmd.action == "ADD_SERVER":
+                host = Host(node_id, cmd.new_value)
+
+                # A learner left behind by an abandoned change only has to catch up
+                if node_id not in self.configuration.learners:
+                    self.append_configuration(self.configuration.with_learner(host))
+
+                self.catch_up = CatchUp(request, host, self.last_log_index(), self.clock.time())
+
+            elif cmd.action == "ADD_LEARNER":
+                self.append_configuration(self.configuration.with_learner(Host(node_id, cmd.new_value)), cmd)
+
+            else:
+                self.append_configuration(self.configuration.without(node_id), cmd)
+
+    def membership_error(self, action, node_id):
+        """ Returns the reason why the given change cannot be made now, or None if it can. """
+
+        if self.catch_up or self.configurations[-1][0] > self.commit_index or \
+                self.log_term(self.commit_index) != self.current_term:
+            return "Another membership change is in progress, try again later"
+        if self.transfer:
+            return "A leadership transfer is in progress, try again later"
+        if action == "ADD_SERVER" and self.configuration.is_voter(node_id):
+            return "Server {0} is already a voter".format(node_id)
+        if action == "ADD_LEARNER" and self.configuration.is_member(node_id):
+            return "Server {0} is already a member".format(node_id)
+        if action == "REMOVE_SERVER" and not self.configuration.is_member(node_id):
+            return "Server {0} is not a member".format(node_id)
+        if action == "REMOVE_SERVER" and list(self.configuration.voters) == [node_id]:
+            return "The last voter cannot be removed"
+        return None
+
+    def append_configuration(self, configuration, command=None):
+        """ Appends a CONFIG entry with the given configuration, which is in effect right away, and replicates it.
+        The entry carries the client and serial of the command to answer once it is applied, if there is one. """
+
+        client_address, serial = (command.client_address, command.serial) if command else (None, None)
+        log = Log(Command(client_address, serial, "CONFIG", None, configuration.to_value()), self.current_term)
+
+        self.storage.append([log])
+        self.track_configurations(self.last_log_index(), [log])
+        self.start_replication()
+
+    def check_catch_up(self):
+        """ Follows the rounds of the server being added. When it ends a round in less than the minimum
+        election timeout, it becomes a voter. The change is abandoned (and the server stays as a learner)
+        after CATCH_UP_ROUNDS rounds, or if the server makes no progress for as long as they may take. """
+
+        catch_up = self.catch_up
+        if catch_up is None or self.state != "LEADER":
+            return
+
+        now = self.clock.time()
+        replicator = self.replicators[catch_up.host.node_id]
+
+        progress = (replicator.match_index, replicator.snapshot_offset)
+        if progress != catch_up.progress:
+            catch_up.progress = progress
+            catch_up.progress_time = now
+
+        if replicator.match_index >= catch_up.round_end:
+            if now - catch_up.round_start < ELECTION_INTERVAL[0]:
+                # Once the learner entry is committed, the learner becomes a voter
+                if self.configurations[-1][0] <= self.commit_index:
+                    self.catch_up = None
+                    self.append_configuration(self.configuration.with_voter(catch_up.host.node_id),
+                                              catch_up.request.command)
+                return
+
+            # The round was too slow, another one starts
+            catch_up.rounds += 1
+            catch_up.round_end = self.last_log_index()
+            catch_up.round_start = now
+
+        if catch_up.rounds > CATCH_UP_ROUNDS or now - catch_up.progress_time > CATCH_UP_ROUNDS * ELECTION_INTERVAL[1]:
+            self.cancel_catch_up("Server {0} could not catch up with the leader".format(catch_up.host.node_id))
+
+    def cancel_catch_up(self, response=None):
+        """ Abandons the addition of a server (it stays as a learner), answering the client if there is a response. """
+
+        catch_up = self.catch_up
+        if catch_up is None:
+            return
+
+        self.catch_up = None
+        self.pending_requests.discard(self.request_key(catch_up.request.command))
+
+        if response:
+            catch_up.request.from_id = self.node_id
+            catch_up.request.response = response
+            self.reply(catch_up.request)
+
+    def configuration_committed(self):
+        """ The latest configuration of the log has been applied: the leader stops replicating to the servers
+        that were removed, and steps down if it was removed itself. """
+
+        if self.state != "LEADER" or self.configurations[-1][0] > self.last_applied:
+            return
+
+        for node_id in [node_id for node_id in self.replicators if not self.configuration.is_member(node_id)]:
+            del self.replicators[node_id]
+
+        if not self.configuration.is_voter(self.node_id):
+            self.step_down(self.current_term)
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Leadership Transfer --------------------------------------------------------------------------------------- """
+
+    # The leadership can be handed over to another voter (TRANSFER_LEADER), before restarting the leader or to
+    # spread the leaders of several Raft groups over the servers, without waiting for an election timeout:
+    # 1. The leader stops appending client commands (they wait in the batch), and sends the target the entries
+    #    that it lacks.
+    # 2. Once the target has the whole log, the leader sends it a TimeoutNow message (again with every heartbeat,
+    #    until it steps down), and the target starts an election right away. It wins it, as its log is up-to-date.
+    # 3. The leader steps down when it sees the new term, and tells the clients of the commands that it held to send
+    #    them to the target.
+    # If the transfer takes longer than the maximum election timeout, it is abandoned, and the leader goes on
+    # appending the commands.
+
+    def receive_leadership_transfer(self, request):
+        """ Receives a request to transfer the leadership (TRANSFER_LEADER, position: node id of the target).
+        The client is answered once the leader steps down, or right away if the transfer cannot be made. """
+
+        cmd = request.command
+
+        with self.lock_log:
+
+            # The transfer is already in progress
+            if self.transfer and self.request_key(self.transfer.request.command) == self.request_key(cmd):
+                return
+
+            node_id = int(cmd.position)
+            response = self.transfer_error(node_id)
+            if response is not None:
+                request.from_id = self.node_id
+                request.response = response
+                self.reply(request)
+                return
+
+            replicator = self.replicators[node_id]
+            self.transfer = LeadershipTransfer(request, replicator.node, self.clock.time() + ELECTION_INTERVAL[1])
+            self.tracer.record(INFO, LEADERSHIP_TRANSFER, node_id, self.current_term, self.last_log_index())
+            self.metrics.increment("transfers.started")
+
+            # The target may be elected before the lease would expire
+            self.lease_expiration = 0
+
+            # The target gets the entries that it lacks (or is told to start the election) without waiting
+            self.replicate(replicator, heartbeat=True)
+            self.check_transfer()
+
+    def transfer_error(self, node_id):
+        """ Returns the reason why the leadership cannot be transferred to the given server, or None if it can. """
+
+        if node_id == self.node_id:
+            return "Server {0} is already the leader".format(node_id)
+        if self.transfer:
+            return "Another leadership transfer is in progress, try again later"
+        if not self.configuration.is_voter(node_id) or node_id not in self.replicators:
+            return "Server {0} is not a voter".format(node_id)
+        return None
+
+    def check_transfer(self):
+        """ Follows the transfer in progress: the target is told to start an election once it has
+        every entry of the log, and the transfer is abandoned if it takes too long. """
+
+        transfer = self.transfer
+        if transfer is None or self.state != "LEADER":
+            return
+
+        if self.clock.time() >= transfer.deadline or transfer.host.node_id not in self.replicators:
+            self.metrics.increment("transfers.abandoned")
+            self.cancel_transfer("Server {0} did not take over the leadership".format(transfer.host.node_id))
+            self.append_batch()
+            return
+
+        if self.replicators[transfer.host.node_id].match_index >= self.last_log_index():
+            message = Message('TimeoutNow', from_address=self.address, to_address=transfer.host.address,
+                              from_id=self.node_id, term=self.current_term)
+            # Send message...
+            self.send(message)
+
+    def end_transfer(self, term):
+        """ The leader steps down to the given term during a transfer. If the term is newer, the target
+        has started its election: the transfer succeeded, and the address of the target is returned. """
+
+        transfer = self.transfer
+        if transfer is None:
+            return None
+
+        if term > self.current_term:
+            self.cancel_transfer("Leadership transferred to server {0} (term {1})".format(transfer.host.node_id,
+                                                                                          term))
+            return tuple(transfer.host.address)
+
+        self.cancel_transfer("The leader stepped down, the transfer was abandoned")
+        return None
+
+    def cancel_transfer(self, response=None):
+        """ Ends the transfer in progress, answering the client if there is a response. """
+
+        transfer = self.transfer
+        if transfer is None:
+            return
+
+        self.transfer = None
+
+        if response:
+            transfer.request.from_id = self.node_id
+            transfer.request.response = response
+            self.reply(transfer.request)
+
+    def receive_timeout_now(self, req):
+        """ Receives a TimeoutNow from the leader, which is transferring the leadership to this server:
+        it starts an election right away, without waiting for its election timeout (nor for a PreVote). """
+
+        if req.term == self.current_term and self.state == "FOLLOWER" and self.configuration.is_voter(self.node_id):
+            self.tracer.record(INFO, TIMEOUT_NOW, self.current_term, req.from_id)
+            self.start_election(transfer=True)
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Statistics ------------------------------------------------------------------------------------------------ """
+
+    # The counters and histograms of the node (see metrics.py) are sent to whoever asks for them with a Stats
+    # message (python stats.py <host> <port>), and are also written every STATS_INTERVAL seconds to a file.
+
+    def stats(self):
+        """ Returns the metrics of the node, along with its current state. """
+
+        data = self.metrics.to_dict()
+        data['node'] = {'node_id': self.node_id,
+                        'state': self.state,
+                        'term': self.current_term,
+                        'last_log_index': self.last_log_index(),
+                        'commit_index': self.commit_index,
+                        'last_applied': self.last_applied,
+                        'snapshot_index': self.snapshot_index,
+                        'snapshot_size': self.storage.snapshot_size,
+                        'voters': sorted(self.configuration.voters),
+                        'learners': sorted(self.configuration.learners)}
+
+        if self.state == "LEADER":
+            # Number of entries that each follower is missing
+            data['match_index_lag'] = {str(node_id): self.last_log_index() - replicator.match_index
+                                       for node_id, replicator in self.replicators.items()}
+
+        return data
+
+    def receive_stats_request(self, req):
+        req.from_id = self.node_id
+        req.data = json.dumps(self.stats())
+        self.reply(req)
+
+    def start_stats(self, file_name):
+        """ Starts writing the statistics to the given file periodically. """
+        self.stats_file = file_name
+        self.stats_timeout = self.clock.time() + STATS_INTERVAL
+
+    def stats_timeout_due(self):
+        """ It's time to write the statistics. """
+        if self.stats_timeout and (self.clock.time() >= self.stats_timeout):
+            WriteAheadLog.replace_file(self.stats_file, json.dumps(self.stats(), indent=2))
+            self.stats_timeout = self.clock.time() + STATS_INTERVAL
+
+
+class ReadRequest(object):
+    """ A read-only request waiting to be served by the leader. """
+
+    def __init__(self, request, index, required_round):
+        self.request = request  # ClientRequest message
+        self.index = index  # Commit index when the request arrived (read index), None while it is unknown
+        self.round = required_round  # Heartbeat round that must be confirmed first (0 if covered by the lease)
+
+
+class SnapshotWriting(object):
+    """ A snapshot being taken (see Node.take_snapshot). """
+
+    def __init__(self, writer, chunks, last_index, last_term, configuration):
+        self.writer = writer  # Writes the snapshot to the storage (SnapshotWriter)
+        self.chunks = chunks  # Chunks of the state machine not written yet (iterator)
+        self.last_index = last_index  # Index of the last entry included in the snapshot
+        self.last_term = last_term  # Term of the last entry included in the snapshot
+        self.configuration = configuration  # Configuration in effect after the last included entry
+
+
+class LeadershipTransfer(object):
+    """ A transfer of the leadership in progress. """
+
+    def __init__(self, request, host, deadline):
+        self.request = request  # ClientRequest message that asked for the transfer
+        self.host = host  # Server that takes over the leadership (Host)
+        self.deadline = deadline  # Time after which the transfer is abandoned
@@ -0,0 +1,314 @@
+import socket
+import asyncio
+import threading
+import uuid
+import codec
+from message import Message
+from transport import open_transport
+from state_machine import KeyValueStore, prefix_end, SCAN_LIMIT
+from utils import *
+
+"""
+Client library for the cluster, without any user interface.
+
+Requests are sent to the last known leader through a single long-lived UDP socket (the large ones, and the large
+replies, over TCP connections on the same port, see transport.py). Each command carries
+a serial number, which identifies the reply, so many requests can be outstanding at the same time.
+If the server is not the leader, it answers with the address of the leader, which is cached for the following
+requests. If a server does not answer within SERVER_TIMEOUT, the request is sent again (to a randomly chosen
+server) after a jittered exponential backoff, until TIME_TO_RETRY expires.
+With follower_reads, the GETs are sent to any server (followers and learners included) along with the highest
+log index seen in the replies, so the client still reads its own writes, but the reads are not linearizable.
+With groups, the servers run several Raft groups (see multiraft.py): each command goes to the group of its key,
+and the leader of each group is cached separately. The membership changes go to the first group, the leadership
+transfers to the group given, and the keys of a multi-key command or a transaction must all belong to the same group.
+A scan covers every group, their pages are merged (see merge_pages).
+
+    • AsyncRaftClient: asyncio interface (await client.set(key, value), await client.get(key)).
+    • RaftClient: blocking interface, running an AsyncRaftClient in a background thread.
+"""
+
+# Backoff between retries: starts at BACKOFF_MIN seconds and doubles up to BACKOFF_MAX
+BACKOFF_MIN = 0.01
+BACKOFF_MAX = 1.0
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    """ Receives the replies and hands them to the client. """
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        try:
+            for message in codec.unpack(data):
+                self.client.receive_reply(Message.deserialize(message))
+        except Exception as e:
+            print("Error :", e)
+
+    def error_received(self, e):
+        # The server is not reachable, the request will time out and be sent again
+        pass
+
+
+class AsyncRaftClient(object):
+    """ Sends commands to the cluster and waits for their responses (asyncio interface). """
+
+    def __init__(self, server_list, address=None, follower_reads=False, groups=None):
+        self.server_list = server_list  # Servers of the cluster [Host]
+        self.address = address  # Address of the client (host, port), a free port is used if not given
+        self.follower_reads = follower_reads  # True to send the reads to any server
+        self.groups = groups  # Number of Raft groups of the servers (None if they run a single one)
+        self.min_index = 0  # Highest log index seen in the replies, that the servers must reach to serve a read
+        self.leaders = {}  # Last known leader of each group {group_id: address} (group None without groups)
+        self.transport = None  # Sends the requests (UdpTransport, or HybridTransport)
+        self.endpoint = None  # asyncio datagram transport
+        self.stream_server = None  # Receives the replies that come over TCP
+        self.client_id = uuid.uuid4().hex[:12]  # Identifies this client instance in the serial numbers
+        self.last_serial = 0
+        self.pending = {}  # Requests waiting for a reply {serial: future}
+
+    async def start(self):
+        """ Opens the sockets used for all the requests. """
+
+        if not self.address:
+            self.address = (socket.gethostbyname(socket.gethostname()), 0)
+
+        loop = asyncio.get_running_loop()
+        self.endpoint, protocol = await loop.create_datagram_endpoint(lambda: ClientProtocol(self),
+                                                                      local_addr=tuple(self.address))
+        self.address = (self.address[0], self.endpoint.get_extra_info('sockname')[1])
+        self.transport, self.stream_server = await open_transport(self.endpoint, protocol.datagram_received,
+                                                                  self.address)
+
+    def close(self):
+        if self.stream_server:
+            self.stream_server.close()
+            self.stream_server = None
+        if self.endpoint:
+            self.transport.close()
+            self.endpoint.close()
+            self.endpoint = None
+
+    def generate_serial(self):
+        """ Generates a unique serial number to assign to a command. """
+        self.last_serial += 1
+        return "{0}-{1}".format(self.client_id, self.last_serial)
+
+    async def get(self, position):
+        return await self.request('GET', position)
+
+    async def set(self, position, value):
+        return await self.request('SET', position, value)
+
+    async def delete(self, position):
+        return await self.request('DELETE', position)
+
+    async def scan(self, start, end=None, limit=None):
+        """ Returns the [key, value] pairs from start (included) to end (excluded), in order. The response
+        has a bounded size: the next page starts right after the last key returned (last key + chr(0)).
+        With groups, the keys are spread over all of them, so every group is scanned. """
+        if not self.groups:
+            return await self.request('SCAN', start, [end, limit])
+
+        pages = await asyncio.gather(*(self.request('SCAN', start, [end, limit], group_id=group_id)
+                                       for group_id in range(self.groups)))
+        return merge_pages(pages, limit)
+
+    async def scan_prefix(self, prefix, limit=None):
+        return await self.scan(prefix, prefix_end(prefix), limit)
+
+    async def mset(self, pairs):
+        """ Sets several keys at once, {key: value} or [[key, value], ...]. """
+        return await self.request('MSET', None, [list(pair) for pair in dict(pairs).items()])
+
+    async def mget(self, keys):
+        return await self.request('MGET', None, list(keys))
+
+    async def cas(self, key, expected, value):
+        """ Sets the key only if it has the expected value, returns [True, value] or [False, current value]. """
+        return await self.request('CAS', key, [expected, value])
+
+    async def txn(self, conditions, success, failure=()):
+        """ Runs a transaction (see state_machine.KeyValueStore), returns [succeeded, responses]. """
+        return await self.request('TXN', None, [[list(c) for c in conditions], [list(op) for op in success],
+                                                [list(op) for op in failure]])
+
+    async def add_server(self, node_id, address, timeout=None):
+        """ Adds a server to the cluster (it must be running, started with 'join'). It may take a while,
+        the server has to catch up with the leader before becoming a voter. """
+        return await self.request('ADD_SERVER', node_id, list(address), timeout)
+
+    async def add_learner(self, node_id, address, timeout=None):
+        """ Adds a server that receives the log and serves follower reads, but does not vote. """
+        return await self.request('ADD_LEARNER', node_id, list(address), timeout)
+
+    async def remove_server(self, node_id, timeout=None):
+        return await self.request('REMOVE_SERVER', node_id, None, timeout)
+
+    async def transfer_leader(self, node_id, group_id=None, timeout=None):
+        """ Hands the leadership (of the given group) over to another voter, e.g. before restarting the leader. """
+        return await self.request('TRANSFER_LEADER', node_id, group_id, timeout)
+
+    async def request(self, action, position, value=None, timeout=None, group_id=None):
+        """ Sends a command to the leader (of the given group, or else of the group of its keys) and returns
+        its response. Raises TimeoutError if no server answers within the timeout (TIME_TO_RETRY by default). """
+
+        loop = asyncio.get_running_loop()
+        command = Command(self.address, self.generate_serial(), action, position, value)
+        deadline = time.time() + (timeout or TIME_TO_RETRY)
+        attempt = 0
+        follower_read = self.follower_reads and action in KeyValueStore.read_actions
+        if group_id is None:
+            group_id = self.group_of(command)
+
+        try:
+            while time.time() < deadline:
+                if follower_read:
+                    server_address = random.choice(self.server_list).address
+                else:
+                    server_address = self.leaders.get(group_id) or random.choice(self.server_list).address
+
+                future = loop.create_future()
+                self.pending[command.serial] = future
+
+                message = Message('ClientRequest', from_address=self.address, to_address=server_address,
+                                  command=command, commit_index=self.min_index if follower_read else None,
+                                  group_id=group_id)
+                message.send(self.transport)
+
+                try:
+                    reply = await asyncio.wait_for(future, min(SERVER_TIMEOUT, max(0, deadline - time.time())))
+                except asyncio.TimeoutError:
+                    reply = None
+
+                if reply and reply.response is not None:
+                    return reply.response
+
+                if reply and reply.leader_address and not follower_read:
+                    # The server is not the leader, but it knows who is
+                    self.leaders[group_id] = tuple(reply.leader_address)
+                    if self.leaders[group_id] != tuple(server_address):
+                        continue
+                elif not follower_read:
+                    # No answer, or the server has no leader's info: try again with another server
+                    self.leaders.pop(group_id, None)
+
+                attempt += 1
+                backoff = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** attempt)
+                await asyncio.sleep(random.uniform(backoff / 2, backoff))
+
+        finally:
+            self.pending.pop(command.serial, None)
+
+        raise TimeoutError("Impossible to connect, try again")
+
+    def group_of(self, command):
+        """ Returns the Raft group that a command belongs to (None if the servers run a single group).
+        Raises ValueError if the keys of the command belong to different groups. """
+        if command.action == 'TRANSFER_LEADER':
+            return command.new_value
+        if not self.groups:
+            return None
+        if command.action in ('ADD_SERVER', 'ADD_LEARNER', 'REMOVE_SERVER'):
+            return 0
+        if command.action == 'SCAN':
+            raise ValueError("A scan covers every group, it is sent to each one by scan()")
+
+        groups = {group_of(key, self.groups) for key in KeyValueStore.keys_of(command)}
+        if len(groups) > 1:
+            raise ValueError("The keys of the command belong to different groups")
+        return groups.pop() if groups else 0
+
+    def receive_reply(self, message):
+        """ Completes the request that the reply belongs to. """
+
+        if message.msg_type == "ClientRequest" and message.direction == "reply" and message.command:
+            if message.response is not None and message.commit_index:
+                self.min_index = max(self.min_index, message.commit_index)
+
+            future = self.pending.get(message.command.serial)
+            if future and not future.done():
+                future.set_result(message)
+
+
+def merge_pages(pages, limit=None):
+    """ Merges the SCAN pages of several groups into a single one, in key order. The keys after the end of a full
+    page may be in its group and missing from the merged page, so it stops at the first such end, and the next page
+    starts right after it in every group. Returns the first response that is not a page (an error), if any. """
+
+    for page in pages:
+        if not isinstance(page, list):
+            return page
+
+    ends = [page[-1][0] for page in pages if page and KeyValueStore.page_full(page, limit)]
+    pairs = sorted((pair for page in pages for pair in page), key=lambda pair: pair[0])
+    if ends:
+        pairs = [pair for pair in pairs if pair[0] <= min(ends)]
+    return pairs[:min(limit or SCAN_LIMIT, SCAN_LIMIT)]
+
+
+class RaftClient(object):
+    """ Blocking interface of the client. The requests run in an event loop of a background thread,
+    so several threads can use the same client at once, and 'submit' lets a caller carry on
+    while the request is in progress. """
+
+    def __init__(self, server_list, address=None, follower_reads=False, groups=None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.client = AsyncRaftClient(server_list, address, follower_reads, groups)
+        asyncio.run_coroutine_threadsafe(self.client.start(), self.loop).result()
+
+    def submit(self, action, position, value=None, timeout=None):
+        """ Sends a command and returns a concurrent.futures.Future with its response. """
+        return asyncio.run_coroutine_threadsafe(self.client.request(action, position, value, timeout), self.loop)
+
+    def request(self, action, position, value=None, timeout=None):
+        return self.submit(action, position, value, timeout).result()
+
+    def get(self, position):
+        return self.request('GET', position)
+
+    def set(self, position, value):
+        return self.request('SET', position, value)
+
+    def delete(self, position):
+        return self.request('DELETE', position)
+
+    def scan(self, start, end=None, limit=None):
+        return asyncio.run_coroutine_threadsafe(self.client.scan(start, end, limit), self.loop).result()
+
+    def scan_prefix(self, prefix, limit=None):
+        return self.scan(prefix, prefix_end(prefix), limit)
+
+    def mset(self, pairs):
+        return self.request('MSET', None, [list(pair) for pair in dict(pairs).items()])
+
+    def mget(self, keys):
+        return self.request('MGET', None, list(keys))
+
+    def cas(self, key, expected, value):
+        return self.request('CAS', key, [expected, value])
+
+    def txn(self, conditions, success, failure=()):
+        return self.request('TXN', None, [[list(c) for c in conditions], [list(op) for op in success],
+                                          [list(op) for op in failure]])
+
+    def add_server(self, node_id, address, timeout=None):
+        return self.request('ADD_SERVER', node_id, list(address), timeout)
+
+    def add_learner(self, node_id, address, timeout=None):
+        return self.request('ADD_LEARNER', node_id, list(address), timeout)
+
+    def remove_server(self, node_id, timeout=None):
+        return self.request('REMOVE_SERVER', node_id, None, timeout)
+
+    def transfer_leader(self, node_id, group_id=None, timeout=None):
+        return self.request('TRANSFER_LEADER', node_id, group_id, timeout)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.client.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
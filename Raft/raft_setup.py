@@ -3,12 +3,39 @@ import socket
 import json
 import os
 import glob
+import shutil
 
 """ Create an initial setting for each of the servers (json files).
-By default, It creates settings for 5 servers and 3 clients. """
+By default, It creates settings for 5 servers and 3 clients.
+python raft_setup.py join <node_id> creates the setting of a new server that joins the running cluster
+(it is then added with python membership.py add <node_id> <ip> <port>). """
+
+
+def create_joining_server(node_id):
+    """ Creates the setting of a server that is not a member of the cluster yet. """
+
+    with open("configs/client-1.json", "r") as file:
+        servers = json.loads(file.read())['server_list']
+
+    config = dict()
+    config['node_id'] = node_id
+    config['port'] = 3000 + node_id
+    config['node_list'] = [server for server in servers if server['node_id'] != node_id]
+    config['dict_data'] = {1: "Blue", 2: "Yellow", 3: "Red", 4: "Green", 5: "White"}
+    config['join'] = True
+
+    file_name = "configs/server-{0}.json".format(node_id)
+    with open(file_name, "w") as file:
+        file.write(json.dumps(config, indent=2))
+        print("->", file_name)
+
 
 if __name__ == '__main__':
 
+    if len(sys.argv) > 2 and sys.argv[1] == "join":
+        create_joining_server(int(sys.argv[2]))
+        sys.exit()
+
     if len(sys.argv) > 1:
         cant_servers = int(sys.argv[1])
         cant_clients = int(sys.argv[2])
@@ -25,6 +52,10 @@ if __name__ == '__main__':
     for filename in glob.glob("configs/client-*.json"):
         os.remove(filename)
 
+    # Write-ahead logs of the previous run
+    for directory in glob.glob("data/server-*"):
+        shutil.rmtree(directory)
+
     # List of all servers
     address_ip = socket.gethostbyname(socket.gethostname())
     servers = []
@@ -50,10 +81,6 @@ if __name__ == '__main__':
         server_list.pop(i - 1)
 
         config['node_list'] = server_list
-
-        config['term'] = 0
-        config['voted_for'] = None
-        config['logs'] = None
         config['dict_data'] = dict_data
 
         # Serializing json
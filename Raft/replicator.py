@@ -0,0 +1,60 @@
+from utils import *
+from collections import OrderedDict
+
+
+class Replicator(object):
+    """ The Replicator class represents the replication state that the leader keeps for one follower.
+    Log entries are sent in bounded batches (MAX_BATCH_ENTRIES entries, MAX_BATCH_BYTES bytes),
+    and up to MAX_INFLIGHT batches may be waiting for an answer at the same time (pipelining).
+    Each in-flight batch is identified by the index of the entry that precedes it (prev_index).
+    New batches are only sent when acknowledgements free a place in the window, so a slow follower
+    only holds back its own replication, and never the one of the other followers. """
+
+    def __init__(self, node, next_index, clock=time):
+        self.node = node  # Follower (Host)
+        self.clock = clock  # Source of the current time (time)
+        self.next_index = next_index  # Index of the next log entry to send (after the in-flight batches)
+        self.match_index = 0  # Index of highest log entry known to be replicated on the follower
+        self.inflight = OrderedDict()  # Batches waiting for an answer {prev_index: (last_index, time sent)}
+        self.snapshot_offset = 0  # Offset of the next snapshot chunk to send
+        self.acked_round = 0  # Last heartbeat round answered by the follower
+        self.last_contact = clock.time()  # Time of the last answer of the follower (see CHECK_QUORUM)
+
+    def can_send(self):
+        """ Returns True if there is room in the window for another batch. """
+        return len(self.inflight) < MAX_INFLIGHT
+
+    def sent(self, prev_index, last_index):
+        """ Registers a batch that has just been sent. """
+        self.inflight[prev_index] = (last_index, self.clock.time())
+        self.next_index = last_index + 1
+
+    def acknowledged(self, match_index):
+        """ The follower matched the leader's log up to the given index,
+        the batches that end at or before it are no longer in flight. """
+
+        self.match_index = max(self.match_index, match_index)
+        self.next_index = max(self.next_index, self.match_index + 1)
+
+        for prev_index in list(self.inflight):
+            if self.inflight[prev_index][0] <= self.match_index:
+                del self.inflight[prev_index]
+
+    def rejected(self, prev_index, next_index):
+        """ The follower did not contain the entry at prev_index. Every batch in flight
+        is discarded and the replication goes back to the given next index.
+        Rejections of batches behind the match index or after the next index are outdated and are ignored. """
+
+        if self.match_index < prev_index < self.next_index:
+            self.inflight.clear()
+            self.next_index = max(self.match_index + 1, min(next_index, prev_index))
+
+    def expire(self):
+        """ Discards the in-flight batches when the oldest of them has been waiting
+        for too long (two heartbeats), in which case they are considered lost and sent again. """
+
+        if self.inflight:
+            last_index, time_sent = next(iter(self.inflight.values()))
+            if self.clock.time() - time_sent >= 2 * HEARTBEAT_TIMEOUT:
+                self.inflight.clear()
+                self.next_index = self.match_index + 1
@@ -1,9 +1,12 @@
 import sys
+import signal
 import socket
+import asyncio
 from node import Node
 from message import Message
+from transport import UdpTransport, open_transport
+from tracing import ERROR, SERVER_ERROR
 from utils import *
-import threading
 
 # run a server
 # python server.py configs\server-1.json
@@ -23,71 +26,90 @@ def get_server_info(file_name):
     return node_id, port, node_list
 
 
-if __name__ == '__main__':
+class ServerProtocol(asyncio.DatagramProtocol):
+    """ Runs a node inside the asyncio event loop.
+    The node handles each datagram as soon as it arrives, and its timeouts (heartbeat, election)
+    are scheduled as timers of the loop, so the server does nothing while the cluster is idle. """
 
-    # Get data from the json file
-    json_file = sys.argv[1]
-    node_id, port, node_list = get_server_info(json_file)
+    def __init__(self, server):
+        self.server = server  # Node
+        self.loop = asyncio.get_event_loop()
+        self.timer = None  # Timer of the next timeout
+        self.deadline = None  # Time at which the timer expires
 
-    # Server Address
-    udp_host = socket.gethostbyname(socket.gethostname())  # Host IP
-    udp_port = port  # Specified port to connect
-    server_address = (udp_host, udp_port)
+    def connection_made(self, transport):
+        # The node sends its messages through the datagram transport of the loop
+        self.server.transport = UdpTransport(transport)
+        self.schedule()
 
-    # Create a UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(server_address)
+    def datagram_received(self, data, address):
+        try:
+            self.server.receive_message(Message.deserialize(data))
 
-    server = Node(node_id, server_address, 'FOLLOWER', node_list, sock)
-    server.update_state()
-    print(server)
+        except Exception as e:
+            self.server.tracer.record(ERROR, SERVER_ERROR, detail=repr(e))
 
-    server.socket.setblocking(False)
+        self.schedule()
+
+    def error_received(self, e):
+        # Error: 10054 --> problems contacting another node
+        self.server.tracer.record(ERROR, SERVER_ERROR, detail=repr(e))
+
+    def timeout(self):
+        self.timer = None
+        self.deadline = None
 
-    while True:
         try:
-            # Receive response
-            data, address = sock.recvfrom(4096)
+            self.server.tick()
+        except Exception as e:
+            self.server.tracer.record(ERROR, SERVER_ERROR, detail=repr(e))
 
-            message = Message.deserialize(data.decode())
-            print(message)
+        self.schedule()
 
-            # It's time to send a heartbeat message
-            server.heartbeat_timeout_due()
+    def schedule(self):
+        """ Sets the timer to the node's next timeout, if it has changed. """
 
-            # Timed out to wait for a heartbeat message
-            server.election_timeout_due()
+        deadline = self.server.next_deadline()
+        if deadline == self.deadline:
+            return
 
-            if message.msg_type == "AppendEntries":
-                if message.direction == "request":
-                    server.receive_append_entries(message)
-                else:
-                    server.receive_append_entries_reply(message)
+        if self.timer:
+            self.timer.cancel()
 
-            elif message.msg_type == "RequestVote":
-                if message.direction == "request":
-                    server.receive_request_vote(message)
-                else:
-                    server.receive_request_vote_reply(message)
+        self.deadline = deadline
+        self.timer = self.loop.call_later(max(0, deadline - time.time()), self.timeout) if deadline else None
 
-            elif message.msg_type == "ClientRequest":
-                if message.direction == "request":
-                    # server.receive_client_request(message)
-                    threading.Thread(target=server.receive_client_request(message)).start()
 
-        except socket.error as e:
-            # Error: 10035 --> server didn't receive data from 'sock.recvfrom(4096)'
-            # Error: 10054 --> problems contacting another node
-            if e.args[0] == 10035 or e.args[0] == 10054 or e.args[0] == 11:
+async def run_server(server, server_address):
+    loop = asyncio.get_running_loop()
+    endpoint, protocol = await loop.create_datagram_endpoint(lambda: ServerProtocol(server), local_addr=server_address)
 
-                # It's time to send a heartbeat message
-                server.heartbeat_timeout_due()
+    # The large messages go over TCP, received on the same port (see transport.py)
+    server.transport, _ = await open_transport(endpoint, protocol.datagram_received, server_address)
 
-                # Timed out to wait for a heartbeat message
-                server.election_timeout_due()
+    # kill -USR1 <pid> writes the last events of the node to data/server-N/trace.bin
+    if hasattr(signal, "SIGUSR1"):
+        trace_file = "data/server-{0}/trace.bin".format(server.node_id)
+        loop.add_signal_handler(signal.SIGUSR1, server.tracer.dump, trace_file)
 
-            else:
-                print("Error :", e)
+    # Runs until the process is stopped
+    await loop.create_future()
 
-        except Exception as e:
-            print("Error :", e)
+
+if __name__ == '__main__':
+
+    # Get data from the json file
+    json_file = sys.argv[1]
+    node_id, port, node_list = get_server_info(json_file)
+
+    # Server Address
+    udp_host = socket.gethostbyname(socket.gethostname())  # Host IP
+    udp_port = port  # Specified port to connect
+    server_address = (udp_host, udp_port)
+
+    server = Node(node_id, server_address, 'FOLLOWER', node_list, None)
+    server.update_state()
+    server.start_stats("data/server-{0}/stats.json".format(node_id))
+    print(server)
+
+    asyncio.run(run_server(server, server_address))
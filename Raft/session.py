@@ -0,0 +1,79 @@
+from utils import *
+from collections import OrderedDict
+
+
+class Session(object):
+    """ A Session keeps the commands of a single client that have already been applied,
+    with the response that was given to each of them (only the most recent ones are kept). """
+
+    def __init__(self, last_index=0, responses=None):
+        self.last_index = last_index  # Index of the last log entry applied for this client
+        self.responses = OrderedDict(responses or [])  # Responses of the last commands {serial: response}
+
+    def record(self, serial, response, index):
+        self.responses[serial] = response
+        self.responses.move_to_end(serial)
+        if len(self.responses) > SESSION_HISTORY:
+            self.responses.popitem(last=False)
+        self.last_index = index
+
+
+class SessionTable(object):
+    """ The SessionTable class keeps a session for each client (by its address), which is used to detect
+    commands that are sent again by a client, and to answer them with the same response without
+    going through the log.
+    The table is updated as log entries are applied to the state machine, and idle sessions are evicted
+    according to log indexes (and never to clocks), so every server makes the same decisions:
+        • A session expires when SESSION_EXPIRY entries are applied without any command of its client.
+        • At most MAX_SESSIONS sessions are kept, the least recently used one is evicted first. """
+
+    def __init__(self):
+        self.sessions = OrderedDict()  # Sessions ordered from the least to the most recently used
+
+    @staticmethod
+    def key(client_address):
+        return tuple(client_address)
+
+    def response(self, client_address, serial):
+        """ Returns the response given to an already applied command, or None if it is unknown. """
+        session = self.sessions.get(self.key(client_address))
+        if session:
+            return session.responses.get(serial)
+        return None
+
+    def last_index(self, client_address):
+        """ Returns the index of the last log entry applied for the client (0 if it is unknown). """
+        session = self.sessions.get(self.key(client_address))
+        return session.last_index if session else 0
+
+    def record(self, command, response, index):
+        """ Registers the response of a command applied at the given index. """
+
+        key = self.key(command.client_address)
+        session = self.sessions.pop(key, None) or Session()
+        session.record(command.serial, response, index)
+        self.sessions[key] = session
+
+        self.expire(index)
+
+    def expire(self, index):
+        """ Evicts the sessions that have been idle for too long, and the least recently used ones
+        if there are too many. """
+
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if oldest.last_index > index - SESSION_EXPIRY and len(self.sessions) <= MAX_SESSIONS:
+                break
+            self.sessions.popitem(last=False)
+
+    def to_list(self):
+        """ Returns the table in a json serializable form (to be included in snapshots). """
+        return [[list(key), session.last_index, list(session.responses.items())]
+                for key, session in self.sessions.items()]
+
+    @staticmethod
+    def from_list(data):
+        table = SessionTable()
+        for client_address, last_index, responses in data:
+            table.sessions[table.key(client_address)] = Session(last_index, [tuple(item) for item in responses])
+        return table
@@ -0,0 +1,537 @@
+import os
+import heapq
+import argparse
+import contextlib
+from tabulate import tabulate
+from node import Node
+from message import Message
+from storage import MemoryStorage
+from transport import Transport
+from tracing import Tracer
+from raft_client import BACKOFF_MIN, BACKOFF_MAX
+from utils import *
+
+# Simulation of clusters on a network in memory
+# python simulation.py --clusters 1 --servers 5 --clients 4 --commands 2000 --loss 0.01 --seed 1
+# python simulation.py --replace (a new server joins each cluster and the first one leaves it, under load)
+# python simulation.py --learners 2 --follower-reads (the reads are spread over followers and learners)
+# python simulation.py --isolate follower (a follower of each cluster is cut off from the others for a while)
+# python simulation.py --transfer (the leadership of each cluster is handed over to another server under load)
+
+""" Runs nodes inside a single process, on a simulated network with a virtual clock.
+Messages are delivered after a configurable latency (plus jitter), and may be lost, reordered (delayed further)
+or blocked by partitions. Time only advances from one event (delivery or timeout) to the next, so the runs
+are much faster than real time, and with the same seed they are exactly the same.
+The scenario measures the time to elect the first leader, the throughput and latency of the commands sent by
+simulated clients, and the time to elect a new leader after the leader crashes. All the times are virtual.
+Optionally, the membership of the clusters is changed while the clients are sending their commands,
+a server of each cluster is cut off from the other servers for a while, or the leadership is transferred. """
+
+
+class SimulatedNetwork(object):
+    """ The SimulatedNetwork class delivers the messages between the endpoints attached to it,
+    and keeps the virtual clock (it is the clock of the simulated nodes). """
+
+    def __init__(self, seed=0, latency=0.001, jitter=0.0005, loss=0.0, reorder=0.0):
+        self.random = random.Random(seed)
+        self.latency = latency  # Minimum delay of a message (seconds)
+        self.jitter = jitter  # Maximum random delay added to the latency (seconds)
+        self.loss = loss  # Probability of losing a message
+        self.reorder = reorder  # Probability of delaying a message by an extra latency (it overtakes others)
+        self.now = 0.0  # Virtual time (seconds)
+        self.events = []  # Heap of the pending events [(time, sequence, callback, args)]
+        self.sequence = 0  # Orders the events scheduled for the same time
+        self.endpoints = {}  # Receivers of the messages {address: callback(data)}
+        self.groups = None  # Partitions {address: group}, None if the network is whole
+        self.sent = 0
+        self.dropped = 0
+
+    def time(self):
+        return self.now
+
+    def schedule(self, when, callback, *args):
+        heapq.heappush(self.events, (when, self.sequence, callback, args))
+        self.sequence += 1
+
+    def attach(self, address, callback):
+        self.endpoints[tuple(address)] = callback
+
+    def detach(self, address):
+        self.endpoints.pop(tuple(address), None)
+
+    def partition(self, *groups):
+        """ Splits the network: messages are only delivered between addresses of the same group
+        (addresses not in any group, such as the clients, can reach everybody). """
+        self.groups = {tuple(address): number for number, group in enumerate(groups) for address in group}
+
+    def heal(self):
+        self.groups = None
+
+    def connected(self, source, destination):
+        if self.groups is None:
+            return True
+        source = self.groups.get(tuple(source))
+        destination = self.groups.get(tuple(destination))
+        return source is None or destination is None or source == destination
+
+    def send(self, source, data, destination):
+        self.sent += 1
+
+        if not self.connected(source, destination) or self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if self.reorder and self.random.random() < self.reorder:
+            delay += self.latency + self.jitter
+
+        self.schedule(self.now + delay, self.deliver, source, data, tuple(destination))
+
+    def deliver(self, source, data, destination):
+        # The partition is checked again, it may have started while the message was on its way
+        callback = self.endpoints.get(destination)
+        if callback and self.connected(source, destination):
+            callback(data)
+
+    def run(self, until=None, condition=None):
+        """ Processes the events in order, until the given time or until the condition is met.
+        Returns True if the condition was met. """
+
+        while self.events:
+            if condition and condition():
+                return True
+
+            when, _, callback, args = self.events[0]
+            if until is not None and when > until:
+                break
+
+            heapq.heappop(self.events)
+            self.now = max(self.now, when)
+            callback(*args)
+
+        if until is not None:
+            self.now = max(self.now, until)
+
+        return bool(condition and condition())
+
+
+class SimulatedTransport(Transport):
+    """ Sends the messages of one endpoint through the simulated network. """
+
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+
+    def sendto(self, data, address):
+        self.network.send(self.address, data, address)
+
+
+class SimulatedServer(object):
+    """ Runs a node on the simulated network, like ServerProtocol does on UDP:
+    it hands the messages received to the node and calls its tick at every deadline. """
+
+    def __init__(self, network, node_id, address, node_list, dict_data, tracer=None, join=False):
+        self.network = network
+        self.tracer = tracer  # Shared by the nodes of the simulation
+        self.node_id = node_id
+        self.address = address
+        self.node_list = node_list
+        self.dict_data = dict_data
+        self.join = join  # The server is not a member of the cluster until the leader adds it
+        self.storage = MemoryStorage()  # Survives the restarts of the node
+        self.node = None
+        self.deadline = None  # Time of the next tick scheduled
+        self.start()
+
+    def start(self):
+        self.node = Node(self.node_id, self.address, 'FOLLOWER', self.node_list,
+                         SimulatedTransport(self.network, self.address), self.storage, self.network, self.tracer)
+        self.node.update_state({'dict_data': self.dict_data, 'join': self.join})
+        self.network.attach(self.address, self.receive)
+        self.deadline = None
+        self.schedule()
+
+    def stop(self):
+        """ Crashes the node: it stops receiving messages and its volatile state is lost. """
+        self.network.detach(self.address)
+        self.node = None
+        self.deadline = None
+
+    def receive(self, data):
+        self.node.receive_message(Message.deserialize(data))
+        self.schedule()
+
+    def timeout(self, deadline):
+        # Timers left behind by a newer deadline (or by a crash) are ignored
+        if self.node is None or deadline != self.deadline:
+            return
+
+        self.deadline = None
+        self.node.tick()
+        self.schedule()
+
+    def schedule(self):
+        deadline = self.node.next_deadline()
+        if deadline != self.deadline:
+            self.deadline = deadline
+            if deadline:
+                self.network.schedule(max(deadline, self.network.now), self.timeout, deadline)
+
+
+class SimulatedClient(object):
+    """ Sends commands to a cluster one at a time (closed loop), following the redirections
+    to the leader and sending them again when no response arrives within SERVER_TIMEOUT. """
+
+    def __init__(self, network, address, server_list, rand, reads=0.5, keys=5, follower_reads=False):
+        self.network = network
+        self.address = address
+        self.server_list = server_list
+        self.transport = SimulatedTransport(network, address)
+        self.random = rand
+        self.reads = reads  # Fraction of GET commands
+        self.keys = keys  # Number of positions used
+        self.follower_reads = follower_reads  # True to send the reads to any server
+        self.min_index = 0  # Highest log index seen in the replies
+        self.leader_address = None
+        self.last_serial = 0
+        self.command = None  # Command waiting for its response
+        self.start_time = None  # Time at which the command was first sent
+        self.attempt = 0  # Number of times the command has been sent
+        self.remaining = 0  # Commands left to send
+        self.latencies = []  # Virtual seconds
+        network.attach(address, self.receive)
+
+    def run(self, commands):
+        self.remaining = commands
+        self.next_command()
+
+    def next_command(self):
+        if self.remaining <= 0:
+            self.command = None
+            return
+
+        self.remaining -= 1
+        self.last_serial += 1
+        action, position, value = self.new_command()
+
+        self.command = Command(self.address, str(self.last_serial), action, position, value)
+        self.start_time = self.network.now
+        self.send()
+
+    def new_command(self):
+        """ Returns the action, position and value of the next command. """
+        action = 'GET' if self.random.random() < self.reads else 'SET'
+        position = str(self.random.randint(1, self.keys))
+        value = "value-{0}".format(self.last_serial) if action == 'SET' else None
+        return action, position, value
+
+    def completed(self, response):
+        self.latencies.append(self.network.now - self.start_time)
+
+    def send(self):
+        self.attempt += 1
+        follower_read = self.follower_reads and self.command.action == 'GET'
+        if follower_read:
+            server_address = self.random.choice(self.server_list).address
+        else:
+            server_address = self.leader_address or self.random.choice(self.server_list).address
+        Message('ClientRequest', from_address=self.address, to_address=server_address, command=self.command,
+                commit_index=self.min_index if follower_read else None).send(self.transport)
+        self.network.schedule(self.network.now + SERVER_TIMEOUT, self.timeout, self.command.serial, self.attempt)
+
+    def timeout(self, serial, attempt):
+        if self.command and self.command.serial == serial and self.attempt == attempt:
+            self.leader_address = None
+            self.send()
+
+    def receive(self, data):
+        message = Message.deserialize(data)
+        if not self.command or not message.command or message.command.serial != self.command.serial:
+            return
+
+        if message.response is not None:
+            self.min_index = max(self.min_index, message.commit_index or 0)
+            self.completed(message.response)
+            self.next_command()
+        elif message.leader_address and tuple(message.leader_address) != self.leader_address:
+            self.leader_address = tuple(message.leader_address)
+            self.send()
+        elif not message.leader_address:
+            # The server does not know the leader either, another one is tried shortly (as RaftClient does)
+            self.network.schedule(self.network.now + BACKOFF_MIN, self.timeout, self.command.serial, self.attempt)
+
+
+class SimulatedAdmin(SimulatedClient):
+    """ Sends the given commands in order (membership changes and leadership transfers), and keeps their responses.
+    A command refused for now ("try again later") is sent again after a backoff, and the script only goes on
+    once a command has been carried out: the next commands rely on it. """
+
+    def __init__(self, network, address, server_list, rand, script):
+        super().__init__(network, address, server_list, rand)
+        self.script = list(script)  # Commands to send [(action, position, value)]
+        self.responses = []
+        self.retries = 0  # Times the current command has been refused
+        self.waiting = False  # True while waiting to send a refused command again
+
+    def run(self, commands=None):
+        super().run(len(self.script))
+
+    def new_command(self):
+        return self.script.pop(0)
+
+    def completed(self, response):
+        super().completed(response)
+        self.responses.append(response)
+
+        if str(response).endswith("try again later"):
+            # Sent again (with a new serial number, the refusal is not a response to keep)
+            self.script.insert(0, (self.command.action, self.command.position, self.command.new_value))
+            self.remaining += 1
+            self.retries += 1
+        elif str(response).startswith(("Configuration changed", "Leadership transferred")):
+            self.retries = 0
+        else:
+            self.remaining = 0
+            self.script = []
+
+    def next_command(self):
+        if self.retries and self.remaining > 0 and not self.waiting:
+            self.waiting = True
+            backoff = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** self.retries)
+            self.network.schedule(self.network.now + self.random.uniform(backoff / 2, backoff), self.next_command)
+            return
+
+        self.waiting = False
+        super().next_command()
+
+    def timeout(self, serial, attempt):
+        if not self.waiting:
+            super().timeout(serial, attempt)
+
+    def receive(self, data):
+        if not self.waiting:
+            super().receive(data)
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Scenario ------------------------------------------------------------------------------------------------------ """
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Raft on a simulated network")
+    parser.add_argument("--clusters", type=int, default=1, help="number of independent clusters")
+    parser.add_argument("--servers", type=int, default=5, help="number of servers of each cluster")
+    parser.add_argument("--clients", type=int, default=4, help="number of clients of each cluster")
+    parser.add_argument("--commands", type=int, default=1000, help="commands sent by each client")
+    parser.add_argument("--reads", type=float, default=0.5, help="fraction of GET commands (0..1)")
+    parser.add_argument("--latency", type=float, default=0.001, help="minimum delay of a message (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.0005, help="maximum random delay added (seconds)")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of losing a message")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability of delaying a message further")
+    parser.add_argument("--seed", type=int, default=0, help="seed of every random choice")
+    parser.add_argument("--replace", action="store_true", help="replace a server of each cluster under load")
+    parser.add_argument("--learners", type=int, default=0, help="learners added to each cluster before the load")
+    parser.add_argument("--follower-reads", action="store_true", help="send the GETs to any server")
+    parser.add_argument("--isolate", choices=["follower", "leader"], help="cut a server of each cluster off under load")
+    parser.add_argument("--isolation", type=float, default=10.0, help="time the server is cut off (seconds)")
+    parser.add_argument("--transfer", action="store_true", help="transfer the leadership of each cluster under load")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the nodes")
+    return parser.parse_args()
+
+
+class Cluster(object):
+
+    def __init__(self, network, number, servers, tracer):
+        hosts = [Host(i, ("10.0.{0}.{1}".format(number, i), 3000 + i)) for i in range(1, servers + 1)]
+        dict_data = {str(i): "value" for i in range(1, 6)}
+
+        self.number = number
+        self.dict_data = dict_data
+        self.hosts = hosts
+        self.servers = [SimulatedServer(network, host.node_id, host.address,
+                                        [other for other in hosts if other is not host], dict_data, tracer)
+                        for host in hosts]
+
+    def leader(self):
+        """ Returns the server that leads the cluster, if there is a single one in the highest term.
+        The candidates are left out: a server removed from the cluster, until it is stopped, keeps starting
+        elections that the others ignore while they hear from the leader. """
+        running = [server.node for server in self.servers if server.node]
+        term = max((node.current_term for node in running if node.state != "CANDIDATE"), default=0)
+        leaders = [node for node in running if node.state == 'LEADER' and node.current_term == term]
+        return leaders[0] if len(leaders) == 1 else None
+
+    def add_server(self, network, tracer):
+        """ Starts a new server, which joins the cluster once the leader adds it. """
+        node_id = len(self.hosts) + 1
+        host = Host(node_id, ("10.0.{0}.{1}".format(self.number, node_id), 3000 + node_id))
+        self.servers.append(SimulatedServer(network, host.node_id, host.address, list(self.hosts), self.dict_data,
+                                            tracer, join=True))
+        self.hosts.append(host)
+        return host
+
+
+def isolate(network, clusters, role):
+    """ Cuts the leader, or a follower, of each cluster off from the other servers of the cluster. """
+
+    groups = []
+    for cluster in clusters:
+        leader = cluster.leader()
+        running = [server for server in cluster.servers if server.node]
+        isolated = [server for server in running if (server.node is leader) == (role == "leader")][:1]
+        groups += [[server.address for server in isolated],
+                   [server.address for server in running if server not in isolated]]
+
+    network.partition(*groups)
+
+
+def transfer_leader(cluster, admin):
+    """ Hands the leadership over to another voter of the cluster, chosen when the transfer starts
+    (the voters may have changed meanwhile, see --replace). """
+
+    leader = cluster.leader()
+    if leader is None:
+        # Between two leaders, the transfer waits for the next one
+        admin.network.schedule(admin.network.now + BACKOFF_MAX, transfer_leader, cluster, admin)
+        return
+
+    target = min(node_id for node_id in leader.configuration.voters if node_id != leader.node_id)
+    admin.server_list = list(cluster.hosts)
+    admin.script = [("TRANSFER_LEADER", target, None)]
+    admin.run()
+
+
+def run_scenario(args):
+    random.seed(args.seed)  # Election timeouts of the nodes
+    network = SimulatedNetwork(args.seed, args.latency, args.jitter, args.loss, args.reorder)
+    tracer = Tracer(clock=network)
+    clusters = [Cluster(network, number, args.servers, tracer) for number in range(args.clusters)]
+    results = []
+    start = time.perf_counter()
+
+    # First election
+    network.run(until=network.now + 60, condition=lambda: all(cluster.leader() for cluster in clusters))
+    results.append(["First election (s)", "{0:.3f}".format(network.now)])
+
+    # Learners
+    if args.learners:
+        admins = []
+        for number, cluster in enumerate(clusters):
+            hosts = [cluster.add_server(network, tracer) for _ in range(args.learners)]
+            admin = SimulatedAdmin(network, ("10.2.{0}.1".format(number), 5001), list(cluster.hosts),
+                                   random.Random(number),
+                                   [("ADD_LEARNER", host.node_id, list(host.address)) for host in hosts])
+            admin.run()
+            admins.append(admin)
+
+        network.run(until=network.now + 60, condition=lambda: all(admin.command is None for admin in admins))
+        results.append(["Learners added", sum(response.startswith("Configuration changed")
+                                              for admin in admins for response in admin.responses)])
+
+    # Load
+    clients = []
+    rand = random.Random(args.seed)
+    for number, cluster in enumerate(clusters):
+        for i in range(args.clients):
+            client = SimulatedClient(network, ("10.1.{0}.{1}".format(number, i), 4000 + i), list(cluster.hosts),
+                                     random.Random(rand.random()), args.reads, follower_reads=args.follower_reads)
+            client.run(args.commands)
+            clients.append(client)
+
+    # Membership changes under load: a new server joins each cluster, and then the first server leaves it
+    admins = []
+    if args.replace:
+        for number, cluster in enumerate(clusters):
+            host = cluster.add_server(network, tracer)
+            admin = SimulatedAdmin(network, ("10.2.{0}.0".format(number), 5000), list(cluster.hosts),
+                                   random.Random(rand.random()),
+                                   [("ADD_SERVER", host.node_id, list(host.address)), ("REMOVE_SERVER", 1, None)])
+            admin.run()
+            admins.append(admin)
+
+    # A server of each cluster is cut off for a while (the clients still reach it)
+    if args.isolate:
+        network.schedule(network.now + 1, isolate, network, clusters, args.isolate)
+        network.schedule(network.now + 1 + args.isolation, network.heal)
+
+    # The leadership of each cluster is handed over to another server
+    transfers = []
+    if args.transfer:
+        for number, cluster in enumerate(clusters):
+            admin = SimulatedAdmin(network, ("10.2.{0}.2".format(number), 5002), list(cluster.hosts),
+                                   random.Random(rand.random()), [])
+            network.schedule(network.now + 1, transfer_leader, cluster, admin)
+            transfers.append(admin)
+
+    load_start = network.now
+    start_terms = [max(server.node.current_term for server in cluster.servers if server.node) for cluster in clusters]
+    network.run(until=network.now + 3600,
+                condition=lambda: all(client.command is None for client in clients + admins + transfers))
+    load_time = network.now - load_start
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    results.append(["Commands", len(latencies)])
+    results.append(["Throughput (commands/s)", "{0:.1f}".format(len(latencies) / load_time if load_time else 0)])
+    for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+        if latencies:
+            value = latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+            results.append(["Latency {0} (ms)".format(name), "{0:.2f}".format(value * 1000)])
+
+    if args.transfer:
+        results.append(["Leadership transfers", " ".join(response for admin in transfers
+                                                        for response in admin.responses)])
+        results.append(["Transfer time (ms)", " ".join("{0:.2f}".format(latency * 1000)
+                                                       for admin in transfers for latency in admin.latencies)])
+
+    if args.isolate:
+        results.append(["Terms during the load", sum(
+            max(server.node.current_term for server in cluster.servers if server.node) - term
+            for cluster, term in zip(clusters, start_terms))])
+
+    if args.replace:
+        changes = [response for admin in admins for response in admin.responses]
+        results.append(["Membership changes", "{0}/{1}".format(
+            sum(response.startswith("Configuration changed") for response in changes), 2 * len(clusters))])
+
+        # The servers removed are stopped, once every cluster has a leader in its new configuration
+        network.run(until=network.now + 60, condition=lambda: all(cluster.leader() for cluster in clusters))
+        for cluster in clusters:
+            configuration = cluster.leader().configuration
+            for server in cluster.servers:
+                if server.node and not configuration.is_member(server.node_id):
+                    server.stop()
+        results.append(["Voters", " ".join(str(sorted(cluster.leader().configuration.voters))
+                                           for cluster in clusters)])
+
+    # Every leader crashes
+    for cluster in clusters:
+        leader = cluster.leader()
+        if leader:
+            next(server for server in cluster.servers if server.node is leader).stop()
+
+    crash_time = network.now
+    network.run(until=network.now + 60, condition=lambda: all(cluster.leader() for cluster in clusters))
+    results.append(["Re-election (s)", "{0:.3f}".format(network.now - crash_time)])
+
+    if args.follower_reads:
+        results.append(["Follower reads", sum(server.node.metrics.counters["follower_reads"]
+                                              for cluster in clusters for server in cluster.servers if server.node)])
+
+    results.append(["Messages sent", network.sent])
+    results.append(["Messages dropped", network.dropped])
+    results.append(["Virtual time (s)", "{0:.3f}".format(network.now)])
+    results.append(["Wall time (s)", "{0:.3f}".format(time.perf_counter() - start)])
+    return results
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    if args.verbose:
+        results = run_scenario(args)
+    else:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = run_scenario(args)
+
+    print(tabulate(results, headers=["Simulation", "Result"], tablefmt='fancy_grid'))
@@ -0,0 +1,295 @@
+from utils import *
+import operator
+from bisect import bisect_left
+
+""" State machines replicated by the nodes.
+
+A node only orders the commands: it hands each committed command to its state machine (apply), answers the
+read-only commands with it (query), and saves it in the snapshots (snapshot / restore).
+Any class with these four methods can be given to a Node, the KeyValueStore is the default one.
+A snapshot is written a few chunks at a time while the node goes on applying commands (see Node.take_snapshot),
+so the chunks must hold the state as it was when snapshot was called. """
+
+# Limits of the entries returned by a single SCAN (the response must fit in a datagram)
+SCAN_LIMIT = 1000
+SCAN_BYTES = 32768
+
+# Number of [key, value] pairs in each chunk of a snapshot
+SNAPSHOT_PAIRS = 1000
+
+# Comparisons allowed in the conditions of a transaction
+COMPARISONS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+               '>': operator.gt, '>=': operator.ge}
+
+# Errors raised while reading the arguments of a malformed command (which is answered "Invalid command")
+MALFORMED = (TypeError, ValueError, IndexError, KeyError)
+
+MISSING = object()  # Value of a key that does not exist
+
+
+class StateMachine(object):
+    """ Interface of the state machines. """
+
+    read_actions = ()  # Actions that do not change the state, served without going through the log
+
+    def apply(self, command):
+        """ Applies a committed command, returns the response for the client. """
+        raise NotImplementedError
+
+    def query(self, command):
+        """ Answers a read-only command, returns the response for the client. """
+        raise NotImplementedError
+
+    def snapshot(self):
+        """ Returns an iterator over the whole state, in json serializable chunks. """
+        raise NotImplementedError
+
+    def restore(self, chunks):
+        """ Replaces the whole state with the chunks returned by snapshot. """
+        raise NotImplementedError
+
+
+class KeyValueStore(StateMachine):
+    """ Keys (strings) and values of any kind.
+        • GET key: returns the value of the key.
+        • SET key value: sets the value of the key.
+        • DELETE key: removes the key.
+        • SCAN start [end, limit]: returns the [key, value] pairs from start (included) to end (excluded)
+        in order, at most 'limit' of them (and never more than SCAN_LIMIT or about SCAN_BYTES). The next
+        page starts right after the last key returned. A prefix scan ends at prefix_end(prefix).
+        • MSET [[key, value], ...]: sets several keys at once (a single log entry).
+        • MGET [key, ...]: returns the values of several keys (None for the missing ones).
+        • CAS key [expected, value]: sets the key only if its value is the expected one (None if the key must
+        not exist), returns [True, value] if it did, or [False, current value] if it did not.
+        • TXN [conditions, success, failure]: a small transaction. Each condition is [key, comparison, value]
+        (see COMPARISONS, a missing key has the value None); if they all hold the operations of 'success'
+        are applied, otherwise the ones of 'failure'. The operations are ["GET", key], ["SET", key, value]
+        and ["DELETE", key]. Returns [True if the conditions held, [response of each operation]].
+    The multi-key commands and the transactions are applied atomically, as any other command: their arguments
+    are checked before anything is changed ("Invalid command" otherwise).
+    The keys are kept in a dict and, for the scans, in a sorted list. The list is sorted lazily: the keys
+    added since the last scan are merged on the next one, and the deleted keys are dropped from it once they
+    are half of it, so each key costs a dict slot and about one list slot.
+    While a snapshot is being written, the first change of each key keeps the value it had before (copy on
+    write), so taking a snapshot does not copy the whole dict. """
+
+    read_actions = ('GET', 'SCAN', 'MGET')
+
+    def __init__(self, data=None):
+        self.data = {}  # {key: value}
+        self.index = []  # Sorted keys, including some of the deleted ones [key]
+        self.new_keys = []  # Keys added since the index was last sorted [key]
+        self.removed = set()  # Deleted keys still in the index or in new_keys {key}
+        self.frozen = None  # Values before their change of the keys changed during a snapshot {key: value}
+
+        if data:
+            self.restore([data.items()])
+
+    def __len__(self):
+        return len(self.data)
+
+    def apply(self, command):
+        action = command.action
+
+        if action == "SET":
+            return self.set(str(command.position), command.new_value)
+
+        if action == "DELETE":
+            return self.delete(str(command.position))
+
+        if action == "MSET":
+            try:
+                pairs = [(str(key), value) for key, value in command.new_value]
+            except MALFORMED:
+                return "Invalid command"
+            for key, value in pairs:
+                self.set(key, value)
+            return "Command executed successfully!"
+
+        if action == "CAS":
+            try:
+                expected, value = command.new_value
+            except MALFORMED:
+                return "Invalid command"
+            key = str(command.position)
+            current = self.data.get(key)
+            if current != expected:
+                return [False, current]
+            self.set(key, value)
+            return [True, value]
+
+        if action == "TXN":
+            try:
+                conditions, success, failure = self.parse_transaction(command.new_value)
+            except MALFORMED:
+                return "Invalid command"
+            succeeded = all(self.compare(*condition) for condition in conditions)
+            return [succeeded, [self.operation(*op) for op in (success if succeeded else failure)]]
+
+        if action in self.read_actions:
+            return self.query(command)
+
+        return "Invalid action: " + str(action)
+
+    def query(self, command):
+        if command.action == "GET":
+            return self.data.get(str(command.position), "Key not found")
+
+        try:
+            if command.action == "MGET":
+                return [self.data.get(str(key)) for key in command.new_value]
+
+            if command.action == "SCAN":
+                end, limit = command.new_value or (None, None)
+                return self.scan(str(command.position), end, limit)
+        except MALFORMED:
+            return "Invalid command"
+
+        return "Invalid action: " + str(command.action)
+
+    def set(self, key, value):
+        if self.frozen is not None and key not in self.frozen:
+            self.frozen[key] = self.data.get(key, MISSING)
+        if key not in self.data:
+            if key in self.removed:
+                self.removed.discard(key)
+            else:
+                self.new_keys.append(key)
+        self.data[key] = value
+        return "Command executed successfully!"
+
+    def delete(self, key):
+        if key not in self.data:
+            return "Key not found"
+        if self.frozen is not None and key not in self.frozen:
+            self.frozen[key] = self.data[key]
+        del self.data[key]
+        self.removed.add(key)
+        if len(self.removed) > len(self.data):
+            self.compact_index()
+        return "Key deleted"
+
+    @staticmethod
+    def parse_transaction(value):
+        """ Returns the conditions and the operations of a transaction, with the keys as strings.
+        Raises ValueError if it is not well formed. """
+
+        conditions, success, failure = value
+        conditions = [(str(key), comparison, expected) for key, comparison, expected in conditions]
+        if any(comparison not in COMPARISONS for key, comparison, expected in conditions):
+            raise ValueError("Unknown comparison")
+
+        operations = []
+        for ops in (success, failure):
+            if any(len(op) not in (2, 3) for op in ops):
+                raise ValueError("Operation without a key")
+            operations.append([(op[0], str(op[1]), op[2] if len(op) > 2 else None) for op in ops])
+            if any(action not in ("GET", "SET", "DELETE") for action, key, item in operations[-1]):
+                raise ValueError("Unknown operation")
+
+        return conditions, operations[0], operations[1]
+
+    def compare(self, key, comparison, value):
+        """ Evaluates a condition of a transaction (False if the values cannot be compared). """
+        try:
+            return bool(COMPARISONS[comparison](self.data.get(key), value))
+        except TypeError:
+            return False
+
+    def operation(self, action, key, value):
+        """ Applies an operation of a transaction, returns its response. """
+        if action == "GET":
+            return self.data.get(key)
+        if action == "SET":
+            return self.set(key, value)
+        return self.delete(key)
+
+    @staticmethod
+    def keys_of(command):
+        """ Returns the keys that a command reads or writes (none if it is malformed). """
+        try:
+            if command.action == "MSET":
+                return [key for key, value in command.new_value]
+            if command.action == "MGET":
+                return list(command.new_value)
+            if command.action == "TXN":
+                conditions, success, failure = command.new_value
+                return [condition[0] for condition in conditions] + [op[1] for op in list(success) + list(failure)]
+        except MALFORMED:
+            return []
+        return [command.position]
+
+    def scan(self, start, end=None, limit=None):
+        """ Returns the [key, value] pairs of the keys in [start, end), in order. """
+
+        self.sort_index()
+        limit = min(limit or SCAN_LIMIT, SCAN_LIMIT)
+        pairs = []
+        size = 0
+
+        for position in range(bisect_left(self.index, start), len(self.index)):
+            key = self.index[position]
+            if end is not None and key >= end:
+                break
+            if key not in self.data:
+                continue
+
+            value = self.data[key]
+            pairs.append([key, value])
+            size += len(key) + len(str(value))
+            if len(pairs) >= limit or size >= SCAN_BYTES:
+                break
+
+        return pairs
+
+    @staticmethod
+    def page_full(pairs, limit=None):
+        """ Returns True if a SCAN page stopped at its size limit (there may be more keys right after it). """
+        limit = min(limit or SCAN_LIMIT, SCAN_LIMIT)
+        return len(pairs) >= limit or sum(len(key) + len(str(value)) for key, value in pairs) >= SCAN_BYTES
+
+    def sort_index(self):
+        """ Merges the keys added since the last scan into the index. """
+        if self.new_keys:
+            self.new_keys.sort()
+            self.index += self.new_keys
+            self.index.sort()  # Two sorted runs, merged in linear time
+            self.new_keys = []
+
+    def compact_index(self):
+        """ Drops the deleted keys from the index. """
+        self.index = [key for key in self.index if key not in self.removed]
+        self.new_keys = [key for key in self.new_keys if key not in self.removed]
+        self.removed = set()
+
+    def snapshot(self):
+        """ Returns the [key, value] pairs in chunks of SNAPSHOT_PAIRS, read as the chunks are consumed. """
+        self.frozen = {}
+        return self.snapshot_chunks(self.index + self.new_keys, self.frozen)
+
+    def snapshot_chunks(self, keys, frozen):
+        # The keys added later are not in the list, the ones deleted before (or later) are skipped
+        for position in range(0, len(keys), SNAPSHOT_PAIRS):
+            chunk = []
+            for key in keys[position:position + SNAPSHOT_PAIRS]:
+                value = frozen[key] if key in frozen else self.data.get(key, MISSING)
+                if value is not MISSING:
+                    chunk.append([key, value])
+            yield chunk
+
+        if self.frozen is frozen:
+            self.frozen = None
+
+    def restore(self, chunks):
+        self.data = {str(key): item for chunk in chunks for key, item in chunk}
+        self.index = sorted(self.data)
+        self.new_keys = []
+        self.removed = set()
+        self.frozen = None
+
+
+def prefix_end(prefix):
+    """ Returns the first key after every key that starts with the prefix (None if there is none). """
+    while prefix and prefix[-1] == chr(0x10FFFF):
+        prefix = prefix[:-1]
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
@@ -0,0 +1,87 @@
+import sys
+import socket
+import select
+from message import Message
+from transport import FRAME
+from tabulate import tabulate
+from utils import *
+
+# Asks a server for its metrics
+# python stats.py <host> <port> [--json]
+
+""" Sends a Stats message to a server and shows the counters and histograms it answers with
+(the durations are shown in milliseconds). A large answer comes over TCP, on the same port (see transport.py). """
+
+
+def request_stats(server_address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((socket.gethostbyname(socket.gethostname()), 0))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(sock.getsockname())
+    listener.listen(1)
+
+    try:
+        Message('Stats', from_address=sock.getsockname(), to_address=server_address).send(sock)
+
+        ready, _, _ = select.select([sock, listener], [], [], SERVER_TIMEOUT)
+        if not ready:
+            raise socket.timeout("The server did not answer")
+
+        if sock in ready:
+            data, server = sock.recvfrom(MAX_DATAGRAM_SIZE)
+        else:
+            data = receive_frame(listener)
+    finally:
+        sock.close()
+        listener.close()
+
+    return json.loads(Message.deserialize(data).data)
+
+
+def receive_frame(listener):
+    """ Accepts the connection of the server and reads the first frame it sends. """
+
+    connection, _ = listener.accept()
+    connection.settimeout(SERVER_TIMEOUT)
+    data = b""
+    try:
+        while len(data) < FRAME.size or len(data) < FRAME.size + FRAME.unpack_from(data)[0]:
+            chunk = connection.recv(65536)
+            if not chunk:
+                raise ConnectionError("Connection closed by the server")
+            data += chunk
+    finally:
+        connection.close()
+
+    return data[FRAME.size:FRAME.size + FRAME.unpack_from(data)[0]]
+
+
+def show_stats(stats):
+    print(tabulate(stats['node'].items(), headers=["Node", ""], tablefmt='fancy_grid'))
+
+    if stats.get('match_index_lag'):
+        print(tabulate(stats['match_index_lag'].items(), headers=["Follower", "Lag (entries)"],
+                       tablefmt='fancy_grid'))
+
+    print(tabulate(stats['counters'].items(), headers=["Counter", "Value"], tablefmt='fancy_grid'))
+
+    rows = []
+    for name, histogram in stats['histograms'].items():
+        # Durations are in seconds, sizes are shown as they are
+        scale = 1000 if name.endswith((".latency", ".duration", ".held")) else 1
+        rows.append([name, histogram['count']] +
+                    ["{0:.3f}".format(histogram[key] * scale) if histogram[key] is not None else "-"
+                     for key in ('mean', 'p50', 'p99', 'p999', 'max')])
+
+    print(tabulate(rows, headers=["Histogram", "Count", "Mean", "p50", "p99", "p999", "Max"], tablefmt='fancy_grid'))
+
+
+if __name__ == '__main__':
+
+    address = (sys.argv[1], int(sys.argv[2]))
+    stats = request_stats(address)
+
+    if "--json" in sys.argv:
+        print(json.dumps(stats, indent=2))
+    else:
+        show_stats(stats)
@@ -0,0 +1,483 @@
+from utils import *
+from bisect import bisect_right
+from array import array
+import codec
+import struct
+import mmap
+import io
+import os
+
+# Record of a segment index: end offset of the entry in the data file, term of the entry
+INDEX_RECORD = struct.Struct("<QQ")
+
+
+class Segment(object):
+    """ The Segment class represents a piece of the log, starting at a given index, made of two files:
+        • data file (.log): the entries encoded one after another (codec.write_entry).
+        • index file (.idx): a fixed size record for each entry with its end offset in the data file and its term.
+          The file is created with room for every entry of the segment, and is mapped in memory,
+          so finding an entry or its term never requires reading the data file nor keeping objects. """
+
+    def __init__(self, directory, first_index, capacity):
+        self.first_index = first_index  # Index of the first entry of the segment
+        self.data_path = os.path.join(directory, "{0:020d}.log".format(first_index))
+        self.index_path = os.path.join(directory, "{0:020d}.idx".format(first_index))
+
+        # The data file is created first, and a missing one is created empty (its index records are then discarded
+        # by recover), so a crash while the segment is being started never leaves files that cannot be opened
+        open(self.data_path, "ab").close()
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) == 0:
+            with open(self.index_path, "wb") as file:
+                file.truncate(capacity * INDEX_RECORD.size)
+
+        self.data = open(self.data_path, "r+b")
+        self.index_file = open(self.index_path, "r+b")
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        self.capacity = len(self.index) // INDEX_RECORD.size  # Maximum number of entries
+
+        self.count = 0  # Number of entries in the segment
+        self.size = 0  # Size of the data file
+        self.dirty = False  # There are writes not yet forced to stable storage
+        self.recover()
+
+    def recover(self):
+        """ Finds the entries of the segment. The index records in use are the ones with a non zero
+        end offset (they are zeroed when entries are truncated). Entries whose data was not completely
+        written before a crash are discarded, as well as data not covered by the index. """
+
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if self.end_offset(middle):
+                low = middle + 1
+            else:
+                high = middle
+        count = low
+
+        data_size = os.path.getsize(self.data_path)
+        self.count = count
+        while count and self.end_offset(count - 1) > data_size:
+            count -= 1
+
+        self.truncate_at(count)
+
+    def end_offset(self, position):
+        """ Returns the offset at which the entry at the given position (from 0) ends. """
+        if position < 0:
+            return 0
+        return INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size)[0]
+
+    def last_index(self):
+        return self.first_index + self.count - 1
+
+    def term(self, index):
+        return INDEX_RECORD.unpack_from(self.index, (index - self.first_index) * INDEX_RECORD.size)[1]
+
+    def read(self, begin, end):
+        """ Returns the entries from index begin to end (not included). """
+
+        start = self.end_offset(begin - self.first_index - 1)
+        stop = self.end_offset(end - self.first_index - 1)
+
+        self.data.seek(start)
+        view = self.data.read(stop - start)
+
+        entries = []
+        pos = 0
+        for _ in range(end - begin):
+            log, pos = codec.read_entry(view, pos)
+            entries.append(log)
+        return entries
+
+    def append(self, records):
+        """ Writes encoded entries [(data, term)] at the end of the segment. """
+
+        self.data.seek(self.size)
+        self.data.write(b"".join(data for data, term in records))
+
+        for data, term in records:
+            self.size += len(data)
+            INDEX_RECORD.pack_into(self.index, self.count * INDEX_RECORD.size, self.size, term)
+            self.count += 1
+
+        self.dirty = True
+
+    def truncate_at(self, count):
+        """ Keeps only the first entries of the segment. """
+
+        self.index[count * INDEX_RECORD.size:self.count * INDEX_RECORD.size] = \
+            bytes((self.count - count) * INDEX_RECORD.size)
+        self.count = count
+        self.size = self.end_offset(count - 1)
+        self.data.truncate(self.size)
+        self.dirty = True
+
+    def sync(self, fsync=True):
+        """ Writes the buffered entries to the operating system and, with fsync, forces them to the disk. """
+        if self.dirty:
+            self.data.flush()
+            if fsync:
+                os.fsync(self.data.fileno())
+                self.index.flush()
+                self.dirty = False
+
+    def close(self):
+        self.index.close()
+        self.index_file.close()
+        self.data.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.data_path)
+        os.remove(self.index_path)
+
+
+class SnapshotWriter(object):
+    """ A new snapshot, written piece by piece to a temporary file (or to memory), which only replaces
+    the stored snapshot once it is complete (see save_snapshot). """
+
+    def __init__(self, file, path=None):
+        self.file = file  # File being written
+        self.path = path  # Path of the temporary file (None in memory)
+        self.size = 0  # Number of bytes written so far
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def discard(self):
+        """ Abandons the snapshot. """
+        self.file.close()
+        if self.path:
+            os.remove(self.path)
+
+
+class WriteAheadLog(object):
+    """ The WriteAheadLog class represents the stable storage of a node.
+    Log entries are written to a sequence of segments (see Segment), each of them with at most SEGMENT_ENTRIES
+    entries and about SEGMENT_SIZE bytes, so each write only costs the new entries, while the term and vote
+    are kept in a small separate metadata record. The latest snapshot of the state machine is stored next
+    to them, and the segments whose entries are all covered by it are removed. The snapshot is never held
+    in memory as a whole: it is written (SnapshotWriter) and read back (load_snapshot, read_snapshot) in pieces.
+    Only the LOG_CACHE_SIZE most recent entries are kept in memory as objects, older entries are read back
+    from the segments, so the memory used does not grow with the log. """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, segment_entries=SEGMENT_ENTRIES,
+                 cache_size=LOG_CACHE_SIZE):
+        self.directory = directory  # Folder containing the metadata record and the segment files
+        self.segment_size = segment_size  # Size of a segment data file after which a new segment is started
+        self.segment_entries = segment_entries  # Maximum number of entries of a segment
+        self.cache_size = cache_size  # Number of recent entries kept in memory
+        self.segments = []  # Segments of the log, in order [Segment]
+        self.first_indexes = []  # First log index of each segment
+        self.last_index = 0  # Index of the last entry stored in the log (or included in the snapshot)
+        self.meta = None  # Last (term, voted_for) written to the metadata record
+        self.cache = []  # Most recent entries, from cache_index to last_index [Log]
+        self.cache_index = 1  # Index of the first entry of the cache
+        self.snapshot_size = 0  # Size in bytes of the stored snapshot
+
+        os.makedirs(directory, exist_ok=True)
+
+    def meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, "snapshot.jsonl")
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Metadata -------------------------------------------------------------------------------------------------- """
+
+    def load_meta(self):
+        """ Returns the stored (term, voted_for) record, or None if it has never been written. """
+        if not os.path.exists(self.meta_path()):
+            return None
+
+        with open(self.meta_path(), "r") as file:
+            data = json.loads(file.read())
+
+        self.meta = (data['term'], data['voted_for'])
+        return self.meta
+
+    def save_meta(self, term, voted_for):
+        """ Durably replaces the metadata record. """
+        self.replace_file(self.meta_path(), json.dumps({'term': term, 'voted_for': voted_for}))
+        self.meta = (term, voted_for)
+
+    @staticmethod
+    def replace_file(path, content):
+        """ Writes the content to a temporary file that is then renamed over the old one,
+        so a crash never leaves a half written record behind. """
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_path, path)
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Snapshots ------------------------------------------------------------------------------------------------- """
+
+    def load_snapshot(self):
+        """ Returns an iterator over the lines of the stored snapshot (see Node.take_snapshot), which are read
+        from the file as they are consumed, or None if no snapshot has been taken. """
+        if not os.path.exists(self.snapshot_path()):
+            return None
+
+        self.snapshot_size = os.path.getsize(self.snapshot_path())
+        return self.read_lines(self.snapshot_path())
+
+    @staticmethod
+    def read_lines(path):
+        with open(path, "rb") as file:
+            yield from file
+
+    def read_snapshot(self, offset, size):
+        """ Returns at most 'size' bytes of the stored snapshot, from the given offset. """
+        with open(self.snapshot_path(), "rb") as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def begin_snapshot(self, incoming=False):
+        """ Starts writing a new snapshot, taken by the node or received from the leader ('incoming'). """
+        path = self.snapshot_path() + (".incoming" if incoming else ".tmp")
+        return SnapshotWriter(open(path, "wb"), path)
+
+    def save_snapshot(self, writer, last_index):
+        """ Durably replaces the snapshot with the one just written, which covers every entry up to the given
+        index, and then removes the log segments that are no longer needed. """
+
+        writer.file.flush()
+        os.fsync(writer.file.fileno())
+        writer.file.close()
+        os.replace(writer.path, self.snapshot_path())
+
+        self.snapshot_size = writer.size
+        self.compact(last_index)
+
+    def compact(self, index):
+        """ Removes the segments whose entries are all at or before the given index.
+        If the index is beyond the end of the log, the next entry appended will follow it. """
+
+        while self.segments and self.segments[0].last_index() <= index:
+            self.segments.pop(0).remove()
+            self.first_indexes.pop(0)
+
+        self.last_index = max(self.last_index, index)
+        self.trim_cache(index + 1)
+
+    """ ----------------------------------------------------------------------------------------------------------- """
+    """ Log entries ----------------------------------------------------------------------------------------------- """
+
+    def load(self, snapshot_index=0):
+        """ Opens the segments of the log, the entries up to snapshot_index are already in the snapshot. """
+
+        self.close()
+
+        names = os.listdir(self.directory)
+        for first_index in sorted(int(name[:-4]) for name in names if name.endswith(".idx")):
+            segment = Segment(self.directory, first_index, self.segment_entries)
+            if segment.count == 0 and self.segments:
+                # Empty segment left behind by a crash, while it was being started
+                segment.remove()
+                continue
+            self.segments.append(segment)
+            self.first_indexes.append(first_index)
+
+        self.last_index = self.segments[-1].last_index() if self.segments else 0
+        self.cache = []
+        self.cache_index = self.last_index + 1
+
+        self.compact(snapshot_index)
+
+    def segment(self, index):
+        """ Returns the segment that contains the entry at the given index. """
+        if index >= self.first_indexes[-1]:
+            return self.segments[-1]
+        return self.segments[bisect_right(self.first_indexes, index) - 1]
+
+    def first_index(self):
+        """ Returns the index of the first entry stored in the log. """
+        return self.first_indexes[0] if self.segments else self.last_index + 1
+
+    def term(self, index):
+        """ Returns the term of the entry at the given index, which must be stored in the log. """
+        return self.segment(index).term(index)
+
+    def entry(self, index):
+        """ Returns the entry at the given index, which must be stored in the log. """
+        if index >= self.cache_index:
+            return self.cache[index - self.cache_index]
+        return self.segment(index).read(index, index + 1)[0]
+
+    def entries(self, begin, end):
+        """ Returns the entries from index begin to end (not included). """
+
+        if begin >= self.cache_index:
+            return self.cache[begin - self.cache_index:end - self.cache_index]
+
+        entries = []
+        while begin < end:
+            if begin >= self.cache_index:
+                return entries + self.cache[begin - self.cache_index:end - self.cache_index]
+
+            segment = self.segment(begin)
+            stop = min(end, segment.last_index() + 1, self.cache_index)
+            entries += segment.read(begin, stop)
+            begin = stop
+        return entries
+
+    def scan(self, begin, chunk=1024):
+        """ Iterates over the entries from the given index to the end of the log, reading them in chunks. """
+        while begin <= self.last_index:
+            end = min(begin + chunk, self.last_index + 1)
+            for log in self.entries(begin, end):
+                yield log
+            begin = end
+
+    def append(self, entries):
+        """ Writes the given entries at the end of the log. They are forced to stable storage by sync. """
+
+        position = 0
+        while position < len(entries):
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.count == segment.capacity or segment.size >= self.segment_size:
+                segment = self.open_segment(self.last_index + 1)
+
+            records = []
+            room = segment.capacity - segment.count
+            size = segment.size
+            while position < len(entries) and len(records) < room and size < self.segment_size:
+                log = entries[position]
+                data = bytearray()
+                codec.write_entry(data, log)
+                if log.size is None:
+                    log.size = len(data)
+                records.append((data, log.term))
+                size += len(data)
+                position += 1
+
+            segment.append(records)
+            self.last_index += len(records)
+
+        self.cache += entries
+        if len(self.cache) >= 2 * self.cache_size:
+            self.trim_cache(self.last_index + 1 - self.cache_size)
+
+    def truncate(self, index):
+        """ Discards every stored entry after the given index. """
+
+        if index >= self.last_index:
+            return
+
+        while self.segments and self.segments[-1].first_index > index:
+            self.segments.pop().remove()
+            self.first_indexes.pop()
+
+        if self.segments:
+            self.segments[-1].truncate_at(index - self.segments[-1].first_index + 1)
+
+        del self.cache[max(0, index + 1 - self.cache_index):]
+        self.last_index = index
+        self.cache_index = min(self.cache_index, index + 1)
+
+    def trim_cache(self, index):
+        """ Drops from the cache the entries before the given index. """
+        if index > self.cache_index:
+            del self.cache[:index - self.cache_index]
+            self.cache_index = min(index, self.last_index + 1)
+
+    def open_segment(self, first_index):
+        """ Starts a new segment beginning at the given index. """
+        segment = Segment(self.directory, first_index, self.segment_entries)
+        self.segments.append(segment)
+        self.first_indexes.append(first_index)
+        return segment
+
+    def sync(self, fsync=True):
+        """ Forces the written entries to stable storage (only to the operating system without fsync). """
+        for segment in self.segments:
+            segment.sync(fsync)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        self.first_indexes = []
+
+
+class MemoryStorage(object):
+    """ The MemoryStorage class keeps the same records as the WriteAheadLog, but in memory.
+    It is used by the simulated network: it survives the restart of a simulated node (the node
+    is rebuilt with the same storage), but not the end of the process. """
+
+    def __init__(self):
+        self.log = []  # Stored log entries, after the ones covered by the snapshot [Log]
+        self.terms = array('q')  # Term of each stored entry (like the index of a segment)
+        self.log_index = 1  # Index of the first stored entry
+        self.last_index = 0  # Index of the last entry stored in the log (or included in the snapshot)
+        self.meta = None  # Last (term, voted_for) saved
+        self.snapshot = None  # Stored snapshot (bytes)
+        self.snapshot_size = 0  # Size in bytes of the stored snapshot
+
+    def load_meta(self):
+        return self.meta
+
+    def save_meta(self, term, voted_for):
+        self.meta = (term, voted_for)
+
+    def load_snapshot(self):
+        return iter(self.snapshot.splitlines()) if self.snapshot else None
+
+    def read_snapshot(self, offset, size):
+        return self.snapshot[offset:offset + size]
+
+    def begin_snapshot(self, incoming=False):
+        return SnapshotWriter(io.BytesIO())
+
+    def save_snapshot(self, writer, last_index):
+        self.snapshot = writer.file.getvalue()
+        self.snapshot_size = len(self.snapshot)
+        self.compact(last_index)
+
+    def compact(self, index):
+        del self.log[:max(0, index - self.log_index + 1)]
+        del self.terms[:max(0, index - self.log_index + 1)]
+        self.log_index = max(self.log_index, index + 1)
+        self.last_index = max(self.last_index, index)
+
+    def load(self, snapshot_index=0):
+        self.compact(snapshot_index)
+
+    def first_index(self):
+        return self.log_index
+
+    def term(self, index):
+        return self.terms[index - self.log_index]
+
+    def entry(self, index):
+        return self.log[index - self.log_index]
+
+    def entries(self, begin, end):
+        return self.log[begin - self.log_index:end - self.log_index]
+
+    def scan(self, begin):
+        return iter(self.log[begin - self.log_index:])
+
+    def append(self, entries):
+        self.log += entries
+        self.terms.extend(log.term for log in entries)
+        self.last_index += len(entries)
+
+    def truncate(self, index):
+        if index < self.last_index:
+            del self.log[max(0, index - self.log_index + 1):]
+            del self.terms[max(0, index - self.log_index + 1):]
+            self.last_index = index
+
+    def sync(self, fsync=True):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,94 @@
+import unittest
+import codec
+from message import Message
+from utils import *
+
+# Binary encoding of every message, alone and in batches
+# python -m pytest test_codec.py (from the Raft folder)
+
+ADDRESS = ("10.0.0.1", 3001)
+CLIENT_ADDRESS = ("10.1.0.1", 4000)
+
+# A value of each kind of field, with varints of several bytes and every tag of the generic values
+VALUES = {
+    'uint': 300,
+    'bool': True,
+    'str': "snapshot chunk ñ",
+    'addr': ADDRESS,
+    'value': [None, True, False, -5, 2 ** 40, 2.5, "ü", {"key": [1, 2]}, [["a", "==", 1]]],
+    'command': Command(CLIENT_ADDRESS, "c1-7", "TXN", "key", [[["a", "==", 1]], [["SET", "b", 2]], []]),
+    'entries': [Log(Command(None, None, "NOOP", None, None), 3),
+                Log(Command(CLIENT_ADDRESS, "c1-8", "SET", "1", "value"), 200),
+                Log(Command(ADDRESS, 9, "MSET", None, [["a", 1], ["b", -1]]), 200)],
+}
+
+
+def comparable(value):
+    """ Turns the commands and log entries into tuples, which can be compared. """
+    if isinstance(value, Log):
+        return value.term, comparable(value.command)
+    if isinstance(value, Command):
+        return (value.client_address and tuple(value.client_address), value.serial, value.action, value.position,
+                value.new_value)
+    if isinstance(value, list):
+        return [comparable(item) for item in value]
+    return value
+
+
+def full_message(msg_type, direction, group_id=None):
+    """ Returns a message of the given type with every field of its schema set. """
+    message = Message(msg_type, from_address=None, to_address=ADDRESS, direction=direction)
+    for name, kind in codec.SCHEMAS[(msg_type, direction)]:
+        setattr(message, name, VALUES[kind])
+    message.group_id = group_id
+    return message
+
+
+class CodecTest(unittest.TestCase):
+
+    def assert_same(self, decoded, message):
+        self.assertEqual((decoded.msg_type, decoded.direction), (message.msg_type, message.direction))
+        for name, kind in codec.SCHEMAS[(message.msg_type, message.direction)]:
+            self.assertEqual(comparable(getattr(decoded, name)), comparable(getattr(message, name)), name)
+
+    def test_every_schema(self):
+        for msg_type, direction in codec.SCHEMAS:
+            for group_id in (None, 0, 1000):
+                message = full_message(msg_type, direction, group_id)
+                self.assert_same(codec.decode(codec.encode(message), Message), message)
+
+    def test_missing_fields(self):
+        message = Message('AppendEntries', from_address=ADDRESS, to_address=ADDRESS, direction='request', term=2)
+        decoded = codec.decode(codec.encode(message), Message)
+        self.assert_same(decoded, message)
+        self.assertIsNone(decoded.entries)
+
+    def test_truncated(self):
+        data = codec.encode(full_message('AppendEntries', 'request'))
+        with self.assertRaises(ValueError):
+            codec.decode(data[:-1], Message)
+
+    def test_batches(self):
+        messages = [full_message(msg_type, direction, group_id=number)
+                    for number, (msg_type, direction) in enumerate(codec.SCHEMAS)]
+        data = [codec.encode(message) for message in messages]
+
+        # Split into datagrams no larger than the limit, the messages are decoded from views of them
+        limit = sum(len(item) for item in data) // 3
+        datagrams = codec.pack(data, limit)
+        self.assertGreater(len(datagrams), 2)
+        self.assertTrue(all(len(datagram) <= limit for datagram in datagrams))
+
+        received = [item for datagram in datagrams for item in codec.unpack(datagram)]
+        self.assertEqual([bytes(item) for item in received], data)
+        self.assertTrue(all(isinstance(item, memoryview) for item in codec.unpack(datagrams[0])))
+        for item, message in zip(received, messages):
+            self.assert_same(Message.deserialize(item), message)
+
+        # A message alone is sent as it is
+        self.assertEqual(codec.pack(data[:1]), data[:1])
+        self.assertEqual(codec.unpack(data[0]), [data[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import io
+import random
+import unittest
+import contextlib
+from message import Message
+from simulation import SimulatedNetwork, Cluster
+from tracing import Tracer
+from utils import *
+
+# Convergence of a server whose log diverges from the leader's
+# python -m pytest test_convergence.py (from the Raft folder, the nodes read configs/parameters/params-test.json)
+
+""" Three servers restart with logs that share a few entries and then diverge: two of them have entries
+of a later term, and the third one has thousands of entries of an older term, which were never committed.
+One of the first two is elected, and the third one must drop its divergent entries: with the conflict term and index
+that it sends back (see Node.receive_append_entries_reply), the leader skips the whole divergent term in a single
+round trip, instead of one entry per round trip. """
+
+COMMON_ENTRIES = 10  # Entries of the first term, in every log
+LEADER_ENTRIES = 500  # Entries of the third term, in the logs of the first two servers
+DIVERGENT_ENTRIES = 3000  # Entries of the second term, in the log of the third server only
+
+
+class CountingNetwork(SimulatedNetwork):
+    """ Counts the AppendEntries requests sent to a server, and the ones it rejects. """
+
+    def __init__(self, seed=0):
+        super().__init__(seed, jitter=0.0)  # The batches sent to a follower arrive in order
+        self.watched = None  # Address of the server whose AppendEntries are counted
+        self.requests = 0
+        self.rejections = 0
+
+    def send(self, source, data, destination):
+        message = Message.deserialize(data)
+        if message.msg_type == 'AppendEntries':
+            if message.direction == 'request' and tuple(destination) == self.watched:
+                self.requests += 1
+            elif message.direction == 'reply' and tuple(source) == self.watched and not message.success:
+                self.rejections += 1
+        super().send(source, data, destination)
+
+
+def entries(first_index, count, term):
+    return [Log(Command(None, None, "SET", str(index % 5 + 1), index), term)
+            for index in range(first_index, first_index + count)]
+
+
+class ConvergenceTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)  # Election timeouts of the nodes
+        self.network = CountingNetwork(seed=1)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.cluster = Cluster(self.network, 0, 3, Tracer(clock=self.network))
+
+            # The servers are restarted with the logs that they had stored
+            common = entries(1, COMMON_ENTRIES, 1)
+            logs = [common + entries(COMMON_ENTRIES + 1, LEADER_ENTRIES, 3)] * 2
+            logs.append(common + entries(COMMON_ENTRIES + 1, DIVERGENT_ENTRIES, 2))
+            for server, log in zip(self.cluster.servers, logs):
+                server.stop()
+                server.storage.save_meta(log[-1].term, None)
+                server.storage.append(log)
+                server.start()
+
+    def run_until(self, condition, timeout=60):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(self.network.run(until=self.network.now + timeout, condition=condition))
+
+    @staticmethod
+    def converged(node, leader):
+        last_index = leader.last_log_index()
+        return node.last_log_index() == last_index and node.log_term(last_index) == leader.log_term(last_index)
+
+    def test_large_divergence(self):
+        follower = self.cluster.servers[2].node
+        self.network.watched = tuple(follower.address)
+
+        self.run_until(self.cluster.leader)
+        leader = self.cluster.leader()
+        election_time = self.network.now
+        self.assertIsNot(leader, follower)
+
+        self.run_until(lambda: self.converged(follower, leader))
+
+        # The first batch is rejected, the next ones carry the leader's entries from the end of the common ones,
+        # a few round trips in all (sending one entry less after each rejection would take hundreds)
+        self.assertEqual(self.network.rejections, 1)
+        self.assertLessEqual(self.network.requests, 20)
+        self.assertLess(self.network.now - election_time, 20 * self.network.latency)
+        self.assertEqual(follower.log_term(COMMON_ENTRIES + 1), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import io
+import random
+import unittest
+import contextlib
+import node
+from message import Message
+from simulation import SimulatedNetwork, SimulatedTransport, Cluster
+from tracing import Tracer
+from utils import *
+
+# Servers that still hear from the leader: they do not elect another one, which the leases rely on
+# python -m pytest test_leader_contact.py (from the Raft folder, the nodes read configs/parameters/params-test.json)
+
+CLIENT_ADDRESS = ("10.1.0.1", 4000)
+
+
+class PartialNetwork(SimulatedNetwork):
+    """ A network where two given servers cannot reach each other, while both reach everybody else. """
+
+    def __init__(self, seed=0):
+        super().__init__(seed)
+        self.cut = None  # Addresses of the two servers that are cut off from each other {address}
+
+    def connected(self, source, destination):
+        if self.cut and {tuple(source), tuple(destination)} == self.cut:
+            return False
+        return super().connected(source, destination)
+
+
+class LeaderContactTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)  # Election timeouts of the nodes
+        self.network = PartialNetwork(seed=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.cluster = Cluster(self.network, 0, 3, Tracer(clock=self.network))
+        self.run_until(self.cluster.leader)
+        self.leader = self.cluster.leader()
+
+        # The replies to the client requests
+        self.replies = []
+        self.network.attach(CLIENT_ADDRESS, lambda data: self.replies.append(Message.deserialize(data)))
+
+    def run_until(self, condition=None, until=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.network.run(until=until or self.network.now + 60, condition=condition)
+
+    def followers(self):
+        return [server.node for server in self.cluster.servers if server.node is not self.leader]
+
+    def read(self, serial):
+        """ Sends the leader a GET, and returns the replies received for it. """
+        command = Command(CLIENT_ADDRESS, serial, "GET", "1", None)
+        message = Message('ClientRequest', from_address=CLIENT_ADDRESS, to_address=self.leader.address,
+                          command=command)
+        message.send(SimulatedTransport(self.network, CLIENT_ADDRESS))
+        self.run_until(until=self.network.now + 4 * self.network.latency)
+        return [reply for reply in self.replies if reply.command.serial == serial]
+
+    def test_disruptive_candidate(self):
+        # A follower that no longer hears from the leader starts an election (without PreVote, which the third
+        # server would refuse as well), but the third server still hears from the leader and ignores it
+        candidate, voter = self.followers()
+        term = self.leader.current_term
+        self.network.cut = {tuple(self.leader.address), tuple(candidate.address)}
+        with contextlib.redirect_stdout(io.StringIO()):
+            candidate.start_election()
+
+        self.run_until(until=self.network.now + 4 * ELECTION_INTERVAL[1])
+        self.assertGreater(voter.metrics.counters["received.RequestVote.request"], 0)
+        self.assertIs(self.cluster.leader(), self.leader)
+        self.assertEqual(voter.current_term, term)
+        self.assertNotEqual(candidate.state, "LEADER")
+
+    def test_lease_expires(self):
+        lease_reads = node.LEASE_READS
+        node.LEASE_READS = True
+        try:
+            self.run_until(until=self.network.now + 2 * HEARTBEAT_TIMEOUT)
+
+            # The leader is cut off from the followers, its lease still covers the first read
+            self.network.partition([self.leader.address], [server.address for server in self.followers()])
+            self.assertLess(self.network.now, self.leader.lease_expiration)
+            self.assertEqual([reply.response for reply in self.read("1")], ["value"])
+
+            # Once the lease has expired, a read waits for a heartbeat round that no follower answers
+            self.run_until(until=self.leader.lease_expiration)
+            self.assertEqual(self.leader.state, "LEADER")
+            self.assertEqual(self.read("2"), [])
+            self.assertEqual(len(self.leader.pending_reads), 1)
+
+            # Until the leader steps down (CheckQuorum), and sends the client to look for the new leader
+            self.run_until(lambda: self.leader.state != "LEADER")
+            self.run_until(until=self.network.now + 4 * self.network.latency)
+            self.assertEqual([reply.response for reply in self.replies if reply.command.serial == "2"], [None])
+        finally:
+            node.LEASE_READS = lease_reads
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+from raft_client import AsyncRaftClient
+from state_machine import KeyValueStore, prefix_end
+from utils import *
+
+# Requests of the client library that involve several Raft groups
+# python -m pytest test_raft_client.py (from the Raft folder)
+
+GROUPS = 3
+KEYS = ["a{0}".format(number) for number in range(20)] + ["b0", "b1"]
+
+
+class LocalClient(AsyncRaftClient):
+    """ Hands each command straight to the state machine of its group, instead of sending it to the servers. """
+
+    def __init__(self, groups):
+        super().__init__([], groups=groups)
+        self.stores = [KeyValueStore({}) for _ in range(groups or 1)]
+
+    async def request(self, action, position, value=None, timeout=None, group_id=None):
+        command = Command(None, None, action, position, value)
+        if group_id is None:
+            group_id = self.group_of(command)
+        return self.stores[group_id or 0].apply(command)
+
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = LocalClient(GROUPS)
+        for key in KEYS:
+            asyncio.run(self.client.set(key, key.upper()))
+
+    def test_keys_spread_over_groups(self):
+        self.assertEqual(len({group_of(key, GROUPS) for key in KEYS}), GROUPS)
+
+    def test_scan_prefix_covers_every_group(self):
+        pairs = asyncio.run(self.client.scan_prefix("a"))
+        self.assertEqual(pairs, sorted([key, key.upper()] for key in KEYS if key.startswith("a")))
+
+    def test_pages_across_groups(self):
+        # Every group fills its page, the merged page stops at the first key where one of them ended
+        keys = []
+        start = "a"
+        while True:
+            page = asyncio.run(self.client.scan(start, prefix_end("a"), limit=3))
+            if not page:
+                break
+            self.assertLessEqual(len(page), 3)
+            keys += [key for key, value in page]
+            start = page[-1][0] + chr(0)
+
+        self.assertEqual(keys, sorted(key for key in KEYS if key.startswith("a")))
+
+    def test_scan_request_needs_every_group(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.client.request('SCAN', "a", [None, None]))
+
+    def test_scan_without_groups(self):
+        client = LocalClient(None)
+        for key in KEYS:
+            asyncio.run(client.set(key, key.upper()))
+        self.assertEqual(asyncio.run(client.scan_prefix("a", limit=5)), asyncio.run(self.client.scan_prefix("a", 5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import state_machine
+from state_machine import KeyValueStore
+from utils import *
+
+# Commands of the key-value store, and its snapshots
+# python -m pytest test_state_machine.py (from the Raft folder)
+
+
+def command(action, position=None, value=None):
+    return Command(None, None, action, position, value)
+
+
+class KeyValueStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = KeyValueStore({"a": 1, "b": 2})
+
+    def apply(self, action, position=None, value=None):
+        return self.store.apply(command(action, position, value))
+
+    def test_get_set_delete(self):
+        self.assertEqual(self.apply("SET", "c", 3), "Command executed successfully!")
+        self.assertEqual(self.store.query(command("GET", "c")), 3)
+        self.assertEqual(self.apply("DELETE", "c"), "Key deleted")
+        self.assertEqual(self.apply("DELETE", "c"), "Key not found")
+        self.assertEqual(self.store.query(command("GET", "c")), "Key not found")
+        self.assertEqual(self.apply("PUT", "c", 3), "Invalid action: PUT")
+
+    def test_mset_mget(self):
+        self.assertEqual(self.apply("MSET", None, [["b", 20], ["c", 30]]), "Command executed successfully!")
+        self.assertEqual(self.store.query(command("MGET", None, ["a", "b", "c", "d"])), [1, 20, 30, None])
+
+        # A malformed pair leaves every key as it was
+        self.assertEqual(self.apply("MSET", None, [["a", 10], ["b"]]), "Invalid command")
+        self.assertEqual(self.apply("MSET", None, 5), "Invalid command")
+        self.assertEqual(self.store.data["a"], 1)
+        self.assertEqual(self.store.query(command("MGET", None, 5)), "Invalid command")
+
+    def test_cas(self):
+        self.assertEqual(self.apply("CAS", "a", [1, 10]), [True, 10])
+        self.assertEqual(self.apply("CAS", "a", [1, 11]), [False, 10])
+        self.assertEqual(self.apply("CAS", "c", [None, 30]), [True, 30])
+        self.assertEqual(self.apply("CAS", "c", [None, 31]), [False, 30])
+        self.assertEqual(self.apply("CAS", "a", 5), "Invalid command")
+        self.assertEqual(self.apply("CAS", "a", [10]), "Invalid command")
+        self.assertEqual(self.store.data, {"a": 10, "b": 2, "c": 30})
+
+    def test_transaction(self):
+        success = [["SET", "c", "yes"], ["GET", "a"], ["DELETE", "b"]]
+        failure = [["SET", "c", "no"]]
+        self.assertEqual(self.apply("TXN", None, [[["a", "==", 1], ["d", "==", None]], success, failure]),
+                         [True, ["Command executed successfully!", 1, "Key deleted"]])
+        self.assertEqual(self.store.data, {"a": 1, "c": "yes"})
+
+        # Values that cannot be compared fail the condition
+        self.assertEqual(self.apply("TXN", None, [[["a", "<", "x"]], success, failure]),
+                         [False, ["Command executed successfully!"]])
+        self.assertEqual(self.store.data["c"], "no")
+
+    def test_malformed_transaction(self):
+        # Nothing is applied, not even the operations that are well formed
+        malformed = [[[["a", "~", 1]], [["SET", "c", 3]], []],  # Unknown comparison
+                     [[], [["SET", "c", 3]], [["SET"]]],  # Operation without a key
+                     [[], [["SET", "c", 3], ["PUT", "d", 4]], []],  # Unknown operation
+                     [[["a"]], [], []],  # Incomplete condition
+                     [[], [["SET", "c", 3]]],  # No failure operations
+                     5]
+        for value in malformed:
+            self.assertEqual(self.apply("TXN", None, value), "Invalid command")
+        self.assertEqual(self.store.data, {"a": 1, "b": 2})
+
+    def test_scan(self):
+        self.apply("MSET", None, [["a1", 3], ["c", 4]])
+        self.assertEqual(self.store.query(command("SCAN", "a", ["b", None])), [["a", 1], ["a1", 3]])
+        self.assertEqual(self.store.query(command("SCAN", "", [None, 2])), [["a", 1], ["a1", 3]])
+        self.assertEqual(self.store.query(command("SCAN", "", 5)), "Invalid command")
+
+    def test_keys_of_malformed_command(self):
+        self.assertEqual(KeyValueStore.keys_of(command("TXN", None, [[], [["SET"]], []])), [])
+        self.assertEqual(KeyValueStore.keys_of(command("MSET", None, 5)), [])
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pairs = state_machine.SNAPSHOT_PAIRS
+        state_machine.SNAPSHOT_PAIRS = 2  # Several chunks with a few keys
+        self.store = KeyValueStore({str(number): number for number in range(7)})
+
+    def tearDown(self):
+        state_machine.SNAPSHOT_PAIRS = self.pairs
+
+    def test_restore(self):
+        chunks = list(self.store.snapshot())
+        self.assertEqual(len(chunks), 4)
+
+        store = KeyValueStore()
+        store.restore(chunks)
+        self.assertEqual(store.data, self.store.data)
+        self.assertEqual(store.scan("", None), self.store.scan("", None))
+
+    def test_changes_while_writing(self):
+        # The commands applied while the chunks are written do not change the snapshot
+        expected = dict(self.store.data)
+        self.store.apply(command("DELETE", "6"))
+        expected.pop("6")
+
+        chunks = self.store.snapshot()
+        written = next(chunks)
+        self.store.apply(command("SET", "0", "changed"))
+        self.store.apply(command("SET", "3", "changed"))
+        self.store.apply(command("DELETE", "4"))
+        self.store.apply(command("SET", "6", "added again"))
+        self.store.apply(command("MSET", None, [["7", "new"], ["5", "changed"]]))
+        written += [pair for chunk in chunks for pair in chunk]
+
+        self.assertEqual(dict(written), expected)
+        self.assertIsNone(self.store.frozen)
+        self.assertEqual(self.store.data["3"], "changed")
+        self.assertNotIn("4", self.store.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import unittest
+from storage import WriteAheadLog
+from utils import *
+
+# Recovery of the write-ahead log after a crash
+# python -m pytest test_storage.py (from the Raft folder)
+
+SEGMENT_ENTRIES = 10  # Small segments, so a few entries span several of them
+
+
+def entries(first_index, count, term=1):
+    return [Log(Command(None, str(index), "SET", str(index), "value-{0}".format(index)), term)
+            for index in range(first_index, first_index + count)]
+
+
+class WriteAheadLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = None
+
+    def tearDown(self):
+        if self.log:
+            self.log.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, snapshot_index=0):
+        """ Opens the log again, as a node does when it restarts. """
+        if self.log:
+            self.log.close()
+        self.log = WriteAheadLog(self.directory, segment_entries=SEGMENT_ENTRIES)
+        self.log.load(snapshot_index)
+        return self.log
+
+    def write(self, count, term=1):
+        log = self.open()
+        log.append(entries(log.last_index + 1, count, term))
+        log.sync()
+        log.close()
+        self.log = None
+
+    def path(self, first_index, extension):
+        return os.path.join(self.directory, "{0:020d}.{1}".format(first_index, extension))
+
+    def serials(self, log):
+        return [int(entry.command.serial) for entry in log.entries(log.first_index(), log.last_index + 1)]
+
+    def test_reload(self):
+        self.write(25)
+        self.write(5, term=2)
+        log = self.open()
+
+        self.assertEqual(log.last_index, 30)
+        self.assertEqual(self.serials(log), list(range(1, 31)))
+        self.assertEqual([log.term(index) for index in (1, 25, 26, 30)], [1, 1, 2, 2])
+        self.assertEqual(log.entry(12).command.new_value, "value-12")
+
+    def test_torn_write(self):
+        # The last entry was only partly written to the data file
+        self.write(25)
+        data_path = self.path(21, "log")
+        os.truncate(data_path, os.path.getsize(data_path) - 3)
+
+        log = self.open()
+        self.assertEqual(log.last_index, 24)
+        self.assertEqual(self.serials(log), list(range(1, 25)))
+
+        # The entries written afterwards follow the ones recovered
+        log.append(entries(25, 3, term=2))
+        log.sync()
+        self.assertEqual(self.open().last_index, 27)
+        self.assertEqual(self.log.term(25), 2)
+
+    def test_index_past_data(self):
+        # The index records reached the disk, but the data of several entries did not
+        self.write(25)
+        data_path = self.path(21, "log")
+        os.truncate(data_path, os.path.getsize(data_path) // 2)
+
+        log = self.open()
+        self.assertTrue(21 < log.last_index < 25)
+        self.assertEqual(self.serials(log), list(range(1, log.last_index + 1)))
+
+        # Nothing is left of the last segment, which is removed
+        os.truncate(data_path, 0)
+        log = self.open()
+        self.assertEqual(log.last_index, 20)
+        self.assertFalse(os.path.exists(data_path))
+
+    def test_index_without_data_file(self):
+        # A crash while a segment was being started left its index only
+        self.write(25)
+        os.remove(self.path(21, "log"))
+
+        log = self.open()
+        self.assertEqual(log.last_index, 20)
+        self.assertFalse(os.path.exists(self.path(21, "idx")))
+
+        log.append(entries(21, 10))
+        log.sync()
+        self.assertEqual(self.serials(self.open()), list(range(1, 31)))
+
+    def test_empty_index(self):
+        self.write(25)
+        open(self.path(21, "idx"), "wb").close()
+
+        log = self.open()
+        self.assertEqual(log.last_index, 20)
+
+    def test_truncate(self):
+        self.write(25)
+        log = self.open()
+        log.truncate(13)
+        log.sync()
+
+        self.assertFalse(os.path.exists(self.path(21, "idx")))
+        log = self.open()
+        self.assertEqual(log.last_index, 13)
+        self.assertEqual(self.serials(log), list(range(1, 14)))
+
+        # The entries that replace the discarded ones are written in their place
+        log.append(entries(14, 4, term=3))
+        log.sync()
+        log = self.open()
+        self.assertEqual(log.last_index, 17)
+        self.assertEqual([log.term(index) for index in (13, 14, 17)], [1, 3, 3])
+
+    def test_restart_after_compact(self):
+        self.write(25)
+        log = self.open()
+        log.compact(15)
+
+        # Only the segments that are all before the snapshot are removed
+        self.assertFalse(os.path.exists(self.path(1, "log")))
+        self.assertTrue(os.path.exists(self.path(11, "log")))
+
+        log = self.open(snapshot_index=15)
+        self.assertEqual(log.first_index(), 11)
+        self.assertEqual(log.last_index, 25)
+        self.assertEqual([int(entry.command.serial) for entry in log.scan(16)], list(range(16, 26)))
+
+    def test_compact_beyond_log(self):
+        # A snapshot received from the leader covers more entries than the log has
+        self.write(5)
+        log = self.open()
+        log.compact(40)
+        self.assertEqual(log.first_index(), 41)
+
+        log.append(entries(41, 3))
+        log.sync()
+        log = self.open(snapshot_index=40)
+        self.assertEqual(log.first_index(), 41)
+        self.assertEqual(log.last_index, 43)
+
+    def test_snapshot(self):
+        self.write(25)
+        log = self.open()
+        self.assertIsNone(log.load_snapshot())
+
+        writer = log.begin_snapshot()
+        writer.write(b'{"last_index": 15}\n')
+        writer.write(b'[["a", 1]]\n')
+        log.save_snapshot(writer, 15)
+        self.assertEqual(log.first_index(), 11)
+
+        # A snapshot received meanwhile is abandoned, the stored one is left as it was
+        writer = log.begin_snapshot(incoming=True)
+        writer.write(b"{")
+        writer.discard()
+
+        log = self.open(snapshot_index=15)
+        self.assertEqual(list(log.load_snapshot()), [b'{"last_index": 15}\n', b'[["a", 1]]\n'])
+        self.assertEqual(log.snapshot_size, 30)
+        self.assertEqual(log.read_snapshot(19, 100), b'[["a", 1]]\n')
+        self.assertEqual(sorted(os.listdir(self.directory))[-1], "snapshot.jsonl")
+
+    def test_meta(self):
+        log = self.open()
+        self.assertIsNone(log.load_meta())
+        log.save_meta(7, 2)
+        self.assertEqual(self.open().load_meta(), (7, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
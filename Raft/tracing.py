@@ -0,0 +1,146 @@
+import sys
+import struct
+import codec
+from datetime import datetime
+from utils import *
+
+# Shows the events of a trace dump
+# python tracing.py data/server-1/trace.bin
+
+""" Tracing of the events of a node.
+
+Each event has a level (ERROR, WARNING, INFO, DEBUG, TRACE) and up to four integer arguments.
+Every event is first written as a fixed size binary record to a ring buffer in memory, which keeps the last
+TRACE_BUFFER events and can be dumped to a file when something has to be investigated (kill -USR1 <pid>).
+The events at TRACE_LEVEL or above are also written to the output, the ones below INFO only in the
+TRACE_SAMPLE fraction of cases. An event is only turned into text when it is written to the output,
+so the events that are not shown only cost the binary record. """
+
+ERROR, WARNING, INFO, DEBUG, TRACE = 40, 30, 20, 10, 5
+LEVELS = {'ERROR': ERROR, 'WARNING': WARNING, 'INFO': INFO, 'DEBUG': DEBUG, 'TRACE': TRACE}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+# Record of the ring buffer: time, level, event, four arguments
+RECORD = struct.Struct("<dBHqqqq")
+
+EVENTS = []  # Every event defined, by its id
+
+
+class Event(object):
+    """ Kind of event, with the function that describes it from its arguments. """
+
+    def __init__(self, name, describe):
+        self.id = len(EVENTS)
+        self.name = name
+        self.describe = describe  # describe(a, b, c, d) -> str
+
+        EVENTS.append(self)
+
+
+def message_kind(code):
+    """ Name of a message from its code (message type code * 2 + 1 if it is a reply, as in codec.py). """
+    return codec.MSG_TYPES[code >> 1] + ("-Reply" if code & 1 else "")
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Events -------------------------------------------------------------------------------------------------------- """
+
+MESSAGE_RECEIVED = Event("message_received",
+                         lambda a, b, c, d: "Received {0} from node {1} (term {2})".format(message_kind(a), b, c))
+REPLY_SENT = Event("reply_sent",
+                   lambda a, b, c, d: " -> {0} to port {1}".format(message_kind(a), b))
+ELECTION_TIMEOUT = Event("election_timeout",
+                         lambda a, b, c, d: ">>> Election Timeout <<< (term {0})".format(a))
+ELECTION_STARTED = Event("election_started",
+                         lambda a, b, c, d: "Sending RequestVote (term {0}, last log index {1})".format(a, b))
+BECAME_LEADER = Event("became_leader",
+                      lambda a, b, c, d: "<<< I AM THE LEADER >>> (term {0}, last log index {1})".format(a, b))
+STEPPED_DOWN = Event("stepped_down",
+                     lambda a, b, c, d: "Stepped down from {0} (term {1} -> {2})".format(
+                         ['FOLLOWER', 'CANDIDATE', 'LEADER'][a], b, c))
+HEARTBEAT = Event("heartbeat",
+                  lambda a, b, c, d: "Sending AppendEntries (term {0}, round {1}, commit index {2})".format(a, b, c))
+SNAPSHOT_TAKEN = Event("snapshot_taken",
+                       lambda a, b, c, d: "Snapshot taken up to index {0} (term {1})".format(a, b))
+SERVER_ERROR = Event("server_error",
+                     lambda a, b, c, d: "Error")
+CONFIGURATION_CHANGED = Event("configuration_changed",
+                              lambda a, b, c, d: "Configuration of index {0} in effect "
+                                                 "({1} voters, {2} learners)".format(a, b, c))
+PRE_VOTE_STARTED = Event("pre_vote_started",
+                         lambda a, b, c, d: "Sending PreVote (term {0}, last log index {1})".format(a, b))
+QUORUM_LOST = Event("quorum_lost",
+                    lambda a, b, c, d: "Lost contact with the majority, stepping down (term {0}, {1} voters "
+                                       "reached)".format(a, b))
+LEADERSHIP_TRANSFER = Event("leadership_transfer",
+                            lambda a, b, c, d: "Transferring the leadership to node {0} (term {1}, last log index "
+                                               "{2})".format(a, b, c))
+TIMEOUT_NOW = Event("timeout_now",
+                    lambda a, b, c, d: ">>> TimeoutNow <<< from node {1} (term {0})".format(a, b))
+
+
+""" --------------------------------------------------------------------------------------------------------------- """
+""" Tracer -------------------------------------------------------------------------------------------------------- """
+
+
+class Tracer(object):
+    """ The Tracer class records the events of a node (or of several nodes that share it). """
+
+    def __init__(self, level=None, sample=None, capacity=None, clock=time, output=None):
+        self.level = LEVELS[level or TRACE_LEVEL]  # Lowest level written to the output
+        self.sample = TRACE_SAMPLE if sample is None else sample  # Fraction of the events below INFO written
+        self.capacity = capacity or TRACE_BUFFER  # Number of records kept in the ring buffer
+        self.clock = clock  # Source of the time of the events (time)
+        self.output = output  # File where the events are written (sys.stdout if None)
+        self.buffer = bytearray(RECORD.size * self.capacity)
+        self.position = 0  # Number of records written so far
+        self.random = random.Random(0)  # Sampling does not disturb other random sequences (simulation)
+
+    def record(self, level, event, a=0, b=0, c=0, d=0, detail=None):
+        """ Records an event. The detail (any object, e.g. a message) is only converted to text,
+        after the description of the event, if the event is written to the output. """
+
+        now = self.clock.time()
+        RECORD.pack_into(self.buffer, (self.position % self.capacity) * RECORD.size, now, level, event.id, a, b, c, d)
+        self.position += 1
+
+        if level >= self.level and (level >= INFO or self.sample >= 1 or self.random.random() < self.sample):
+            self.emit(now, level, event, a, b, c, d, detail)
+
+    def emit(self, when, level, event, a, b, c, d, detail=None):
+        output = self.output or sys.stdout
+        output.write("{0} {1:<7} {2}\n".format(format_time(when), LEVEL_NAMES.get(level, level),
+                                               event.describe(a, b, c, d)))
+        if detail is not None:
+            output.write(str(detail) + "\n")
+
+    def records(self):
+        """ Returns the records of the ring buffer, from the oldest to the newest. """
+        first = max(0, self.position - self.capacity)
+        return [RECORD.unpack_from(self.buffer, (position % self.capacity) * RECORD.size)
+                for position in range(first, self.position)]
+
+    def dump(self, file_name):
+        """ Writes the ring buffer to a file, in order (it is read with 'python tracing.py <file>'). """
+        with open(file_name, "wb") as file:
+            for record in self.records():
+                file.write(RECORD.pack(*record))
+
+
+def format_time(when):
+    # Virtual times (simulation) are small numbers of seconds, and are shown as they are
+    if when < 1e9:
+        return "{0:12.6f}".format(when)
+    return datetime.fromtimestamp(when).strftime("%H:%M:%S.%f")
+
+
+def read_dump(file_name):
+    with open(file_name, "rb") as file:
+        return list(RECORD.iter_unpack(file.read()))
+
+
+if __name__ == '__main__':
+
+    for when, level, event_id, a, b, c, d in read_dump(sys.argv[1]):
+        print("{0} {1:<7} {2}".format(format_time(when), LEVEL_NAMES.get(level, level),
+                                      EVENTS[event_id].describe(a, b, c, d)))
@@ -0,0 +1,244 @@
+""" Transports used by the nodes to send their messages.
+
+A Node does not use sockets directly, it sends the serialized messages through a transport, which only
+has to provide 'sendto(data, address)'. The messages received are handed to Node.receive_message by
+whoever owns the transport (server.py for UDP, simulation.py for the simulated network, multiraft.py for hosts
+of several Raft groups).
+
+The messages larger than STREAM_THRESHOLD travel over TCP instead (see HybridTransport): every server and client
+also listens for connections on the port of its UDP endpoint, and each peer is sent its messages through a single
+persistent connection, as frames preceded by their length. The small control messages (heartbeats, votes,
+most client requests) stay on UDP. """
+
+import socket
+import struct
+import asyncio
+import codec
+from utils import *
+
+# Header of each frame of a stream: size of the message that follows
+FRAME = struct.Struct("!I")
+
+# Largest frame accepted, a connection that announces a larger one is closed
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Bytes waiting to be written to a connection above which the new messages are dropped (the peer is not keeping up,
+# and Raft sends again whatever is lost)
+MAX_PENDING_BYTES = 16 * 1024 * 1024
+
+# Delay before connecting again to a peer that could not be reached: starts at STREAM_BACKOFF_MIN seconds
+# and doubles up to STREAM_BACKOFF_MAX
+STREAM_BACKOFF_MIN = 0.05
+STREAM_BACKOFF_MAX = 2.0
+
+
+class Transport(object):
+    """ Interface of the transports. """
+
+    def sendto(self, data, address):
+        """ Sends a serialized message (bytes) to the given address. Delivery is not guaranteed. """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Writes the messages that the transport holds right away, instead of once the event is handled. """
+        pass
+
+    def close(self):
+        """ Releases the connections of the transport (not the endpoint it was given). """
+        pass
+
+
+class UdpTransport(Transport):
+    """ Sends the messages as UDP datagrams, through an asyncio datagram transport or a socket. """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint  # asyncio.DatagramTransport or socket.socket
+
+    def sendto(self, data, address):
+        self.endpoint.sendto(data, address)
+
+
+class CoalescingTransport(Transport):
+    """ Holds the messages sent to each address until it is flushed, and then sends them together,
+    packed in as few datagrams as possible (see codec.pack). The nodes of a host share it, so the messages
+    that several Raft groups send to the same server while the host handles an event travel together. """
+
+    def __init__(self, transport=None):
+        self.transport = transport  # Transport that sends the datagrams
+        self.queues = {}  # Messages waiting to be sent to each address {address: [data]}
+
+    def sendto(self, data, address):
+        self.queues.setdefault(address, []).append(data)
+
+    def flush(self):
+        queues, self.queues = self.queues, {}
+        for address, messages in queues.items():
+            for datagram in codec.pack(messages):
+                self.transport.sendto(datagram, address)
+
+
+class StreamTransport(Transport):
+    """ Sends the messages over TCP, through one persistent connection per peer, opened on the first message. """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.connections = {}  # {address: StreamConnection}
+
+    def sendto(self, data, address):
+        """ Returns False if the message was dropped because the peer cannot be reached right now. """
+        connection = self.connections.get(address)
+        if connection is None:
+            connection = self.connections[address] = StreamConnection(self.loop, address)
+        return connection.send(data)
+
+    def flush(self):
+        for connection in self.connections.values():
+            connection.flush()
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+
+class StreamConnection(asyncio.Protocol):
+    """ Outgoing connection to a peer. The frames sent while the event loop handles an event are written together
+    (write coalescing) once it is done. If the peer cannot be reached, the messages are dropped and the connection
+    is tried again after a growing delay. """
+
+    def __init__(self, loop, address):
+        self.loop = loop
+        self.address = address  # Address of the peer (ip, port)
+        self.transport = None  # asyncio.Transport, while connected
+        self.connecting = False
+        self.pending = bytearray()  # Frames waiting to be written
+        self.flush_scheduled = False
+        self.backoff = STREAM_BACKOFF_MIN  # Delay before the next attempt, if this one fails
+        self.retry_time = 0  # Time (of the loop) before which the peer is not tried again
+        self.closed = False
+
+    def send(self, data):
+        if self.transport is None and not self.connecting:
+            if self.closed or self.loop.time() < self.retry_time:
+                return False
+            self.connect()
+
+        buffered = len(self.pending) + (self.transport.get_write_buffer_size() if self.transport else 0)
+        if buffered > MAX_PENDING_BYTES:
+            return False
+
+        self.pending += FRAME.pack(len(data))
+        self.pending += data
+
+        if self.transport and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+        return True
+
+    def connect(self):
+        self.connecting = True
+        task = self.loop.create_task(self.loop.create_connection(lambda: self, *self.address))
+        task.add_done_callback(self.connection_done)
+
+    def connection_done(self, task):
+        self.connecting = False
+        if task.cancelled() or task.exception():
+            self.pending.clear()
+            self.retry_time = self.loop.time() + self.backoff
+            self.backoff = min(STREAM_BACKOFF_MAX, self.backoff * 2)
+        else:
+            self.backoff = STREAM_BACKOFF_MIN
+            self.flush()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connection_lost(self, exc):
+        # The frames not written are lost, the next message opens a new connection
+        self.transport = None
+        self.pending.clear()
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.transport and self.pending:
+            self.transport.write(bytes(self.pending))
+            self.pending.clear()
+
+    def close(self):
+        self.closed = True
+        if self.transport:
+            self.transport.close()
+
+
+class StreamReceiver(asyncio.Protocol):
+    """ Incoming connection from a peer: splits the stream into frames and hands each one to the handler,
+    as if it were a datagram (handler(data, address)). """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.transport = None
+        self.peer = None  # Address of the peer's end of the connection
+        self.buffer = bytearray()  # Data received and not handled yet
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+
+    def data_received(self, data):
+        self.buffer += data
+        pos = 0
+
+        while len(self.buffer) - pos >= FRAME.size:
+            size = FRAME.unpack_from(self.buffer, pos)[0]
+            if size > MAX_FRAME_SIZE:
+                self.transport.close()
+                return
+            if len(self.buffer) - pos - FRAME.size < size:
+                break
+            start = pos + FRAME.size
+            self.handler(bytes(self.buffer[start:start + size]), self.peer)
+            pos = start + size
+
+        del self.buffer[:pos]
+
+
+class HybridTransport(Transport):
+    """ Sends the small messages as UDP datagrams and the ones larger than the threshold over TCP.
+    A large message that fits in a datagram goes by UDP while the peer cannot be reached over TCP. """
+
+    def __init__(self, datagrams, streams, threshold=STREAM_THRESHOLD):
+        self.datagrams = datagrams  # UdpTransport
+        self.streams = streams  # StreamTransport
+        self.threshold = threshold  # Largest message sent by UDP (bytes)
+
+    def sendto(self, data, address):
+        if len(data) <= self.threshold or not self.streams.sendto(data, address):
+            if len(data) <= MAX_DATAGRAM_SIZE:
+                self.datagrams.sendto(data, address)
+
+    def flush(self):
+        self.streams.flush()
+
+    def close(self):
+        self.streams.close()
+
+
+async def open_transport(datagram_transport, handler, address):
+    """ Starts listening for TCP connections on the address of a datagram endpoint, whose frames are handed
+    to the handler (as datagram_received). Returns the transport to send the messages through and the TCP server
+    (None if STREAM_THRESHOLD is not set, or if the port is not available, then everything goes by UDP). """
+
+    datagrams = UdpTransport(datagram_transport)
+    if not STREAM_THRESHOLD:
+        return datagrams, None
+
+    loop = asyncio.get_running_loop()
+    try:
+        server = await loop.create_server(lambda: StreamReceiver(handler), address[0], address[1])
+    except OSError:
+        return datagrams, None
+
+    return HybridTransport(datagrams, StreamTransport(loop)), server
@@ -1,6 +1,7 @@
 import json
 import time
 import random
+import zlib
 
 
 with open('configs/parameters/params-test.json', 'r') as file:
@@ -22,10 +23,104 @@ HEARTBEAT_TIMEOUT = config['HEARTBEAT_TIMEOUT']
 # (A random number contained in the given interval is taken).
 ELECTION_INTERVAL = config['ELECTION_INTERVAL']
 
+# With PRE_VOTE, a server makes sure that a majority would vote for it before starting an election (so a server
+# cut off from the others does not depose the leader when it comes back), and with CHECK_QUORUM, a leader steps
+# down when it stops hearing from a majority of the voters (see Leader Election in node.py).
+PRE_VOTE = config['PRE_VOTE']
+CHECK_QUORUM = config['CHECK_QUORUM']
 
-def random_timeout():
+# Maximum size in bytes of a write-ahead log segment file,
+# once it is reached the following entries are written to a new segment.
+SEGMENT_SIZE = config['SEGMENT_SIZE']
+
+# Maximum number of entries of a segment (size of its index file, which has 16 bytes per entry).
+SEGMENT_ENTRIES = config['SEGMENT_ENTRIES']
+
+# Number of the most recent log entries kept in memory as objects,
+# older entries are read back from the segment files when they are needed.
+LOG_CACHE_SIZE = config['LOG_CACHE_SIZE']
+
+# The state machine is saved in a new snapshot, and the log is truncated, once the entries applied since the last
+# snapshot take SNAPSHOT_RATIO times the size of that snapshot (and at least SNAPSHOT_MIN_SIZE bytes), so the
+# cost of writing the state is spread over a log that grows with it.
+SNAPSHOT_MIN_SIZE = config['SNAPSHOT_MIN_SIZE']
+SNAPSHOT_RATIO = config['SNAPSHOT_RATIO']
+
+# Bytes of the snapshot written at each step, between which the node goes on handling messages.
+SNAPSHOT_STEP_SIZE = config['SNAPSHOT_STEP_SIZE']
+
+# Maximum size of each chunk of a snapshot sent to a lagging follower
+# (over TCP, see STREAM_THRESHOLD, otherwise it is reduced to fit in a datagram).
+SNAPSHOT_CHUNK_SIZE = config['SNAPSHOT_CHUNK_SIZE']
+
+# Format of the messages on the wire: "binary" (compact encoding) or "json" (readable, for debugging).
+WIRE_FORMAT = config['WIRE_FORMAT']
+
+# Largest datagram that servers and clients are able to receive.
+MAX_DATAGRAM_SIZE = 65507
+
+# When the log entries are forced to disk (fsync): "always" every time they are written, "interval" at most every
+# FSYNC_INTERVAL seconds, or "none" (left to the operating system). Without fsync, a server that crashes along with
+# its machine may lose entries that it had acknowledged.
+FSYNC_POLICY = config['FSYNC_POLICY']
+FSYNC_INTERVAL = config['FSYNC_INTERVAL']
+
+# Messages larger than this many bytes are sent over TCP instead of UDP (see transport.py), null to only use UDP.
+STREAM_THRESHOLD = config['STREAM_THRESHOLD']
+
+# Limits of each batch of log entries sent in an AppendEntries message
+# (number of entries, and bytes of the entries in the binary wire format).
+MAX_BATCH_ENTRIES = config['MAX_BATCH_ENTRIES']
+MAX_BATCH_BYTES = config['MAX_BATCH_BYTES']
+
+# Maximum number of AppendEntries batches sent to a follower and waiting for its answer.
+MAX_INFLIGHT = config['MAX_INFLIGHT']
+
+# Client sessions: maximum number of sessions kept, number of applied log entries after which
+# an idle session expires, and number of responses kept for each client.
+MAX_SESSIONS = config['MAX_SESSIONS']
+SESSION_EXPIRY = config['SESSION_EXPIRY']
+SESSION_HISTORY = config['SESSION_HISTORY']
+
+# Reads served with a leader lease instead of confirming the leadership with a heartbeat round,
+# and maximum relative clock drift between servers (the lease is shortened by it).
+LEASE_READS = config['LEASE_READS']
+CLOCK_DRIFT = config['CLOCK_DRIFT']
+
+# Group commit: the leader collects client commands for BATCH_WINDOW seconds, or until
+# BATCH_SIZE commands arrive, and then appends them to the log all together.
+BATCH_WINDOW = config['BATCH_WINDOW']
+BATCH_SIZE = config['BATCH_SIZE']
+
+# Maximum number of replication rounds given to a new server to catch up with the leader
+# before it becomes a voter (see membership.py), after which the change is abandoned.
+CATCH_UP_ROUNDS = config['CATCH_UP_ROUNDS']
+
+# Every STATS_INTERVAL seconds, the servers write their metrics to data/server-N/stats.json.
+STATS_INTERVAL = config['STATS_INTERVAL']
+
+# Tracing (see tracing.py): lowest level of the events shown (ERROR, WARNING, INFO, DEBUG, TRACE),
+# fraction of the events below INFO that are shown, and number of events kept in memory for dumps.
+# At TRACE level every message received is shown in full, as a table.
+TRACE_LEVEL = config['TRACE_LEVEL']
+TRACE_SAMPLE = config['TRACE_SAMPLE']
+TRACE_BUFFER = config['TRACE_BUFFER']
+
+
+def random_timeout(clock=time):
     """ Returns a timeout chosen randomly from a fixed interval (150-300ms). """
-    return time.time() + (random.uniform(*ELECTION_INTERVAL))
+    return clock.time() + (random.uniform(*ELECTION_INTERVAL))
+
+
+def group_of(key, groups):
+    """ Returns the Raft group that holds the given key, when the data is split among several groups. """
+    return zlib.crc32(str(key).encode()) % groups
+
+
+def to_dict(obj):
+    """ Returns the fields of an object as a dictionary, to be written as json.
+    The classes with __slots__ have no __dict__, they provide their own to_dict. """
+    return obj.to_dict() if hasattr(obj, 'to_dict') else obj.__dict__
 
 
 class Host(object):
@@ -33,6 +128,8 @@ class Host(object):
     and they are used to facilitate communication with the cluster servers.
     These only contain the id of the node and its address. """
 
+    __slots__ = ('node_id', 'address')
+
     def __init__(self, node_id, address):
         self.node_id = node_id
         self.address = tuple(address)
@@ -43,8 +140,11 @@ class Host(object):
         string += "Address: " + str(self.address)
         return string
 
+    def to_dict(self):
+        return {'node_id': self.node_id, 'address': self.address}
+
     def serialize(self):
-        return json.dumps(self, default=lambda o: o.__dict__, indent=4)
+        return json.dumps(self, default=to_dict, indent=4)
 
 
 class Command(object):
@@ -53,43 +153,53 @@ class Command(object):
     A command contains:
         • client_address: The address of the client that created it.
         • serial: A unique serial number to identify it.
-        • action: The action to be executed (GET/SET).
-        • position: The position on which the action will take effect.
+        • action: The action to be executed (GET/SET/DELETE/SCAN, see state_machine.py).
+        • position: The key on which the action will take effect.
         • new_value: The value to be applied (in case the action is 'SET').
-        • old_value: The value that the machine contains before executing this command.
-        • executed: A field that identifies if the command has already been executed.
     """
 
-    def __init__(self, client_address, serial, action, position, new_value=None, old_value=None, executed=False):
+    __slots__ = ('client_address', 'serial', 'action', 'position', 'new_value')
+
+    def __init__(self, client_address, serial, action, position, new_value=None):
         self.client_address = client_address
         self.serial = serial
         self.action = action
         self.position = position
         self.new_value = new_value
-        self.old_value = old_value
-        self.executed = executed
 
     def __str__(self):
-        if self.action == "GET":
+        if self.action in ("GET", "DELETE"):
             return "(" + self.action + ", " + str(self.position) + ")"
         else:
             return "(" + self.action + ", " + str(self.position) + ", " + str(self.new_value) + ")"
 
+    def to_dict(self):
+        return {'client_address': self.client_address, 'serial': self.serial, 'action': self.action,
+                'position': self.position, 'new_value': self.new_value}
+
     def serialize(self):
-        return json.dumps(self, default=lambda o: o.__dict__, indent=4)
+        return json.dumps(self, default=to_dict, indent=4)
 
 
 class Log(object):
     """ A a log is a field belonging to a server's log record and they are used
     in the process of log replication between all the servers in the cluster.
-    These contain a command sent by a client and a term that identifies the moment the log was added. """
+    These contain a command sent by a client and a term that identifies the moment the log was added.
+    Entries are never modified once appended, so the same objects are kept by the storage
+    and sent to the followers. """
+
+    __slots__ = ('command', 'term', 'size')
 
     def __init__(self, command, term):
         self.command = command
         self.term = term
+        self.size = None  # Size of the entry on the wire, computed the first time it is replicated
+
+    def to_dict(self):
+        return {'command': self.command, 'term': self.term}
 
     def serialize(self):
-        return json.dumps(self, default=lambda o: o.__dict__, indent=4)
+        return json.dumps(self, default=to_dict, indent=4)
 
     def __str__(self):
         return "(" + str(self.command) + " " + str(self.term) + ")"